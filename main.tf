@@ -43,19 +43,22 @@ module "aviatrix_controller_build" {
 }
 
 module "aviatrix_controller_initialize" {
-  source                        = "./modules/aviatrix_controller_initialize"
-  avx_controller_public_ip      = module.aviatrix_controller_build.aviatrix_controller_public_ip_address
-  avx_controller_private_ip     = module.aviatrix_controller_build.aviatrix_controller_private_ip_address
-  avx_controller_admin_email    = var.avx_controller_admin_email
-  avx_controller_admin_password = var.avx_controller_admin_password
-  arm_subscription_id           = module.aviatrix_controller_azure.subscription_id
-  arm_application_id            = module.aviatrix_controller_azure.application_id
-  arm_application_key           = module.aviatrix_controller_azure.application_key
-  directory_id                  = module.aviatrix_controller_azure.directory_id
-  account_email                 = var.account_email
-  access_account_name           = var.access_account_name
-  aviatrix_customer_id          = var.aviatrix_customer_id
-  controller_version            = var.controller_version
+  source                          = "./modules/aviatrix_controller_initialize"
+  avx_controller_public_ip        = module.aviatrix_controller_build.aviatrix_controller_public_ip_address
+  avx_controller_private_ip       = module.aviatrix_controller_build.aviatrix_controller_private_ip_address
+  avx_controller_instance_id      = module.aviatrix_controller_build.aviatrix_controller_virtual_machine_id
+  avx_controller_admin_email      = var.avx_controller_admin_email
+  avx_controller_admin_password   = var.avx_controller_admin_password
+  arm_subscription_id             = module.aviatrix_controller_azure.subscription_id
+  arm_application_id              = module.aviatrix_controller_azure.application_id
+  arm_application_key             = module.aviatrix_controller_azure.application_key
+  directory_id                    = module.aviatrix_controller_azure.directory_id
+  account_email                   = var.account_email
+  access_account_name             = var.access_account_name
+  aviatrix_customer_id            = var.aviatrix_customer_id
+  controller_version              = var.controller_version
+  location                        = var.location
+  controller_virtual_machine_size = var.controller_virtual_machine_size
 
   depends_on = [
     module.aviatrix_controller_azure
@@ -1,43 +1,375 @@
+import argparse
+import concurrent.futures
+import itertools
 import json
+import os
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
+try:
+    import fcntl
+except ImportError:
+    # Windows: the cache is only locked within the process, its writes stay atomic
+    fcntl = None
 
-def accept_license():
-    # Accept Azure Marketplace image terms so that the image can be used to create VMs
-    subprocess.Popen(
-        [
-            "az",
-            "vm",
-            "image",
-            "terms",
-            "accept",
-            "--urn",
-            "aviatrix-systems:aviatrix-bundle-payg:aviatrix-enterprise-bundle-byol:latest",
-        ],
+default_urn = "aviatrix-systems:aviatrix-bundle-payg:aviatrix-enterprise-bundle-byol:latest"
+
+# On-disk cache of accepted Marketplace terms, keyed by subscription and URN
+default_cache_file = os.environ.get(
+    "AVIATRIX_LICENSE_CACHE_FILE",
+    os.path.join(os.path.expanduser("~"), ".aviatrix", "marketplace_terms_cache.json"),
+)
+default_cache_ttl = int(os.environ.get("AVIATRIX_LICENSE_CACHE_TTL", "86400"))
+
+# "az" runs the Azure CLI, "rest" calls the Marketplace agreements REST API directly
+default_backend = os.environ.get("AVIATRIX_LICENSE_BACKEND", "az")
+default_timeout = int(os.environ.get("AVIATRIX_LICENSE_TIMEOUT", "120"))
+
+# Endpoints of the REST backend, can point to a local stub
+arm_endpoint = os.environ.get("AVIATRIX_ARM_ENDPOINT", "https://management.azure.com")
+arm_login_endpoint = os.environ.get("AVIATRIX_ARM_LOGIN_ENDPOINT", "https://login.microsoftonline.com")
+marketplace_api_version = "2021-01-01"
+
+# Number of (subscription, URN) pairs checked and accepted at the same time in batch mode
+default_max_workers = int(os.environ.get("AVIATRIX_LICENSE_MAX_WORKERS", "8"))
+
+_cache_lock = threading.Lock()
+_token_lock = threading.Lock()
+_access_token = None
+
+
+def get_profile_subscription_id():
+    # The default subscription of the Azure CLI profile, read without starting the CLI
+    profile_file = os.path.join(
+        os.environ.get("AZURE_CONFIG_DIR", os.path.join(os.path.expanduser("~"), ".azure")),
+        "azureProfile.json",
+    )
+    try:
+        # the CLI writes the profile with a UTF-8 BOM
+        with open(profile_file, encoding="utf-8-sig") as f:
+            profile = json.load(f)
+    except (IOError, ValueError):
+        return ""
+    for subscription in profile.get("subscriptions", []):
+        if subscription.get("isDefault"):
+            return subscription.get("id", "")
+    return ""
+
+
+def get_default_subscription_id(backend=default_backend):
+    # The az backend keeps using the default subscription of the CLI, as "az vm image terms" does without
+    # --subscription, and falls back to the Terraform provider variables. The rest backend, used without
+    # the CLI, reads the provider variables first.
+    environment_ids = [os.environ.get(name, "") for name in ["ARM_SUBSCRIPTION_ID", "AZURE_SUBSCRIPTION_ID"]]
+    if backend == "rest":
+        candidates = environment_ids + [get_profile_subscription_id()]
+    else:
+        candidates = [get_profile_subscription_id()] + environment_ids
+    for subscription_id in candidates:
+        if subscription_id:
+            return subscription_id
+    return ""
+
+
+def load_cache(cache_file=default_cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_cache(cache, cache_file=default_cache_file):
+    # Write to a temporary file of its own first so that an interrupted or a concurrent
+    # write never corrupts the cache
+    directory = os.path.dirname(cache_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=directory or ".", prefix=os.path.basename(cache_file) + ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+
+def get_cache_key(subscription_id, urn):
+    return subscription_id + "|" + urn
+
+
+def is_accepted_in_cache(subscription_id, urn, cache_file=default_cache_file, cache_ttl=default_cache_ttl):
+    # Only accepted terms are cached, terms that are not accepted are always checked again
+    if not subscription_id or cache_ttl <= 0:
+        return False
+    entry = load_cache(cache_file).get(get_cache_key(subscription_id, urn))
+    if not entry:
+        return False
+    return entry.get("accepted") is True and time.time() - entry.get("time", 0) < cache_ttl
+
+
+def record_accepted_in_cache(subscription_id, urn, cache_file=default_cache_file):
+    if not subscription_id:
+        return
+    directory = os.path.dirname(cache_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    # batch mode records from several threads, and several terraform runs may share the cache:
+    # serialize the read-modify-write with the lock and a lock file
+    with _cache_lock:
+        with open(cache_file + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            cache = load_cache(cache_file)
+            cache[get_cache_key(subscription_id, urn)] = {"accepted": True, "time": time.time()}
+            save_cache(cache, cache_file)
+
+
+def run_az(arguments, subscription_id="", timeout=default_timeout):
+    # Run the Azure CLI and wait for it, raise on failure or timeout
+    command = ["az"] + arguments
+    if subscription_id:
+        command += ["--subscription", subscription_id]
+    process = subprocess.run(
+        command,
         stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=timeout,
     )
+    if process.returncode != 0:
+        raise RuntimeError(
+            "'" + " ".join(arguments) + "' failed: " + process.stderr.decode("utf-8", "replace")
+        )
+    return json.loads(process.stdout)
+
 
+def accept_license(urn=default_urn, subscription_id="", timeout=default_timeout):
+    # Accept Azure Marketplace image terms so that the image can be used to create VMs
+    return run_az(
+        ["vm", "image", "terms", "accept", "--urn", urn],
+        subscription_id=subscription_id,
+        timeout=timeout,
+    )
 
-def get_license_details():
+
+def get_license_details(urn=default_urn, subscription_id="", timeout=default_timeout):
     # Get the details if Azure Marketplace image terms
-    process = subprocess.Popen(
-        [
-            "az",
-            "vm",
-            "image",
-            "terms",
-            "show",
-            "--urn",
-            "aviatrix-systems:aviatrix-bundle-payg:aviatrix-enterprise-bundle-byol:latest",
-        ],
-        stdout=subprocess.PIPE,
+    return run_az(
+        ["vm", "image", "terms", "show", "--urn", urn],
+        subscription_id=subscription_id,
+        timeout=timeout,
     )
-    out = process.communicate()[0]
-    py_dict = json.loads(out)
-    return py_dict
+
+
+def get_arm_access_token(timeout=default_timeout):
+    # Access token of the REST backend: AZURE_ACCESS_TOKEN as is, or a client credentials
+    # grant of the service principal in ARM_CLIENT_ID, ARM_CLIENT_SECRET and ARM_TENANT_ID
+    # The token is requested once per process and shared by all pairs of a batch.
+    global _access_token
+
+    if os.environ.get("AZURE_ACCESS_TOKEN"):
+        return os.environ["AZURE_ACCESS_TOKEN"]
+    with _token_lock:
+        if _access_token is None:
+            _access_token = request_arm_access_token(timeout=timeout)
+        return _access_token
+
+
+def request_arm_access_token(timeout=default_timeout):
+    for name in ["ARM_CLIENT_ID", "ARM_CLIENT_SECRET", "ARM_TENANT_ID"]:
+        if not os.environ.get(name):
+            raise RuntimeError("The REST backend requires AZURE_ACCESS_TOKEN or " + name)
+    data = urllib.parse.urlencode(
+        {
+            "grant_type": "client_credentials",
+            "client_id": os.environ["ARM_CLIENT_ID"],
+            "client_secret": os.environ["ARM_CLIENT_SECRET"],
+            "scope": arm_endpoint.rstrip("/") + "/.default",
+        }
+    ).encode("utf-8")
+    url = arm_login_endpoint.rstrip("/") + "/" + os.environ["ARM_TENANT_ID"] + "/oauth2/v2.0/token"
+    with urllib.request.urlopen(url, data=data, timeout=timeout) as response:
+        return json.loads(response.read())["access_token"]
+
+
+def get_agreement_url(urn, subscription_id):
+    publisher, offer, plan = urn.split(":")[:3]
+    return (
+        arm_endpoint.rstrip("/")
+        + "/subscriptions/" + subscription_id
+        + "/providers/Microsoft.MarketplaceOrdering/offerTypes/virtualmachine"
+        + "/publishers/" + publisher
+        + "/offers/" + offer
+        + "/plans/" + plan
+        + "/agreements/current?api-version=" + marketplace_api_version
+    )
+
+
+def call_arm(url, token, method="GET", body=None, timeout=default_timeout):
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode("utf-8")
+    request = urllib.request.Request(url, data=data, method=method)
+    request.add_header("Authorization", "Bearer " + token)
+    request.add_header("Content-Type", "application/json")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def get_license_details_rest(urn=default_urn, subscription_id="", token="", timeout=default_timeout):
+    # Same as get_license_details() through the Marketplace agreements REST API
+    agreement = call_arm(get_agreement_url(urn, subscription_id), token, timeout=timeout)
+    details = dict(agreement.get("properties", {}))
+    details["id"] = agreement.get("id")
+    return details
+
+
+def accept_license_rest(urn=default_urn, subscription_id="", token="", timeout=default_timeout):
+    # Same as accept_license() through the Marketplace agreements REST API,
+    # the current agreement is sent back with "accepted" set
+    url = get_agreement_url(urn, subscription_id)
+    agreement = call_arm(url, token, timeout=timeout)
+    agreement.setdefault("properties", {})["accepted"] = True
+    return call_arm(url, token, method="PUT", body=agreement, timeout=timeout)
+
+
+def ensure_license_accepted(
+    urn=default_urn,
+    subscription_id="",
+    backend=default_backend,
+    cache_file=default_cache_file,
+    cache_ttl=default_cache_ttl,
+    timeout=default_timeout,
+):
+    # Make sure the Marketplace terms of the image are accepted.
+    # Returns "cached", "already_accepted" or "accepted".
+    if is_accepted_in_cache(subscription_id, urn, cache_file=cache_file, cache_ttl=cache_ttl):
+        return "cached"
+
+    if backend == "rest":
+        if not subscription_id:
+            raise RuntimeError("The REST backend requires a subscription id")
+        token = get_arm_access_token(timeout=timeout)
+        details = get_license_details_rest(urn, subscription_id, token, timeout=timeout)
+        status = "already_accepted"
+        if not details.get("accepted"):
+            accept_license_rest(urn, subscription_id, token, timeout=timeout)
+            status = "accepted"
+    else:
+        details = get_license_details(urn, subscription_id, timeout=timeout)
+        status = "already_accepted"
+        if not details["accepted"]:
+            accept_license(urn, subscription_id, timeout=timeout)
+            status = "accepted"
+
+    record_accepted_in_cache(subscription_id, urn, cache_file=cache_file)
+    return status
+
+
+def ensure_licenses_accepted(
+    pairs=list(),
+    backend=default_backend,
+    cache_file=default_cache_file,
+    cache_ttl=default_cache_ttl,
+    timeout=default_timeout,
+    max_workers=default_max_workers,
+):
+    # Batch mode of ensure_license_accepted() for a list of (subscription_id, urn) pairs.
+    # The pairs are checked and accepted concurrently by at most max_workers workers.
+    # Returns one status per pair, in the order of the pairs:
+    #   {"subscription_id": ..., "urn": ..., "status": ..., "error": ..., "duration": seconds}
+    # where status is "cached", "already_accepted", "accepted" or "failed".
+    def process_pair(pair):
+        subscription_id, urn = pair
+        start_time = time.monotonic()
+        result = {"subscription_id": subscription_id, "urn": urn, "error": ""}
+        try:
+            result["status"] = ensure_license_accepted(
+                urn=urn,
+                subscription_id=subscription_id,
+                backend=backend,
+                cache_file=cache_file,
+                cache_ttl=cache_ttl,
+                timeout=timeout,
+            )
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = str(e)
+        result["duration"] = round(time.monotonic() - start_time, 3)
+        return result
+
+    if not pairs:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pairs)))) as executor:
+        return list(executor.map(process_pair, pairs))
+
+
+def load_batch_pairs(batch_file):
+    # Read the pairs of a batch from a JSON file ("-" for stdin):
+    #   [{"subscription_id": "...", "urn": "..."}, ...]
+    # an entry without a urn uses the default Aviatrix image
+    if batch_file == "-":
+        entries = json.load(sys.stdin)
+    else:
+        with open(batch_file) as f:
+            entries = json.load(f)
+    return [(entry["subscription_id"], entry.get("urn", default_urn)) for entry in entries]
 
 
 if __name__ == "__main__":
-    details = get_license_details()
-    if not details["accepted"]:
-        accept_license()
+    parser = argparse.ArgumentParser(description="Accept the Azure Marketplace terms of the Aviatrix image")
+    parser.add_argument(
+        "--urn",
+        action="append",
+        help="image URN, can be repeated (default: " + default_urn + ")",
+    )
+    parser.add_argument(
+        "--subscription-id",
+        action="append",
+        help="Azure subscription id, can be repeated; every subscription is paired with every URN",
+    )
+    parser.add_argument(
+        "--batch",
+        help='JSON file ("-" for stdin) with a list of {"subscription_id": ..., "urn": ...} pairs',
+    )
+    parser.add_argument("--backend", default=default_backend, choices=["az", "rest"])
+    parser.add_argument("--cache-file", default=default_cache_file)
+    parser.add_argument("--cache-ttl", type=int, default=default_cache_ttl, help="seconds, 0 disables the cache")
+    parser.add_argument("--timeout", type=int, default=default_timeout, help="seconds per Azure call")
+    parser.add_argument("--max-workers", type=int, default=default_max_workers, help="pairs processed at the same time")
+    args = parser.parse_args()
+
+    if args.batch:
+        pairs = load_batch_pairs(args.batch)
+    else:
+        urns = args.urn or [default_urn]
+        subscription_ids = args.subscription_id or [get_default_subscription_id(args.backend)]
+        pairs = list(itertools.product(subscription_ids, urns))
+
+    results = ensure_licenses_accepted(
+        pairs=pairs,
+        backend=args.backend,
+        cache_file=args.cache_file,
+        cache_ttl=args.cache_ttl,
+        timeout=args.timeout,
+        max_workers=args.max_workers,
+    )
+    for result in results:
+        if result["status"] == "failed":
+            sys.stderr.write(
+                "Failed to accept the Marketplace terms of " + result["urn"]
+                + " in subscription " + result["subscription_id"] + ": " + result["error"] + "\n"
+            )
+    if len(results) == 1 and not args.batch:
+        print(json.dumps(results[0]))
+    else:
+        print(json.dumps(results, indent=2))
+    if any(result["status"] == "failed" for result in results):
+        sys.exit(1)
@@ -0,0 +1,146 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in of the Azure AD token endpoint and the Marketplace agreements REST API
+# used by the "rest" backend of accept_license.py. Point the backend to it with
+#   AVIATRIX_ARM_ENDPOINT=http://127.0.0.1:<port> AVIATRIX_ARM_LOGIN_ENDPOINT=http://127.0.0.1:<port>
+
+
+class MockMarketplaceState(object):
+    # replication_delay: seconds a new service principal is not found yet, like Azure AD replication
+    # tenant_id: the only tenant the token endpoint knows, any tenant when None
+    def __init__(self, client_id="client-id", client_secret="client-secret", replication_delay=0, tenant_id=None):
+        self.lock = threading.Lock()
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.replicated_at = time.monotonic() + replication_delay
+        self.token = "mock-access-token"
+        # agreement id -> accepted
+        self.agreements = dict()
+        self.request_count = 0
+
+
+class MockMarketplaceRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("mock-marketplace: " + format, *args)
+
+    def send_json(self, py_dict, status_code=200):
+        body = json.dumps(py_dict).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length).decode("utf-8")
+
+    def is_authorized(self):
+        return self.headers.get("Authorization") == "Bearer " + self.server.state.token
+
+    def do_POST(self):
+        state = self.server.state
+        form = dict((k, v[0]) for k, v in parse_qs(self.read_body()).items())
+        path = urlparse(self.path).path
+        with state.lock:
+            state.request_count += 1
+        if not path.endswith("/oauth2/v2.0/token"):
+            self.send_json({"error": "not_found"}, status_code=404)
+        elif state.tenant_id is not None and path.split("/")[1] != state.tenant_id:
+            self.send_json(
+                {
+                    "error": "invalid_request",
+                    "error_description": "AADSTS90002: Tenant '" + path.split("/")[1] + "' not found.",
+                },
+                status_code=400,
+            )
+        elif form.get("client_id") != state.client_id or form.get("client_secret") != state.client_secret:
+            self.send_json(
+                {"error": "invalid_client", "error_description": "AADSTS7000215: Invalid client secret provided."},
+                status_code=401,
+            )
+        elif time.monotonic() < state.replicated_at:
+            self.send_json(
+                {
+                    "error": "unauthorized_client",
+                    "error_description": "AADSTS700016: Application with identifier '"
+                    + state.client_id
+                    + "' was not found in the directory.",
+                },
+                status_code=400,
+            )
+        else:
+            self.send_json({"token_type": "Bearer", "expires_in": 3599, "access_token": state.token})
+
+    def do_GET(self):
+        self.handle_agreement(body=None)
+
+    def do_PUT(self):
+        self.handle_agreement(body=json.loads(self.read_body()))
+
+    def handle_agreement(self, body):
+        state = self.server.state
+        path = urlparse(self.path).path
+        with state.lock:
+            state.request_count += 1
+            if not self.is_authorized():
+                py_dict, status_code = {"error": {"code": "AuthenticationFailed"}}, 401
+            elif "/agreements/current" not in path:
+                py_dict, status_code = {"error": {"code": "NotFound"}}, 404
+            else:
+                if body is not None:
+                    state.agreements[path] = body.get("properties", {}).get("accepted") is True
+                parts = path.split("/")
+                py_dict = {
+                    "id": path,
+                    "name": parts[-3],
+                    "type": "Microsoft.MarketplaceOrdering/offertypes",
+                    "properties": {
+                        "publisher": parts[-7],
+                        "product": parts[-5],
+                        "plan": parts[-3],
+                        "accepted": state.agreements.get(path, False),
+                    },
+                }
+                status_code = 200
+        self.send_json(py_dict, status_code=status_code)
+
+
+class MockMarketplaceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, state):
+        HTTPServer.__init__(self, server_address, MockMarketplaceRequestHandler)
+        self.state = state
+
+
+def start_mock_marketplace(
+    host="127.0.0.1",
+    port=0,
+    client_id="client-id",
+    client_secret="client-secret",
+    replication_delay=0,
+    tenant_id=None,
+):
+    # Start the stand-in in a background thread, returns (server, endpoint)
+    server = MockMarketplaceServer(
+        (host, port),
+        MockMarketplaceState(client_id, client_secret, replication_delay=replication_delay, tenant_id=tenant_id),
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://%s:%d" % (host, server.server_address[1])
+
+
+def stop_mock_marketplace(server):
+    server.shutdown()
+    server.server_close()
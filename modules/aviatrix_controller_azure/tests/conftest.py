@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import accept_license  # noqa: E402
+import mock_marketplace  # noqa: E402
+
+# The tests run the "rest" backend of accept_license.py against the local stand-in of
+# mock_marketplace.py, with the cache in the temporary directory of the test.
+
+
+@pytest.fixture
+def marketplace(monkeypatch):
+    # Start the stand-in and point the REST backend to it, stopped after the test
+    server, endpoint = mock_marketplace.start_mock_marketplace()
+    monkeypatch.setattr(accept_license, "arm_endpoint", endpoint)
+    monkeypatch.setattr(accept_license, "arm_login_endpoint", endpoint)
+    monkeypatch.setattr(accept_license, "_access_token", None)
+    monkeypatch.delenv("AZURE_ACCESS_TOKEN", raising=False)
+    monkeypatch.setenv("ARM_CLIENT_ID", "client-id")
+    monkeypatch.setenv("ARM_CLIENT_SECRET", "client-secret")
+    monkeypatch.setenv("ARM_TENANT_ID", "tenant-id")
+    yield server
+    mock_marketplace.stop_mock_marketplace(server)
+
+
+# End def marketplace()
+
+
+@pytest.fixture
+def cache_file(tmp_path):
+    return str(tmp_path / "cache" / "marketplace_terms_cache.json")
+
+
+# End def cache_file()
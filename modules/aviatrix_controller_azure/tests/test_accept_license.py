@@ -0,0 +1,162 @@
+import json
+import multiprocessing
+import subprocess
+import time
+import urllib.error
+
+import pytest
+
+import accept_license
+
+subscription_id = "00000000-0000-0000-0000-000000000000"
+
+
+def test_rest_backend_accepts_terms(marketplace, cache_file):
+    status = accept_license.ensure_license_accepted(
+        subscription_id=subscription_id, backend="rest", cache_file=cache_file
+    )
+    assert status == "accepted"
+    assert list(marketplace.state.agreements.values()) == [True]
+    assert accept_license.is_accepted_in_cache(subscription_id, accept_license.default_urn, cache_file=cache_file)
+
+
+# End def test_rest_backend_accepts_terms()
+
+
+def test_accepted_terms_are_not_accepted_again(marketplace, cache_file):
+    accept_license.ensure_license_accepted(subscription_id=subscription_id, backend="rest", cache_file=cache_file)
+    request_count = marketplace.state.request_count
+    status = accept_license.ensure_license_accepted(
+        subscription_id=subscription_id, backend="rest", cache_file=cache_file, cache_ttl=0
+    )
+    assert status == "already_accepted"
+    assert marketplace.state.request_count == request_count + 1
+
+
+# End def test_accepted_terms_are_not_accepted_again()
+
+
+def test_cached_terms_skip_the_marketplace(marketplace, cache_file):
+    accept_license.ensure_license_accepted(subscription_id=subscription_id, backend="rest", cache_file=cache_file)
+    request_count = marketplace.state.request_count
+    status = accept_license.ensure_license_accepted(
+        subscription_id=subscription_id, backend="rest", cache_file=cache_file
+    )
+    assert status == "cached"
+    assert marketplace.state.request_count == request_count
+
+
+# End def test_cached_terms_skip_the_marketplace()
+
+
+def test_expired_cache_entry_is_checked_again(cache_file):
+    key = accept_license.get_cache_key(subscription_id, accept_license.default_urn)
+    accept_license.save_cache({key: {"accepted": True, "time": time.time() - 100}}, cache_file)
+    assert accept_license.is_accepted_in_cache(subscription_id, accept_license.default_urn, cache_file, cache_ttl=200)
+    assert not accept_license.is_accepted_in_cache(
+        subscription_id, accept_license.default_urn, cache_file, cache_ttl=50
+    )
+
+
+# End def test_expired_cache_entry_is_checked_again()
+
+
+def test_invalid_client_secret_fails(marketplace, cache_file, monkeypatch):
+    monkeypatch.setenv("ARM_CLIENT_SECRET", "wrong-secret")
+    with pytest.raises(urllib.error.HTTPError, match="401"):
+        accept_license.ensure_license_accepted(subscription_id=subscription_id, backend="rest", cache_file=cache_file)
+    assert accept_license.load_cache(cache_file) == {}
+
+
+# End def test_invalid_client_secret_fails()
+
+
+def test_az_backend_accepts_terms(cache_file, monkeypatch):
+    # the Azure CLI is stubbed, the terms are not accepted yet
+    commands = list()
+
+    def run(command, **kwargs):
+        commands.append(command)
+        assert kwargs["timeout"] == accept_license.default_timeout
+        return subprocess.CompletedProcess(command, 0, stdout=json.dumps({"accepted": "accept" in command}).encode())
+
+    monkeypatch.setattr(accept_license.subprocess, "run", run)
+    status = accept_license.ensure_license_accepted(
+        subscription_id=subscription_id, backend="az", cache_file=cache_file
+    )
+    assert status == "accepted"
+    assert [command[:5] for command in commands] == [
+        ["az", "vm", "image", "terms", "show"],
+        ["az", "vm", "image", "terms", "accept"],
+    ]
+    assert all(command[-2:] == ["--subscription", subscription_id] for command in commands)
+    assert accept_license.is_accepted_in_cache(subscription_id, accept_license.default_urn, cache_file=cache_file)
+
+
+# End def test_az_backend_accepts_terms()
+
+
+def test_az_failure_is_raised(cache_file, monkeypatch):
+    def run(command, **kwargs):
+        return subprocess.CompletedProcess(command, 1, stdout=b"", stderr=b"Please run 'az login'")
+
+    monkeypatch.setattr(accept_license.subprocess, "run", run)
+    with pytest.raises(RuntimeError, match="az login"):
+        accept_license.ensure_license_accepted(subscription_id=subscription_id, backend="az", cache_file=cache_file)
+    assert accept_license.load_cache(cache_file) == {}
+
+
+# End def test_az_failure_is_raised()
+
+
+def test_default_subscription_by_backend(tmp_path, monkeypatch):
+    profile_id = "11111111-1111-1111-1111-111111111111"
+    with open(str(tmp_path / "azureProfile.json"), "w", encoding="utf-8-sig") as f:
+        json.dump({"subscriptions": [{"id": "other", "isDefault": False}, {"id": profile_id, "isDefault": True}]}, f)
+    monkeypatch.setenv("AZURE_CONFIG_DIR", str(tmp_path))
+    monkeypatch.setenv("ARM_SUBSCRIPTION_ID", subscription_id)
+    # the az backend keeps the default subscription of the CLI, the rest backend has no CLI
+    assert accept_license.get_default_subscription_id("az") == profile_id
+    assert accept_license.get_default_subscription_id("rest") == subscription_id
+
+    monkeypatch.setenv("AZURE_CONFIG_DIR", str(tmp_path / "missing"))
+    assert accept_license.get_default_subscription_id("az") == subscription_id
+
+
+# End def test_default_subscription_by_backend()
+
+
+def record_urns(cache_file, prefix, count):
+    for i in range(count):
+        accept_license.record_accepted_in_cache(subscription_id, "%s:offer:plan:%d" % (prefix, i), cache_file)
+
+
+# End def record_urns()
+
+
+def test_concurrent_processes_keep_all_cache_entries(cache_file):
+    # several terraform runs accept terms at the same time
+    processes = [
+        multiprocessing.get_context("fork").Process(target=record_urns, args=(cache_file, "publisher%d" % p, 20))
+        for p in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+    with open(cache_file) as f:
+        assert len(json.load(f)) == 80
+
+
+# End def test_concurrent_processes_keep_all_cache_entries()
+
+
+def test_cache_without_fcntl(cache_file, monkeypatch):
+    # Windows has no fcntl, the cache is still written
+    monkeypatch.setattr(accept_license, "fcntl", None)
+    accept_license.record_accepted_in_cache(subscription_id, accept_license.default_urn, cache_file)
+    assert accept_license.is_accepted_in_cache(subscription_id, accept_license.default_urn, cache_file)
+
+
+# End def test_cache_without_fcntl()
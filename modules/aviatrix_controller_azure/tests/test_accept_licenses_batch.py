@@ -0,0 +1,56 @@
+import io
+import json
+
+import accept_license
+
+subscription_ids = ["00000000-0000-0000-0000-00000000000%d" % i for i in range(3)]
+urns = [accept_license.default_urn, "aviatrix-systems:aviatrix-copilot:avx-cplt-byol-01:latest"]
+
+
+def get_pairs():
+    return [(subscription_id, urn) for subscription_id in subscription_ids for urn in urns]
+
+
+# End def get_pairs()
+
+
+def test_batch_accepts_every_pair_with_one_token(marketplace, cache_file):
+    results = accept_license.ensure_licenses_accepted(
+        pairs=get_pairs(), backend="rest", cache_file=cache_file, max_workers=4
+    )
+    assert [(result["subscription_id"], result["urn"]) for result in results] == get_pairs()
+    assert [result["status"] for result in results] == ["accepted"] * 6
+    assert len(marketplace.state.agreements) == 6
+    # one token request, then the check, and the GET and PUT of the acceptance per pair
+    assert marketplace.state.request_count == 1 + 3 * 6
+    assert len(accept_license.load_cache(cache_file)) == 6
+
+    results = accept_license.ensure_licenses_accepted(pairs=get_pairs(), backend="rest", cache_file=cache_file)
+    assert [result["status"] for result in results] == ["cached"] * 6
+
+
+# End def test_batch_accepts_every_pair_with_one_token()
+
+
+def test_failed_pair_does_not_stop_the_batch(marketplace, cache_file):
+    pairs = get_pairs() + [("", accept_license.default_urn)]
+    results = accept_license.ensure_licenses_accepted(pairs=pairs, backend="rest", cache_file=cache_file)
+    assert [result["status"] for result in results[:6]] == ["accepted"] * 6
+    assert results[6]["status"] == "failed"
+    assert "subscription id" in results[6]["error"]
+
+
+# End def test_failed_pair_does_not_stop_the_batch()
+
+
+def test_load_batch_pairs(tmp_path, monkeypatch):
+    entries = [{"subscription_id": subscription_ids[0]}, {"subscription_id": subscription_ids[1], "urn": urns[1]}]
+    batch_file = tmp_path / "batch.json"
+    batch_file.write_text(json.dumps(entries))
+    expected = [(subscription_ids[0], accept_license.default_urn), (subscription_ids[1], urns[1])]
+    assert accept_license.load_batch_pairs(str(batch_file)) == expected
+    monkeypatch.setattr("sys.stdin", io.StringIO(json.dumps(entries)))
+    assert accept_license.load_batch_pairs("-") == expected
+
+
+# End def test_load_batch_pairs()
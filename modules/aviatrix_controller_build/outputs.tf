@@ -40,4 +40,8 @@ output "aviatrix_controller_subnet" {
 
 output "aviatrix_controller_name" {
   value = azurerm_linux_virtual_machine.aviatrix_controller_vm.name
+}
+
+output "aviatrix_controller_virtual_machine_id" {
+  value = azurerm_linux_virtual_machine.aviatrix_controller_vm.virtual_machine_id
 }
\ No newline at end of file
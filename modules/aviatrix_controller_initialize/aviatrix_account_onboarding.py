@@ -0,0 +1,277 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+import urllib3
+
+import aviatrix_controller_init
+from aviatrix_controller_init import AviatrixException, CircuitBreakerOpenException, RetryPolicy
+
+# Bulk onboarding of access accounts onto an initialized controller.
+# Account definitions are read as a stream, one JSON object per line (or a single JSON list):
+#   {"account_name": "azure-1", "cloud_type": "8", "account_email": "...", "arm_subscription_id": "...",
+#    "arm_application_endpoint": "...", "arm_application_client_id": "...",
+#    "arm_application_client_secret": "..."}
+# Every field except account_name is sent to setup_account_profile as is, so any cloud type can be
+# onboarded with its own fields; cloud_type defaults to "8" (Azure ARM).
+# Accounts are created concurrently over one authenticated session, accounts that already exist
+# are skipped, and one JSON result per account is written as soon as the account is done.
+
+# Number of setup_account_profile calls in flight
+default_onboarding_max_workers = int(os.environ.get("AVIATRIX_ONBOARDING_MAX_WORKERS", "8"))
+# Seconds an account waits for a busy controller before it fails: for its circuit breaker to close,
+# or to stop refusing the calls
+default_onboarding_breaker_wait_time = float(os.environ.get("AVIATRIX_ONBOARDING_BREAKER_WAIT_TIME", "600"))
+
+# Fields of an account definition that are never logged
+secret_account_field_pattern = re.compile(r"secret|password|key", re.I)
+
+
+def send_onboarding_api(
+    api_endpoint_url="https://123.123.123.123/v1/api",
+    username="admin",
+    password="********",
+    payload=dict(),
+    breaker_wait_time=default_onboarding_breaker_wait_time,
+):
+    # send_authenticated_aviatrix_api() that waits for a busy controller.
+    # A call rejected by the open circuit breaker of the controller was not sent, it is sent again
+    # when the breaker lets calls through. A call the controller refused, classified as retryable by
+    # RetryPolicy.classify_call(), is sent again after the backoff of the retry policy. Both wait for
+    # at most breaker_wait_time seconds and never past the time budget of the caller, then the last
+    # refusal is returned or raised.
+    deadline = time.monotonic() + breaker_wait_time
+    remaining_time = aviatrix_controller_init.get_remaining_time()
+    if remaining_time is not None:
+        deadline = min(deadline, time.monotonic() + remaining_time)
+    retry_policy = aviatrix_controller_init.get_retry_policy()
+    attempt = 0
+    while True:
+        response = None
+        try:
+            response = aviatrix_controller_init.send_authenticated_aviatrix_api(
+                api_endpoint_url=api_endpoint_url,
+                username=username,
+                password=password,
+                payload=payload,
+            )
+        except CircuitBreakerOpenException:
+            # another call holds the trial call of a half open breaker when the retry time is 0
+            wait_time = max(aviatrix_controller_init.get_circuit_breaker(api_endpoint_url).get_retry_time(), 1)
+            if time.monotonic() + wait_time > deadline:
+                raise
+            logging.info(
+                "Controller is busy, send %s again in %.0f seconds", str(payload.get("action")), wait_time
+            )
+            time.sleep(wait_time)
+            continue
+        except AviatrixException as e:
+            if retry_policy.classify_call("POST", payload, error=e) != RetryPolicy.RETRYABLE:
+                raise
+            error = e
+        else:
+            if retry_policy.classify_call("POST", payload, response=response) != RetryPolicy.RETRYABLE:
+                return response
+
+        wait_time = retry_policy.get_delay(attempt)
+        attempt += 1
+        if time.monotonic() + wait_time > deadline:
+            if response is not None:
+                return response
+            raise error
+        logging.info(
+            "Controller refused %s, send it again in %.2f seconds", str(payload.get("action")), wait_time
+        )
+        time.sleep(wait_time)
+
+
+# End def send_onboarding_api()
+
+
+def list_account_names(
+    api_endpoint_url="https://123.123.123.123/v1/api",
+    username="admin",
+    password="********",
+    breaker_wait_time=default_onboarding_breaker_wait_time,
+):
+    # Names of the access accounts that exist on the controller
+    response = send_onboarding_api(
+        api_endpoint_url=api_endpoint_url,
+        username=username,
+        password=password,
+        payload={"action": "list_accounts"},
+        breaker_wait_time=breaker_wait_time,
+    )
+    if response.return_value is not True:
+        raise AviatrixException(message="Fail to list the access accounts. The response is : " + str(response.py_dict))
+    return set(account["account_name"] for account in response.results.get("account_list", []))
+
+
+# End def list_account_names()
+
+
+def onboard_account(
+    api_endpoint_url="https://123.123.123.123/v1/api",
+    username="admin",
+    password="********",
+    account=dict(),
+    existing_account_names=set(),
+    breaker_wait_time=default_onboarding_breaker_wait_time,
+):
+    # Create one access account, returns its result:
+    #   {"account_name": ..., "cloud_type": ..., "status": "created" | "exists" | "failed", "error": ..., "duration": ...}
+    # A busy controller is waited for, see send_onboarding_api().
+    start_time = time.monotonic()
+    result = {"account_name": "", "cloud_type": "", "status": "created", "error": ""}
+    try:
+        # a line of the stream that is not an object is reported like any other failed account
+        if isinstance(account, aviatrix_controller_init.InvalidRecord):
+            raise account.to_exception()
+        if not isinstance(account, dict):
+            raise AviatrixException(message="The account definition is not a JSON object: " + json.dumps(account))
+        account_name = account.get("account_name", "")
+        cloud_type = str(account.get("cloud_type", "8"))
+        result["account_name"] = account_name
+        result["cloud_type"] = cloud_type
+        if not account_name:
+            raise AviatrixException(message="The account definition has no account_name")
+        if account_name in existing_account_names:
+            result["status"] = "exists"
+            return result
+
+        data = dict(account)
+        data["action"] = "setup_account_profile"
+        data["cloud_type"] = cloud_type
+        logging.info(
+            "Create access account: %s",
+            json.dumps(
+                dict(
+                    (name, "************" if secret_account_field_pattern.search(name) else value)
+                    for name, value in data.items()
+                )
+            ),
+        )
+        response = send_onboarding_api(
+            api_endpoint_url=api_endpoint_url,
+            username=username,
+            password=password,
+            payload=data,
+            breaker_wait_time=breaker_wait_time,
+        )
+        if response.return_value is not True:
+            if response.error_kind() != "already_exists":
+                raise AviatrixException(
+                    message="Fail to create the access account. The response is : " + str(response.py_dict)
+                )
+            result["status"] = "exists"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+    finally:
+        result["duration"] = round(time.monotonic() - start_time, 3)
+    return result
+
+
+# End def onboard_account()
+
+
+def onboard_accounts(
+    api_endpoint_url="https://123.123.123.123/v1/api",
+    username="admin",
+    password="********",
+    accounts=list(),
+    max_workers=default_onboarding_max_workers,
+    on_result=None,
+):
+    # Onboard the accounts of an iterable with at most max_workers calls in flight.
+    # The iterable is consumed as the workers free up, so a stream of any length is processed
+    # in constant memory. on_result is called with each result as soon as it is known.
+    # Returns the number of accounts per status.
+    summary = {"created": 0, "exists": 0, "failed": 0}
+    summary_lock = threading.Lock()
+
+    # one pooled connection per worker, and one login shared by all of them
+    aviatrix_controller_init.configure_aviatrix_session(pool_maxsize=max(max_workers, 1))
+    existing_account_names = list_account_names(
+        api_endpoint_url=api_endpoint_url,
+        username=username,
+        password=password,
+    )
+    logging.info("%d access accounts exist on the controller", len(existing_account_names))
+
+    in_flight = threading.BoundedSemaphore(max_workers)
+
+    def run_one(account):
+        try:
+            result = onboard_account(
+                api_endpoint_url=api_endpoint_url,
+                username=username,
+                password=password,
+                account=account,
+                existing_account_names=existing_account_names,
+            )
+            with summary_lock:
+                summary[result["status"]] += 1
+                if on_result is not None:
+                    on_result(result)
+        finally:
+            in_flight.release()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for account in accounts:
+            in_flight.acquire()
+            executor.submit(run_one, account)
+    return summary
+
+
+# End def onboard_accounts()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Onboard access accounts onto an Aviatrix Controller")
+    parser.add_argument("hostname", help="public ip or hostname of the controller")
+    parser.add_argument("--accounts", default="-", help='JSONL file of account definitions, "-" for stdin')
+    parser.add_argument("--output", default="-", help='JSONL file of the results, "-" for stdout')
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--max-workers", type=int, default=default_onboarding_max_workers)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s aviatrix-azure-function--- %(message)s", level=logging.INFO)
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    # the password is read from the environment so that it does not show up in process listings
+    password = os.environ.get("AVIATRIX_CONTROLLER_PASSWORD", "")
+    if not password:
+        parser.error("AVIATRIX_CONTROLLER_PASSWORD is not set")
+
+    accounts_stream = sys.stdin if args.accounts == "-" else open(args.accounts)
+    output_stream = sys.stdout if args.output == "-" else open(args.output, "a")
+
+    def write_result(result):
+        output_stream.write(json.dumps(result) + "\n")
+        output_stream.flush()
+
+    try:
+        summary = onboard_accounts(
+            api_endpoint_url="https://" + args.hostname + "/v1/api",
+            username=args.username,
+            password=password,
+            accounts=aviatrix_controller_init.read_json_records(accounts_stream),
+            max_workers=args.max_workers,
+            on_result=write_result,
+        )
+    finally:
+        aviatrix_controller_init.close_aviatrix_session()
+        if accounts_stream is not sys.stdin:
+            accounts_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+    logging.info("Onboarding finished: %s", json.dumps(summary))
+    if summary["failed"]:
+        sys.exit(1)
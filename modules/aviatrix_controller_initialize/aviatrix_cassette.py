@@ -0,0 +1,200 @@
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Cassettes of the HTTP exchanges of the shared session: recorded from a controller and replayed
+# instead of talking to one, see RecordingHTTPAdapter and ReplayHTTPAdapter
+
+# Record every HTTP exchange of the shared session to a cassette file, or replay a cassette
+# instead of talking to a controller. Mode "record" or "replay", speed "recorded" or "instant".
+default_cassette_mode = os.environ.get("AVIATRIX_CASSETTE_MODE", "")
+default_cassette_file = os.environ.get("AVIATRIX_CASSETTE_FILE", "aviatrix_cassette.json")
+default_cassette_speed = os.environ.get("AVIATRIX_CASSETTE_SPEED", "recorded")
+
+# Request fields and response keys never written to a cassette: credentials, the CID session
+# tokens and the customer id (license key). Replays send and receive the placeholder instead.
+cassette_redacted_field_pattern = re.compile(r"password|secret|access_token|^CID$|customer_id", re.I)
+cassette_redacted_placeholder = "************"
+# Reasons of the responses of an API server that is not ready yet
+not_ready_reason_pattern = re.compile(r"Valid action required: login|RequestRefused")
+
+
+def get_cassette_key(method, url, fields):
+    # Recorded exchanges are matched on the method, the path and the action, not on the
+    # host or the CID, so a cassette replays against any controller address
+    return [
+        method,
+        urlparse(url).path,
+        fields.get("action", ""),
+        fields.get("subaction", ""),
+        fields.get("username", ""),
+    ]
+
+
+# End def get_cassette_key()
+
+
+def get_request_fields(request):
+    fields = dict(parse_qsl(urlparse(request.url).query))
+    body = request.body
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    if body:
+        fields.update(parse_qsl(body))
+    return fields
+
+
+# End def get_request_fields()
+
+
+def redact_fields(fields):
+    # Redact the matching keys of a dict, and of the dicts and lists nested in it
+    if isinstance(fields, list):
+        return [redact_fields(value) for value in fields]
+    if not isinstance(fields, dict):
+        return fields
+    return dict(
+        (name, cassette_redacted_placeholder if cassette_redacted_field_pattern.search(name) else redact_fields(value))
+        for name, value in fields.items()
+    )
+
+
+# End def redact_fields()
+
+
+class RecordingHTTPAdapter(HTTPAdapter):
+    # HTTPAdapter that records every exchange, with its timing, and writes the cassette
+    # when the session is closed. Secrets are redacted from the requests and responses.
+    # An exchange is marked transient when it only shows that the controller is not ready
+    # yet (connection errors, 5xx, not-ready answers to the readiness probe).
+    def __init__(self, cassette_file=default_cassette_file, **kwargs):
+        super(RecordingHTTPAdapter, self).__init__(**kwargs)
+        self.cassette_file = cassette_file
+        self.start_time = time.monotonic()
+        self.interactions = list()
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        fields = get_request_fields(request)
+        interaction = {
+            "key": get_cassette_key(request.method, request.url, fields),
+            "method": request.method,
+            "url": request.url.split("?")[0],
+            "request": redact_fields(fields),
+            "start": round(time.monotonic() - self.start_time, 6),
+        }
+        start_time = time.monotonic()
+        try:
+            response = super(RecordingHTTPAdapter, self).send(request, **kwargs)
+            body = response.content.decode("utf-8", "replace")
+        except Exception as e:
+            interaction["elapsed"] = round(time.monotonic() - start_time, 6)
+            interaction["error"] = {"type": type(e).__name__, "message": str(e)}
+            interaction["transient"] = True
+            self.add_interaction(interaction)
+            raise
+        interaction["elapsed"] = round(time.monotonic() - start_time, 6)
+        try:
+            py_dict = json.loads(body)
+            if isinstance(py_dict, (dict, list)):
+                body = json.dumps(redact_fields(py_dict))
+        except ValueError:
+            py_dict = None
+        interaction["status_code"] = response.status_code
+        interaction["headers"] = dict(
+            (name, value)
+            for name, value in response.headers.items()
+            if name.lower() in ("content-type", "retry-after")
+        )
+        interaction["body"] = body
+        interaction["transient"] = response.status_code >= 500 or (
+            isinstance(py_dict, dict)
+            and fields.get("username") == "test"
+            and bool(not_ready_reason_pattern.search(str(py_dict.get("reason", ""))))
+        )
+        self.add_interaction(interaction)
+        return response
+
+    def add_interaction(self, interaction):
+        with self.lock:
+            self.interactions.append(interaction)
+
+    def close(self):
+        super(RecordingHTTPAdapter, self).close()
+        with self.lock:
+            interactions = sorted(self.interactions, key=lambda interaction: interaction["start"])
+        cassette = {"version": 1, "recorded_at": time.time(), "interactions": interactions}
+        with open(self.cassette_file + ".tmp", "w") as f:
+            json.dump(cassette, f, indent=2)
+        os.replace(self.cassette_file + ".tmp", self.cassette_file)
+        logging.info("%d HTTP exchanges have been recorded to %s", len(interactions), self.cassette_file)
+
+
+# END class RecordingHTTPAdapter
+
+
+class ReplayHTTPAdapter(BaseAdapter):
+    # Transport that answers from a cassette instead of the network.
+    # Exchanges with the same key are served in the recorded order, the last one is repeated
+    # once they are used up (e.g. progress polls).
+    #   speed "recorded" : every answer takes as long as it did when it was recorded
+    #   speed "instant"  : answers are immediate, and transient exchanges of the wake-up are skipped
+    error_types = {
+        "ConnectTimeout": requests.exceptions.ConnectTimeout,
+        "ReadTimeout": requests.exceptions.ReadTimeout,
+        "Timeout": requests.exceptions.Timeout,
+        "SSLError": requests.exceptions.SSLError,
+    }
+
+    def __init__(self, cassette_file=default_cassette_file, speed=default_cassette_speed):
+        super(ReplayHTTPAdapter, self).__init__()
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.queues = dict()
+        with open(cassette_file) as f:
+            cassette = json.load(f)
+        for interaction in cassette["interactions"]:
+            if speed == "instant" and interaction.get("transient"):
+                continue
+            self.queues.setdefault(json.dumps(interaction["key"]), list()).append(interaction)
+
+    def send(self, request, **kwargs):
+        key = json.dumps(get_cassette_key(request.method, request.url, get_request_fields(request)))
+        with self.lock:
+            queue = self.queues.get(key)
+            if not queue:
+                raise requests.exceptions.ConnectionError(
+                    "No recorded exchange for " + key, request=request
+                )
+            interaction = queue.pop(0) if len(queue) > 1 else queue[0]
+        if self.speed != "instant":
+            time.sleep(interaction["elapsed"])
+
+        if "error" in interaction:
+            error_type = self.error_types.get(interaction["error"]["type"], requests.exceptions.ConnectionError)
+            raise error_type(interaction["error"]["message"], request=request)
+
+        response = requests.models.Response()
+        response.status_code = interaction["status_code"]
+        response.headers = CaseInsensitiveDict(interaction.get("headers", {}))
+        response._content = interaction["body"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(seconds=interaction["elapsed"])
+        return response
+
+    def close(self):
+        pass
+
+
+# END class ReplayHTTPAdapter
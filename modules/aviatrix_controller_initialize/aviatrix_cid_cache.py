@@ -0,0 +1,134 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+# Reuse of the CID sessions of earlier logins, so that a run or a tool does not log in again
+# for every call, see CIDCache
+
+# CIDs of logged in users are kept per controller and user for this many seconds, 0 disables the cache
+default_cid_cache_ttl = float(os.environ.get("AVIATRIX_CID_CACHE_TTL", "3600"))
+# Optional encrypted copy of the CID cache on disk, shared by later runs and tools.
+# Requires the cryptography package and a passphrase in AVIATRIX_CID_CACHE_KEY.
+default_cid_cache_file = os.environ.get("AVIATRIX_CID_CACHE_FILE", "")
+default_cid_cache_key = os.environ.get("AVIATRIX_CID_CACHE_KEY", "")
+
+_cid_cache = None
+_cid_cache_lock = threading.Lock()
+
+
+class CIDCache(object):
+    # CIDs of logged in users, keyed by controller and user.
+    # An entry is only returned for the password it was created with and for ttl seconds,
+    # so a changed password or an old entry never costs a failed call.
+    # With a file and a passphrase the cache is also kept on disk, encrypted with Fernet.
+    # Without the cryptography package the on-disk copy is disabled, it is never written in clear.
+    def __init__(
+        self,
+        ttl=default_cid_cache_ttl,
+        cache_file=default_cid_cache_file,
+        passphrase=default_cid_cache_key,
+    ):
+        self.ttl = ttl
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.cache_file = None
+        self.fernet = None
+        if cache_file and ttl > 0:
+            if Fernet is None:
+                logging.warning("The cryptography package is not installed, the CID cache is not saved to disk")
+            elif not passphrase:
+                logging.warning("AVIATRIX_CID_CACHE_KEY is not set, the CID cache is not saved to disk")
+            else:
+                key = hashlib.pbkdf2_hmac(
+                    "sha256", passphrase.encode("utf-8"), b"aviatrix-cid-cache", 100000
+                )
+                self.fernet = Fernet(base64.urlsafe_b64encode(key))
+                self.cache_file = cache_file
+                self.entries = self.load()
+
+    def get_key(self, api_endpoint_url, username):
+        return api_endpoint_url + "|" + username
+
+    def get_password_hash(self, api_endpoint_url, username, password):
+        data = "|".join([api_endpoint_url, username, password]).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, api_endpoint_url, username, password):
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(self.get_key(api_endpoint_url, username))
+        if entry is None:
+            return None
+        if entry["password_hash"] != self.get_password_hash(api_endpoint_url, username, password):
+            return None
+        if time.time() - entry["time"] >= self.ttl:
+            return None
+        return entry["CID"]
+
+    def put(self, api_endpoint_url, username, password, CID):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[self.get_key(api_endpoint_url, username)] = {
+                "CID": CID,
+                "password_hash": self.get_password_hash(api_endpoint_url, username, password),
+                "time": time.time(),
+            }
+            self.save()
+
+    def invalidate(self, api_endpoint_url, username=None):
+        with self.lock:
+            for key in list(self.entries):
+                if username is None and key.startswith(api_endpoint_url + "|"):
+                    del self.entries[key]
+                elif key == self.get_key(api_endpoint_url, username or ""):
+                    del self.entries[key]
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.cache_file, "rb") as f:
+                entries = json.loads(self.fernet.decrypt(f.read()).decode("utf-8"))
+        except (IOError, ValueError, InvalidToken):
+            return dict()
+        now = time.time()
+        return dict((key, entry) for key, entry in entries.items() if now - entry["time"] < self.ttl)
+
+    def save(self):
+        # called with the lock held
+        if self.cache_file is None:
+            return
+        directory = os.path.dirname(self.cache_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_file = self.cache_file + ".tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.fernet.encrypt(json.dumps(self.entries).encode("utf-8")))
+        os.replace(tmp_file, self.cache_file)
+
+
+# END class CIDCache
+
+
+def get_cid_cache():
+    # The CID cache shared by all runs of this process, built from the environment on first use
+    global _cid_cache
+
+    with _cid_cache_lock:
+        if _cid_cache is None:
+            _cid_cache = CIDCache()
+        return _cid_cache
+
+
+# End def get_cid_cache()
@@ -1,79 +1,1008 @@
+import concurrent.futures
+import contextlib
+import contextvars
+import io
+import ipaddress
 import json
 import logging
+import os
+import random
+import re
+import socket
+import ssl
 import sys
+import threading
 import time
 import traceback
 
 import requests
 
-# The wait time from experience is between 60 to 600 seconds
-default_wait_time_for_apache_wakeup = 300
+from urllib.parse import urlparse
+
+import aviatrix_profiler
+from aviatrix_cassette import (
+    RecordingHTTPAdapter,
+    ReplayHTTPAdapter,
+    cassette_redacted_field_pattern,
+    cassette_redacted_placeholder,
+    default_cassette_file,
+    default_cassette_mode,
+    default_cassette_speed,
+    get_cassette_key,
+    get_request_fields,
+    not_ready_reason_pattern,
+    redact_fields,
+)
+from aviatrix_cid_cache import (
+    CIDCache,
+    default_cid_cache_file,
+    default_cid_cache_key,
+    default_cid_cache_ttl,
+    get_cid_cache,
+)
+from aviatrix_errors import AviatrixException
+from aviatrix_file_lock import locked_file
+from aviatrix_fleet import (
+    InvalidRecord,
+    build_event_from_arguments,
+    complete_event,
+    default_fleet_max_concurrency,
+    function_handler_fleet,
+    function_handler_fleet_async,
+    function_handler_stream,
+    get_initialize_controller,
+    read_events,
+    read_json_records,
+)
+from aviatrix_init_journal import InitJournal, default_journal_dir
+from aviatrix_metrics import (
+    AviatrixMetrics,
+    default_metrics_file,
+    default_metrics_port,
+    get_metrics,
+    merge_histogram,
+    metric_definitions,
+    samples_from_list,
+    samples_to_list,
+    start_metrics_server,
+    write_metrics_file,
+)
+from aviatrix_profiler import (
+    AviatrixProfiler,
+    default_profile_dir,
+    default_profile_memory,
+    get_profile_categories,
+    profile_category_patterns,
+    profile_run,
+    profile_section,
+    profiled,
+)
+from aviatrix_retry import (
+    CircuitBreaker,
+    CircuitBreakerOpenException,
+    RetryPolicy,
+    configure_circuit_breaker,
+    configure_retry_policy,
+    default_circuit_breaker_reset_timeout,
+    default_circuit_breaker_threshold,
+    default_connect_timeout,
+    default_read_timeout,
+    default_retry_base_delay,
+    default_retry_max_attempts,
+    default_retry_max_delay,
+    get_circuit_breaker,
+    get_retry_policy,
+    is_connection_refused,
+    is_transport_error,
+    non_idempotent_api_actions,
+    parse_retry_after,
+)
+from aviatrix_session import (
+    close_aviatrix_session,
+    configure_aviatrix_session,
+    default_http_keep_alive,
+    default_http_pool_connections,
+    default_http_pool_maxsize,
+    get_aviatrix_session,
+    is_replaying_cassette,
+)
+from aviatrix_tracer import (
+    AviatrixTracer,
+    default_trace_file,
+    default_trace_format,
+    end_trace_span,
+    start_trace_span,
+    trace_run,
+    trace_span,
+)
+from aviatrix_wakeup_history import (
+    WakeupHistory,
+    build_probe_schedule,
+    default_wait_time_for_apache_wakeup,
+    default_wakeup_history_file,
+    default_wakeup_history_size,
+    default_wakeup_min_samples,
+    default_wakeup_wait_percentile,
+    get_percentile,
+    get_readiness_plan,
+    get_wakeup_history,
+    record_readiness_duration,
+    wakeup_dense_probe_interval,
+    wakeup_min_wait_time,
+    wakeup_sparse_probe_interval,
+    wakeup_wait_margin,
+)
+
+# "public" calls the controller at its hostname, "race" also at its private ip: the address that
+# gets ready first is used, and the API calls fail over to the other one on connection errors
+default_endpoint_mode = os.environ.get("AVIATRIX_ENDPOINT_MODE", "public")
+
+# Read-only (action, subaction) pairs whose responses are cached for a few seconds per controller and CID.
+# Any other action, except login, invalidates the cached responses of the controller.
+read_only_api_actions = {("initial_setup", "check"), ("list_accounts", None), ("list_version_info", None)}
+non_mutating_api_actions = {"login"}
+default_response_cache_ttl = float(os.environ.get("AVIATRIX_RESPONSE_CACHE_TTL", "30"))
+
+# Track the initial setup upgrade by polling its progress instead of blocking on the "run" request
+default_track_upgrade = os.environ.get("AVIATRIX_TRACK_UPGRADE", "true").lower() != "false"
+# The longest time an upgrade is expected to take
+default_upgrade_timeout = int(os.environ.get("AVIATRIX_UPGRADE_TIMEOUT", "900"))
+
+# Preflight check of the ARM service principal: a client credentials grant against the token
+# endpoint of the tenant. The endpoints can point to a local stub, the check can be disabled.
+default_preflight_arm_check = os.environ.get("AVIATRIX_PREFLIGHT_ARM_CHECK", "true").lower() != "false"
+default_arm_endpoint = os.environ.get("AVIATRIX_ARM_ENDPOINT", "https://management.azure.com")
+default_arm_login_endpoint = os.environ.get("AVIATRIX_ARM_LOGIN_ENDPOINT", "https://login.microsoftonline.com")
+# Errors of a service principal or secret created moments ago that Azure AD has not replicated yet:
+# application not found in the directory, invalid client secret
+arm_replication_error_pattern = re.compile(r"AADSTS(700016|7000215)\b")
+
+# Formats of the inputs checked by the preflight
+email_pattern = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+guid_pattern = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
+tenant_domain_pattern = re.compile(r"^[A-Za-z0-9-]+(\.[A-Za-z0-9-]+)+$")
+access_account_name_pattern = re.compile(r"^[A-Za-z0-9_-]+$")
+customer_id_pattern = re.compile(r"^[A-Za-z0-9._-]+$")
+controller_version_pattern = re.compile(r"^(latest|[0-9][0-9A-Za-z.-]*)$")
+# The numeric part of a version, e.g. 6.5.1000 of "UserConnect-6.5.1000"
+version_number_pattern = re.compile(r"[0-9]+(\.[0-9]+)*")
+
+# Number of initialization steps of one controller that may run at the same time
+default_step_max_workers = int(os.environ.get("AVIATRIX_STEP_MAX_WORKERS", "4"))
+
+# End-to-end time budget of the initialization of one controller in seconds, 0 disables it
+default_init_deadline = float(os.environ.get("AVIATRIX_INIT_DEADLINE", "1800"))
+
+# Reasons of responses to calls made with a CID that is no longer valid
+auth_error_pattern = re.compile(r"CID is invalid|invalid CID|CID.*expired|session.*expired|not logged in", re.I)
+
+# What the "results" of a successful call contain, per action
+api_success_matchers = {
+    "login": re.compile(r"authorized successfully"),
+    "add_admin_email_addr": re.compile(r"admin email address has been successfully added"),
+    "setup_account_profile": re.compile(r"An email confirmation has been sent to"),
+}
+# Kinds of failed calls, by their "reason", in the order they are tried
+api_error_matchers = [
+    ("not_ready", re.compile(r"Valid action required: login|RequestRefused")),
+    ("unsupported_action", re.compile(r"Valid action required")),
+    ("invalid_cid", auth_error_pattern),
+    ("already_exists", re.compile(r"already exists", re.I)),
+    ("not_initialized", re.compile(r"not run")),
+]
+
+_response_cache = dict()
+_response_cache_lock = threading.Lock()
+
+_current_deadline = contextvars.ContextVar("aviatrix_deadline", default=None)
+_current_fleet_run = contextvars.ContextVar("aviatrix_fleet_run", default=False)
+
+_api_endpoints = dict()
+_api_endpoints_lock = threading.Lock()
+
+
+class AviatrixResponse(object):
+    # Response of an API call, decoded once by send_aviatrix_api().
+    #   status_code  : HTTP status code
+    #   return_value : the "return" flag of the body, None if the body is not a JSON object
+    #   results      : the "results" of the body
+    #   reason       : the "reason" of the body
+    #   elapsed      : seconds of the attempt that returned the response
+    #   attempts     : number of attempts of the call
+    #   py_dict      : the whole decoded body
+    __slots__ = (
+        "action",
+        "status_code",
+        "return_value",
+        "results",
+        "reason",
+        "elapsed",
+        "attempts",
+        "py_dict",
+        "headers",
+    )
 
+    def __init__(self, action="", status_code=-1, py_dict=None, headers=None, elapsed=0.0, attempts=1):
+        if not isinstance(py_dict, dict):
+            py_dict = dict()
+        self.action = action
+        self.status_code = status_code
+        self.py_dict = py_dict
+        self.return_value = py_dict.get("return")
+        self.results = py_dict.get("results")
+        self.reason = str(py_dict.get("reason", ""))
+        self.headers = headers or dict()
+        self.elapsed = elapsed
+        self.attempts = attempts
+
+    @classmethod
+    def from_http_response(cls, response, action="", elapsed=None, attempts=1):
+        try:
+            py_dict = response.json()
+        except ValueError:
+            py_dict = None
+        if elapsed is None:
+            elapsed = response.elapsed.total_seconds()
+        return cls(
+            action=action,
+            status_code=response.status_code,
+            py_dict=py_dict,
+            headers=response.headers,
+            elapsed=elapsed,
+            attempts=attempts,
+        )
 
-class AviatrixException(Exception):
-    def __init__(self, message="Aviatrix Error Message: ..."):
-        super(AviatrixException, self).__init__(message)
+    def json(self):
+        return self.py_dict
 
+    def succeeded(self):
+        # 200, "return" is true, and the results match the success matcher of the action
+        if self.status_code != 200 or self.return_value is not True:
+            return False
+        matcher = api_success_matchers.get(self.action)
+        return matcher is None or matcher.search(str(self.results)) is not None
 
-# END class MyException
+    def error_kind(self):
+        # Name of the first error matcher matching the reason of a failed call, or None
+        if self.return_value is not False:
+            return None
+        for kind, matcher in api_error_matchers:
+            if matcher.search(self.reason):
+                return kind
+        return None
+
+    def __repr__(self):
+        return "AviatrixResponse(action=%r, status_code=%d, py_dict=%r)" % (
+            self.action,
+            self.status_code,
+            self.py_dict,
+        )
 
 
-def function_handler(event):
+# END class AviatrixResponse
+
+
+def to_aviatrix_response(response, action=""):
+    # AviatrixResponse of a response, raw responses (e.g. of the probes) are decoded only once
+    if isinstance(response, AviatrixResponse):
+        return response
+    aviatrix_response = getattr(response, "_aviatrix_response", None)
+    if aviatrix_response is None:
+        aviatrix_response = AviatrixResponse.from_http_response(response, action=action)
+        response._aviatrix_response = aviatrix_response
+    return aviatrix_response
+
+
+# End def to_aviatrix_response()
+
+
+def get_response_json(response):
+    # The decoded JSON body of a response, decoded only once
+    if isinstance(response, AviatrixResponse):
+        return response.py_dict
+    py_dict = getattr(response, "_aviatrix_json", None)
+    if py_dict is None:
+        py_dict = response.json()
+        response._aviatrix_json = py_dict
+    return py_dict
+
+
+# End def get_response_json()
+
+
+def get_response_cache_key(api_endpoint_url="https://123.123.123.123/v1/api", payload=dict()):
+    # Only read-only actions are cached, the key is scoped to the controller and the CID
+    action = payload.get("action")
+    subaction = payload.get("subaction")
+    if (action, subaction) not in read_only_api_actions:
+        return None
+    return (api_endpoint_url, payload.get("CID"), action, subaction)
+
+
+# End def get_response_cache_key()
+
+
+def get_cached_response(cache_key):
+    with _response_cache_lock:
+        cache_entry = _response_cache.get(cache_key)
+        if cache_entry is None:
+            return None
+        expire_time, response = cache_entry
+        if time.monotonic() >= expire_time:
+            del _response_cache[cache_key]
+            return None
+    logging.info("Serve %s from the response cache", str(cache_key[2:]))
+    return response
+
+
+# End def get_cached_response()
+
+
+def put_cached_response(cache_key, response, ttl=default_response_cache_ttl):
+    if ttl <= 0:
+        return
+    with _response_cache_lock:
+        _response_cache[cache_key] = (time.monotonic() + ttl, response)
+
+
+# End def put_cached_response()
+
+
+def invalidate_response_cache(api_endpoint_url=None):
+    # Drop the cached responses of one controller, or of all controllers
+    with _response_cache_lock:
+        if api_endpoint_url is None:
+            _response_cache.clear()
+            return
+        for cache_key in list(_response_cache):
+            if cache_key[0] == api_endpoint_url:
+                del _response_cache[cache_key]
+
+
+# End def invalidate_response_cache()
+
+
+class ApiEndpoints(object):
+    # The addresses the API of one controller can be reached at, e.g. its public and private ip.
+    # Calls go to the pinned address; a connection error pins the next address.
+    def __init__(self, urls=list()):
+        self.urls = list(urls)
+        self.pinned_url = self.urls[0]
+        self.lock = threading.Lock()
+
+    def get_url(self):
+        with self.lock:
+            return self.pinned_url
+
+    def pin(self, url):
+        with self.lock:
+            self.pinned_url = url
+
+    def failover(self, failed_url):
+        # Pin the address after failed_url, returns it, or None when there is no other address
+        with self.lock:
+            if len(self.urls) < 2:
+                return None
+            if self.pinned_url == failed_url:
+                self.pinned_url = self.urls[(self.urls.index(failed_url) + 1) % len(self.urls)]
+            return self.pinned_url
+
+
+# END class ApiEndpoints
+
+
+def configure_api_endpoints(api_endpoint_url="https://123.123.123.123/v1/api", endpoint_urls=None):
+    # Call the controller of api_endpoint_url at endpoint_urls, the first one is pinned.
+    # api_endpoint_url stays the key of the CID cache, the response cache and the circuit breaker.
+    # None calls the controller at api_endpoint_url only.
+    with _api_endpoints_lock:
+        if endpoint_urls:
+            _api_endpoints[api_endpoint_url] = ApiEndpoints(endpoint_urls)
+        else:
+            _api_endpoints.pop(api_endpoint_url, None)
+
+
+# End def configure_api_endpoints()
+
+
+def get_api_endpoints(api_endpoint_url="https://123.123.123.123/v1/api"):
+    with _api_endpoints_lock:
+        return _api_endpoints.get(api_endpoint_url)
+
+
+# End def get_api_endpoints()
+
+
+def resolve_api_endpoint(api_endpoint_url="https://123.123.123.123/v1/api"):
+    # The url the controller of api_endpoint_url is called at
+    api_endpoints = get_api_endpoints(api_endpoint_url)
+    if api_endpoints is None:
+        return api_endpoint_url
+    return api_endpoints.get_url()
+
+
+# End def resolve_api_endpoint()
+
+
+def failover_api_endpoint(api_endpoint_url="https://123.123.123.123/v1/api", failed_url=None):
+    # Pin the next address of the controller of api_endpoint_url after a connection error at
+    # failed_url, returns the url to call, or None when the controller has a single address
+    api_endpoints = get_api_endpoints(api_endpoint_url)
+    if api_endpoints is None:
+        return None
+    return api_endpoints.failover(failed_url)
+
+
+# End def failover_api_endpoint()
+
+
+def get_endpoint_hostnames(event):
+    # The addresses of the controller of an event. In "race" mode (event["endpoint_mode"] or
+    # AVIATRIX_ENDPOINT_MODE) the private ip is added, with the port of the hostname if any.
     hostname = event["hostname"]
-    aviatrix_api_version = event["aviatrix_api_version"]
-    aviatrix_api_route = event["aviatrix_api_route"]
-    ucc_private_ip = event["ucc_private_ip"]
-    admin_email = event["admin_email"]
-    new_admin_password = event["new_admin_password"]
-    arm_subscription_id = event["arm_subscription_id"]
-    arm_application_client_id = event["arm_application_client_id"]
-    arm_application_client_secret = event["arm_application_client_secret"]
-    directory_tenant_id = event["directory_tenant_id"]
-    account_email = event["account_email"]
-    access_account_name = event["access_account_name"]
-    aviatrix_customer_id = event["aviatrix_customer_id"]
-    controller_init_version = event["controller_init_version"]
-    wait_time = default_wait_time_for_apache_wakeup
-
-    # Reconstruct some parameters
-    aviatrix_customer_id = aviatrix_customer_id.rstrip()
-    aviatrix_customer_id = aviatrix_customer_id.lstrip()
-    api_endpoint_url = (
-        "https://" + hostname + "/" + aviatrix_api_version + "/" + aviatrix_api_route
+    if event.get("endpoint_mode", default_endpoint_mode) != "race":
+        return [hostname]
+    private_hostname = event["ucc_private_ip"]
+    port = urlparse("https://" + hostname).port
+    if port is not None:
+        private_hostname += ":" + str(port)
+    if private_hostname == hostname:
+        return [hostname]
+    return [hostname, private_hostname]
+
+
+# End def get_endpoint_hostnames()
+
+
+def wait_until_any_controller_endpoint_is_ready(
+    hostnames=["123.123.123.123"],
+    api_version="v1",
+    api_route="api",
+    total_wait_time=300,
+    interval_wait_time=2,
+    abort_event=None,
+    probe_schedule=None,
+    waited=None,
+):
+    # Wait until the API server is ready at one of the addresses of the controller.
+    # The addresses are probed at the same time, the first one to be ready is pinned for the
+    # API calls of the controller and the others stop waiting. Raises the error of the first
+    # address when none of them gets ready. waited is set when the first address to be ready
+    # was not ready at its first probe.
+    if len(hostnames) == 1:
+        return wait_until_controller_api_server_is_ready(
+            hostname=hostnames[0],
+            api_version=api_version,
+            api_route=api_route,
+            total_wait_time=total_wait_time,
+            interval_wait_time=interval_wait_time,
+            abort_event=abort_event,
+            probe_schedule=probe_schedule,
+            waited=waited,
+        )
+
+    endpoint_urls = ["https://" + hostname + "/" + api_version + "/" + api_route for hostname in hostnames]
+    race_over = threading.Event()
+    waited_at = dict((hostname, threading.Event()) for hostname in hostnames)
+    errors = dict()
+    winner = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(hostnames)) as executor:
+        futures = dict(
+            (
+                executor.submit(
+                    contextvars.copy_context().run,
+                    wait_until_controller_api_server_is_ready,
+                    hostname=hostname,
+                    api_version=api_version,
+                    api_route=api_route,
+                    total_wait_time=total_wait_time,
+                    interval_wait_time=interval_wait_time,
+                    abort_event=race_over,
+                    probe_schedule=probe_schedule,
+                    waited=waited_at[hostname],
+                ),
+                hostname,
+            )
+            for hostname in hostnames
+        )
+        pending = set(futures)
+        while pending and winner is None:
+            finished, pending = concurrent.futures.wait(
+                pending, timeout=0.2, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[futures[future]] = e
+                else:
+                    if winner is None:
+                        winner = futures[future]
+            if abort_event is not None and abort_event.is_set():
+                break
+        race_over.set()
+
+    if winner is None:
+        if abort_event is not None and abort_event.is_set():
+            raise AviatrixException(message="Wait for Aviatrix Controller " + hostnames[0] + " aborted")
+        raise errors.get(hostnames[0]) or list(errors.values())[0]
+
+    logging.info("Aviatrix Controller is ready at %s, the API is called there", winner)
+    if waited is not None and waited_at[winner].is_set():
+        waited.set()
+    api_endpoints = get_api_endpoints(endpoint_urls[0])
+    if api_endpoints is not None:
+        api_endpoints.pin(endpoint_urls[hostnames.index(winner)])
+    get_circuit_breaker(endpoint_urls[0]).record_success()
+    return True
+
+
+# End def wait_until_any_controller_endpoint_is_ready()
+
+
+def get_remaining_time():
+    # Seconds left of the time budget of the current initialization, None without a deadline
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+# End def get_remaining_time()
+
+
+@contextlib.contextmanager
+def time_budget(seconds=default_init_deadline):
+    # Bound the enclosed block by a time budget of seconds, 0 disables it
+    if seconds <= 0:
+        yield
+        return
+    token = _current_deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+
+# End def time_budget()
+
+
+def function_handler(event):
+    # Initialize one Aviatrix Controller.
+    # The whole initialization is bounded by event["deadline"] seconds (AVIATRIX_INIT_DEADLINE):
+    # waits, retries and request timeouts never run past it.
+    # The duration of the run is added to the metrics, which are written to the metrics
+    # file (event["metrics_file"] or AVIATRIX_METRICS_FILE) at the end of every run.
+    start_time = time.monotonic()
+    outcome = "failure"
+    try:
+        with time_budget(float(event.get("deadline", default_init_deadline))), profile_run(event):
+            result = run_traced_controller_initialization(event)
+        outcome = "success"
+        return result
+    finally:
+        get_metrics().observe("aviatrix_init_duration_seconds", time.monotonic() - start_time, outcome=outcome)
+        write_metrics_file(event.get("metrics_file", default_metrics_file))
+
+
+# End def function_handler()
+
+
+def run_traced_controller_initialization(event):
+    # run_controller_initialization() within the timeline of the run, see trace_run()
+    with trace_run(event, fleet_run=_current_fleet_run.get()):
+        return run_controller_initialization(event)
+
+
+# End def run_traced_controller_initialization()
+
+
+class InitStep(object):
+    # One step of the controller initialization.
+    #   number     : step number, also the key of the step in the journal
+    #   name       : short description used in logs and trace spans
+    #   run        : function(context) doing the work of the step
+    #   depends_on : numbers of the steps that must be completed before this one starts
+    #   journaled  : completed steps are recorded in the journal and skipped when resuming
+    #   always_run : run the step even if the journal records it as completed
+    def __init__(self, number, name, run, depends_on=(), journaled=True, always_run=False):
+        self.number = number
+        self.name = name
+        self.run = run
+        self.depends_on = tuple(depends_on)
+        self.journaled = journaled
+        self.always_run = always_run
+
+
+# END class InitStep
+
+
+def build_init_steps():
+    # The initialization flow as steps with explicit dependencies.
+    # Steps whose dependencies are completed run concurrently, e.g. the preflight runs
+    # during the readiness wait and gates the first state changing step, and the customer id and the access account are set
+    # up at the same time after the re-login.
+    # Additional post-init steps can be appended, depending on step 9 (re-login).
+    return [
+        InitStep(0, "preflight", step_preflight, journaled=False),
+        InitStep(1, "wait until API server is ready", step_wait_until_api_server_is_ready),
+        InitStep(2, "login with private ip", step_login_with_private_ip, depends_on=[1]),
+        InitStep(3, "check if initialized", step_check_if_initialized, depends_on=[0, 2]),
+        InitStep(4, "set admin email", step_set_admin_email, depends_on=[3]),
+        InitStep(5, "set admin password", step_set_admin_password, depends_on=[4]),
+        InitStep(6, "login with new password", step_login_with_new_password, depends_on=[5]),
+        InitStep(7, "initial setup", step_initial_setup, depends_on=[6]),
+        InitStep(
+            8,
+            "wait until API server is ready after initial setup",
+            step_wait_until_api_server_is_ready_after_initial_setup,
+            depends_on=[7],
+        ),
+        InitStep(9, "re-login", step_relogin, depends_on=[8], always_run=True),
+        InitStep(10, "set customer id", step_set_customer_id, depends_on=[9]),
+        InitStep(11, "create access account", step_create_access_account, depends_on=[9]),
+    ]
+
+
+# End def build_init_steps()
+
+
+def run_init_steps(steps=list(), context=dict(), journal=None, max_workers=default_step_max_workers):
+    # Run the steps as soon as all their dependencies are completed, at most max_workers
+    # steps at the same time. Steps completed in the journal are skipped.
+    # When a step fails no new step is started, the running steps are asked to stop
+    # (context["abort"]) and waited for, and the first error is raised.
+    if journal is None:
+        journal = InitJournal()
+    completed = set()
+    pending = list()
+    for step in steps:
+        if step.journaled and not step.always_run and journal.is_completed(step.number):
+            completed.add(step.number)
+        else:
+            pending.append(step)
+
+    error = None
+    running = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if error is None:
+                for step in list(pending):
+                    if all(number in completed for number in step.depends_on):
+                        pending.remove(step)
+                        future = executor.submit(
+                            contextvars.copy_context().run,
+                            run_init_step,
+                            step,
+                            context,
+                            journal,
+                        )
+                        running[future] = step
+            if not running:
+                break
+
+            finished, not_finished = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    future.result()
+                    completed.add(step.number)
+                except Exception as e:
+                    if error is None:
+                        error = e
+                        if "abort" in context:
+                            context["abort"].set()
+        # END while loop
+
+    if error is not None:
+        raise error
+    if pending:
+        err_msg = "ERROR: Steps with unresolvable dependencies: " + str(
+            [step.number for step in pending]
+        )
+        raise AviatrixException(message=err_msg)
+
+
+# End def run_init_steps()
+
+
+def run_init_step(step, context, journal):
+    with trace_span("Step%d. %s" % (step.number, step.name), step=step.number):
+        with profile_section("step%d %s" % (step.number, step.name), cprofile=True):
+            step.run(context)
+    if step.journaled and not journal.is_completed(step.number):
+        journal.record(step.number, step.name)
+
+
+# End def run_init_step()
+
+
+def build_init_context(event):
+    # The state shared by the steps of one initialization run
+    context = dict(event)
+    context["aviatrix_customer_id"] = event["aviatrix_customer_id"].strip()
+    context["api_endpoint_url"] = (
+        "https://"
+        + event["hostname"]
+        + "/"
+        + event["aviatrix_api_version"]
+        + "/"
+        + event["aviatrix_api_route"]
+    )
+    context["endpoint_hostnames"] = get_endpoint_hostnames(event)
+    configure_api_endpoints(
+        context["api_endpoint_url"],
+        [
+            "https://" + hostname + "/" + event["aviatrix_api_version"] + "/" + event["aviatrix_api_route"]
+            for hostname in context["endpoint_hostnames"]
+        ],
+    )
+    context["wakeup_plan"] = get_readiness_plan(context, "wakeup")
+    context["restart_plan"] = get_readiness_plan(context, "restart")
+    context["upgrade_plan"] = get_readiness_plan(context, "upgrade", default_wait_time=default_upgrade_timeout)
+    context["CID"] = None
+    context["cid_lock"] = threading.Lock()
+    context["journal"] = InitJournal()
+    context["abort"] = threading.Event()
+    return context
+
+
+# End def build_init_context()
+
+
+def get_step_cid(context):
+    # The login step of a resumed run may have been skipped, login again with
+    # the password that is valid at this point of the flow. The journal may lag behind
+    # the controller (the password was changed but the run stopped before recording it),
+    # so a rejected password is followed by the other one.
+    with context["cid_lock"]:
+        if context["CID"] is not None:
+            return context["CID"]
+        passwords = [context["ucc_private_ip"], context["new_admin_password"]]
+        if context["journal"].is_completed(5):
+            passwords.reverse()
+        logging.info("START: Login Aviatrix Controller to resume initialization")
+        for i, password in enumerate(passwords):
+            try:
+                context["CID"] = get_session_cid(
+                    api_endpoint_url=context["api_endpoint_url"],
+                    username="admin",
+                    password=password,
+                    validate=True,
+                )
+                break
+            except AviatrixException as e:
+                if i + 1 == len(passwords) or is_transport_error(e):
+                    raise
+                logging.info("Login failed, try the other admin password: %s", str(e))
+        logging.info("END: Login Aviatrix Controller to resume initialization")
+        return context["CID"]
+
+
+# End def get_step_cid()
+
+
+def run_controller_initialization(event):
+    context = build_init_context(event)
+
+    # Steps recorded in the journal by a previous failed run are skipped
+    journal = InitJournal(
+        journal_dir=event.get("journal_dir", default_journal_dir),
+        hostname=event["hostname"],
+        ucc_private_ip=event["ucc_private_ip"],
+        instance_id=event.get("instance_id", ""),
+    )
+    context["journal"] = journal
+    run_init_steps(steps=build_init_steps(), context=context, journal=journal)
+    journal.clear()
+
+
+# End def run_controller_initialization()
+
+
+def step_preflight(context):
+    # Step0. Validate the inputs and the ARM credentials before any state changing call.
+    # Runs during the readiness wait, a failure aborts the wait.
+    logging.info("START: Preflight")
+    validate_inputs(context)
+    if context.get("preflight_arm_check", default_preflight_arm_check):
+        check_arm_credentials(
+            tenant_id=context["directory_tenant_id"],
+            client_id=context["arm_application_client_id"],
+            client_secret=context["arm_application_client_secret"],
+            arm_endpoint=context.get("arm_endpoint", default_arm_endpoint),
+            arm_login_endpoint=context.get("arm_login_endpoint", default_arm_login_endpoint),
+            replication_wait_time=context["wakeup_plan"]["wait_time"],
+            abort_event=context.get("abort"),
+        )
+    logging.info("END: Preflight")
+
+
+# End def step_preflight()
+
+
+def validate_inputs(context):
+    # Raise AviatrixException listing every missing or malformed input
+    required_keys = [
+        "hostname",
+        "ucc_private_ip",
+        "admin_email",
+        "new_admin_password",
+        "arm_subscription_id",
+        "arm_application_client_id",
+        "arm_application_client_secret",
+        "directory_tenant_id",
+        "account_email",
+        "access_account_name",
+        "controller_init_version",
+    ]
+    missing_keys = [key for key in required_keys if not str(context.get(key, "")).strip()]
+    if missing_keys:
+        err_msg = "ERROR: Missing required inputs: " + ", ".join(missing_keys)
+        logging.error(err_msg)
+        raise AviatrixException(message=err_msg)
+
+    errors = list()
+    try:
+        ipaddress.ip_address(context["ucc_private_ip"])
+    except ValueError:
+        errors.append("ucc_private_ip is not an ip address")
+    for key in ["admin_email", "account_email"]:
+        if not email_pattern.match(context[key]):
+            errors.append(key + " is not an email address")
+    for key in ["arm_subscription_id", "arm_application_client_id"]:
+        if not guid_pattern.match(context[key]):
+            errors.append(key + " is not a GUID")
+    if not guid_pattern.match(context["directory_tenant_id"]) and not tenant_domain_pattern.match(
+        context["directory_tenant_id"]
+    ):
+        errors.append("directory_tenant_id is neither a GUID nor a domain name")
+    if not access_account_name_pattern.match(context["access_account_name"]):
+        errors.append("access_account_name may only contain letters, digits, '-' and '_'")
+    customer_id = str(context.get("aviatrix_customer_id", "")).strip()
+    if customer_id and not customer_id_pattern.match(customer_id):
+        errors.append("aviatrix_customer_id contains invalid characters")
+    if not controller_version_pattern.match(context["controller_init_version"]):
+        errors.append("controller_init_version is neither \"latest\" nor a version number")
+    if errors:
+        err_msg = "ERROR: Invalid inputs: " + "; ".join(errors)
+        logging.error(err_msg)
+        raise AviatrixException(message=err_msg)
+
+
+# End def validate_inputs()
+
+
+def check_arm_credentials(
+    tenant_id="4780055e-ce37-4f02-b33d-fdad8493a4b6",
+    client_id="wfwek98f-c904-479f-def2-23ijrodsof",
+    client_secret="abcd1234xyz",
+    arm_endpoint=default_arm_endpoint,
+    arm_login_endpoint=default_arm_login_endpoint,
+    timeout=(10, 30),
+    replication_wait_time=0,
+    abort_event=None,
+):
+    # Request an ARM token for the service principal of the access account.
+    # Rejected credentials raise AviatrixException; an unreachable token endpoint is not
+    # a proof of bad credentials, it is logged and the check is skipped.
+    # The service principal and its secret are usually created by the same apply: the errors
+    # of a service principal Azure AD has not replicated yet are retried for replication_wait_time
+    # seconds (the readiness wait), then logged and left to the creation of the access account.
+    url = arm_login_endpoint.rstrip("/") + "/" + tenant_id + "/oauth2/v2.0/token"
+    data = {
+        "grant_type": "client_credentials",
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "scope": arm_endpoint.rstrip("/") + "/.default",
+    }
+    deadline = time.monotonic() + replication_wait_time
+    attempt = 0
+    while True:
+        try:
+            response = get_aviatrix_session().post(url=url, data=data, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            logging.warning("Skip the check of the ARM credentials, %s is not reachable: %s", url, str(e))
+            return False
+
+        if response.status_code == 200:
+            logging.info("ARM credentials of %s are valid", client_id)
+            return True
+        try:
+            py_dict = get_response_json(response)
+        except ValueError:
+            py_dict = dict()
+        error_description = str(py_dict.get("error_description") or py_dict.get("error") or response.status_code)
+        if response.status_code not in (400, 401, 403) or not arm_replication_error_pattern.search(
+            error_description
+        ):
+            break
+
+        wait_time_before_retry = min(15, 2 * pow(2, min(attempt, 4)))
+        attempt += 1
+        remaining_time = get_remaining_time()
+        if remaining_time is not None:
+            wait_time_before_retry = min(wait_time_before_retry, remaining_time)
+        if time.monotonic() + wait_time_before_retry > deadline or wait_time_before_retry <= 0:
+            logging.warning(
+                "The ARM credentials of %s are still rejected by %s, it may not be replicated in Azure AD yet, "
+                + "the creation of the access account will tell: %s",
+                client_id,
+                url,
+                error_description,
+            )
+            return False
+        logging.info(
+            "The ARM credentials of %s are rejected by %s, retry in %.0f seconds for the Azure AD replication: %s",
+            client_id,
+            url,
+            wait_time_before_retry,
+            error_description,
+        )
+        if abort_event is None:
+            time.sleep(wait_time_before_retry)
+        elif abort_event.wait(timeout=wait_time_before_retry):
+            return False
+    # END while loop
+
+    if response.status_code in (400, 401, 403):
+        err_msg = (
+            "ERROR: The ARM credentials of the access account are rejected by "
+            + url
+            + ": "
+            + error_description
+        )
+        logging.error(err_msg)
+        raise AviatrixException(message=err_msg)
+    logging.warning(
+        "Skip the check of the ARM credentials, %s returned status code %d", url, response.status_code
     )
+    return False
+
 
+# End def check_arm_credentials()
+
+
+def step_wait_until_api_server_is_ready(context):
     # Step1. Wait until the rest API service of Aviatrix Controller is up and running
     logging.info(
         "START: Wait until API server of Aviatrix Controller is up and running"
     )
 
-    wait_until_controller_api_server_is_ready(
-        hostname=hostname,
-        api_version=aviatrix_api_version,
-        api_route=aviatrix_api_route,
-        total_wait_time=wait_time,
-        interval_wait_time=10,
-    )
+    wait_for_controller_readiness(context, "wakeup", abort_event=context.get("abort"))
     logging.info("ENDED: Wait until API server of controller is up and running")
 
+
+# End def step_wait_until_api_server_is_ready()
+
+
+def step_login_with_private_ip(context):
     # Step2. Login Aviatrix Controller with username: Admin and password: private ip address and verify login
     logging.info("START: Login Aviatrix Controller as admin using private ip address")
     response = login(
-        api_endpoint_url=api_endpoint_url,
+        api_endpoint_url=context["api_endpoint_url"],
         username="admin",
-        password=ucc_private_ip,
+        password=context["ucc_private_ip"],
         hide_password=False,
     )
 
     verify_aviatrix_api_response_login(response=response)
-    CID = response.json()["CID"]
+    context["CID"] = get_response_json(response)["CID"]
+    get_cid_cache().put(context["api_endpoint_url"], "admin", context["ucc_private_ip"], context["CID"])
     logging.info("END: Login Aviatrix Controller as admin using private ip address")
 
+
+# End def step_login_with_private_ip()
+
+
+def step_check_if_initialized(context):
     # Step3. Check if the controller has been initialized or not
     logging.info("START: Check if Aviatrix Controller has already been initialized")
     is_controller_initialized = has_controller_initialized(
-        api_endpoint_url=api_endpoint_url,
-        CID=CID,
+        api_endpoint_url=context["api_endpoint_url"],
+        CID=get_step_cid(context),
     )
 
     if is_controller_initialized:
@@ -81,227 +1010,436 @@ def function_handler(event):
         logging.error(err_msg)
         raise AviatrixException(message=err_msg)
 
+    # the initial setup of step 7 does not need to check again: setting the admin email and
+    # password does not run it, and the CID of the check is gone after the password change
+    context["initial_setup_pending"] = True
     logging.info("END: Check if Aviatrix Controller has already been initialized")
 
+
+# End def step_check_if_initialized()
+
+
+def step_set_admin_email(context):
     # Step4. Set admin email
     logging.info("Start: Set admin email")
     response = set_admin_email(
-        api_endpoint_url=api_endpoint_url,
-        CID=CID,
-        admin_email=admin_email,
+        api_endpoint_url=context["api_endpoint_url"],
+        CID=get_step_cid(context),
+        admin_email=context["admin_email"],
     )
 
     verify_aviatrix_api_set_admin_email(response=response)
     logging.info("End: Set admin email")
 
+
+# End def step_set_admin_email()
+
+
+def step_set_admin_password(context):
     # Step5. set admin password
     logging.info("Start: Set admin password")
     response = set_admin_password(
-        api_endpoint_url=api_endpoint_url,
-        CID=CID,
-        old_admin_password=ucc_private_ip,
-        new_admin_password=new_admin_password,
+        api_endpoint_url=context["api_endpoint_url"],
+        CID=get_step_cid(context),
+        old_admin_password=context["ucc_private_ip"],
+        new_admin_password=context["new_admin_password"],
     )
 
     verify_aviatrix_api_set_admin_password(response=response)
     logging.info("End: Set admin password")
 
+
+# End def step_set_admin_password()
+
+
+def step_login_with_new_password(context):
     # Step6. Login Aviatrix Controller as admin with new password
     logging.info("Start: Login in as admin with new password")
     response = login(
-        api_endpoint_url=api_endpoint_url,
+        api_endpoint_url=context["api_endpoint_url"],
         username="admin",
-        password=new_admin_password,
+        password=context["new_admin_password"],
     )
 
-    CID = response.json()["CID"]
+    context["CID"] = get_response_json(response)["CID"]
     verify_aviatrix_api_set_admin_password(response=response)
+    get_cid_cache().put(context["api_endpoint_url"], "admin", context["new_admin_password"], context["CID"])
     logging.info("End: Login as admin with new password")
 
+
+# End def step_login_with_new_password()
+
+
+def step_initial_setup(context):
     # Step7. Initial Setup for Aviatrix Controller by Invoking Aviatrix API
     logging.info("Start: Aviatrix Controller initial setup")
     response = run_initial_setup(
-        api_endpoint_url=api_endpoint_url,
-        CID=CID,
-        target_version=controller_init_version,
+        api_endpoint_url=context["api_endpoint_url"],
+        CID=get_step_cid(context),
+        target_version=context["controller_init_version"],
+        check_first=not context.get("initial_setup_pending", False),
+        upgrade_timeout=context["upgrade_plan"]["wait_time"],
+        poll_schedule=context["upgrade_plan"]["probe_schedule"],
+        on_upgrade_duration=lambda duration: record_readiness_duration(context, "upgrade", duration),
     )
     verify_aviatrix_api_run_initial_setup(response=response)
     logging.info("End: Aviatrix Controller initial setup")
 
+
+# End def step_initial_setup()
+
+
+def step_wait_until_api_server_is_ready_after_initial_setup(context):
     # Step8. Wait until apache server of controller is up and running after initial setup
     logging.info(
         "START: Wait until API server of Aviatrix Controller is up and running after initial setup"
     )
-    wait_until_controller_api_server_is_ready(
-        hostname=hostname,
-        api_version=aviatrix_api_version,
-        api_route=aviatrix_api_route,
-        total_wait_time=wait_time,
-        interval_wait_time=10,
-    )
+    wait_for_controller_readiness(context, "restart")
     logging.info(
         "End: Wait until API server of Aviatrix Controller is up ans running after initial setup"
     )
 
+
+# End def step_wait_until_api_server_is_ready_after_initial_setup()
+
+
+def step_relogin(context):
     # Step9. Re-login
+    # the CID of a resumed run is always refreshed here, as the upgrade invalidates older CIDs
     logging.info("START: Re-login")
     response = login(
-        api_endpoint_url=api_endpoint_url,
+        api_endpoint_url=context["api_endpoint_url"],
         username="admin",
-        password=new_admin_password,
+        password=context["new_admin_password"],
     )
     verify_aviatrix_api_response_login(response=response)
-    CID = response.json()["CID"]
+    context["CID"] = get_response_json(response)["CID"]
+    get_cid_cache().put(context["api_endpoint_url"], "admin", context["new_admin_password"], context["CID"])
     logging.info("END: Re-login")
 
+
+# End def step_relogin()
+
+
+def step_set_customer_id(context):
     # Step10. Set Aviatrix Customer ID
     # only BYOL license in Azure
     logging.info("START: Set Aviatrix Customer ID by invoking aviatrix API")
     response = set_aviatrix_customer_id(
-        api_endpoint_url=api_endpoint_url,
-        CID=CID,
-        customer_id=aviatrix_customer_id,
+        api_endpoint_url=context["api_endpoint_url"],
+        CID=get_step_cid(context),
+        customer_id=context["aviatrix_customer_id"],
     )
-    py_dict = response.json()
+    py_dict = get_response_json(response)
     logging.info("Aviatrix API response is : " + str(py_dict))
     logging.info("END: Set Aviatrix Customer ID by invoking aviatrix API")
 
+
+# End def step_set_customer_id()
+
+
+def step_create_access_account(context):
     # Step11. Create Access Account Based on Azure ARM
     logging.info("START : Create the Access Account based on Azure ARM")
     response = create_access_account(
-        api_endpoint_url=api_endpoint_url,
-        CID=CID,
-        account_name=access_account_name,
+        api_endpoint_url=context["api_endpoint_url"],
+        CID=get_step_cid(context),
+        account_name=context["access_account_name"],
         cloud_type="8",
-        account_email=account_email,
-        arm_subscription_id=arm_subscription_id,
-        arm_application_endpoint=directory_tenant_id,
-        arm_application_client_id=arm_application_client_id,
-        arm_application_client_secret=arm_application_client_secret,
+        account_email=context["account_email"],
+        arm_subscription_id=context["arm_subscription_id"],
+        arm_application_endpoint=context["directory_tenant_id"],
+        arm_application_client_id=context["arm_application_client_id"],
+        arm_application_client_secret=context["arm_application_client_secret"],
     )
 
     verify_aviatrix_api_create_access_account(
         response=response,
-        admin_email=admin_email,
+        admin_email=context["admin_email"],
+        account_email=context["account_email"],
     )
     logging.info("END : Create the Access Account based on Azure ARM")
 
 
+# End def step_create_access_account()
+
+
+def initialize_controller(event):
+    # function_handler() of one controller of a fleet, failures are returned instead of raised:
+    #   {"hostname": ..., "success": True/False, "error": ..., "duration": seconds}
+    # An InvalidRecord of the event stream is reported as a failed controller without hostname.
+    start_time = time.monotonic()
+    hostname = event.get("hostname") if isinstance(event, dict) else None
+    result = {"hostname": hostname, "success": True, "error": ""}
+    logging.info("START: Initialize Aviatrix Controller %s", hostname)
+    token = _current_fleet_run.set(True)
+    try:
+        if isinstance(event, InvalidRecord):
+            raise event.to_exception()
+        function_handler(event)
+    except Exception as e:
+        logging.exception("Failed to initialize Aviatrix Controller %s", hostname)
+        result["success"] = False
+        result["error"] = str(e)
+    finally:
+        _current_fleet_run.reset(token)
+    result["duration"] = time.monotonic() - start_time
+    logging.info(
+        "END: Initialize Aviatrix Controller %s, success: %s",
+        hostname,
+        str(result["success"]),
+    )
+    return result
+
+
+# End def initialize_controller()
+
+
+def probe_controller_tcp_connect(host="123.123.123.123", port=443, timeout=3):
+    # Stage 1: the VM is up and something listens on the HTTPS port
+    sock = socket.create_connection((host, port), timeout=timeout)
+    sock.close()
+    return True, "TCP connect succeeded"
+
+
+# End def probe_controller_tcp_connect()
+
+
+def probe_controller_tls_handshake(host="123.123.123.123", port=443, timeout=3):
+    # Stage 2: Apache accepts TLS connections
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        tls_sock = context.wrap_socket(sock, server_hostname=host)
+        tls_sock.close()
+    finally:
+        sock.close()
+    return True, "TLS handshake succeeded"
+
+
+# End def probe_controller_tls_handshake()
+
+
+def probe_controller_http(base_url="https://123.123.123.123", timeout=3):
+    # Stage 3: Apache answers HTTP requests, any status code is fine
+    response = get_aviatrix_session().get(url=base_url, verify=False, timeout=timeout)
+    return True, "HTTP status code is " + str(response.status_code)
+
+
+# End def probe_controller_http()
+
+
+def probe_controller_api(api_endpoint_url="https://123.123.123.123/v1/api", timeout=3):
+    # Stage 4: the backend of the API server is ready
+    # invoke the aviatrix api with a dummy login
+    # to resolve the issue where server status code is 200 but response message is "Valid action required: login"
+    # which means backend is not ready yet
+    payload = {"action": "login", "username": "test", "password": "test"}
+    response = get_aviatrix_session().post(
+        url=api_endpoint_url, data=payload, verify=False, timeout=timeout
+    )
+    logging.info("Server status code is: %s", str(response.status_code))
+
+    # handle the response code is 404
+    if response.status_code == 404:
+        err_msg = (
+            "Error: Aviatrix Controller returns error code: 404 for "
+            + api_endpoint_url
+        )
+        raise AviatrixException(
+            message=err_msg,
+        )
+    if response.status_code != 200:
+        return False, "Server status code is: " + str(response.status_code)
+
+    # if the server is ready, the response code should be 200.
+    # there are two cases that the response code is 200
+    #   case1 : return value is false and the reason message is "Valid action required: login",
+    #           which means the server is not ready yet
+    #   case2 : return value is false and the reason message is "username ans password do not match",
+    #           which means the server is ready
+    response = to_aviatrix_response(response, action="login")
+    # a body that is not the JSON of the API, e.g. the placeholder page of the web server
+    # during the boot, means the backend is not serving the API yet
+    if "return" not in response.py_dict and "reason" not in response.py_dict:
+        logging.info("Server is not ready, the response is not a response of the API")
+        return False, "The response is not a response of the API"
+    # case1:
+    if response.error_kind() in ("not_ready", "unsupported_action"):
+        logging.info(
+            "Server is not ready, and the response is :(%s)",
+            response.reason,
+        )
+        get_metrics().inc(
+            "aviatrix_api_backend_not_ready_total",
+            reason="request_refused" if "RequestRefused" in response.reason else "valid_action_required",
+        )
+        return False, response.reason
+    # case2:
+    return True, "API server is ready"
+
+
+# End def probe_controller_api()
+
+
+def wait_for_controller_readiness(context, kind="wakeup", abort_event=None):
+    # Readiness wait of a step, planned with and added to the wake-up history
+    plan = context[kind + "_plan"]
+    start_time = time.monotonic()
+    waited = threading.Event()
+    try:
+        wait_until_any_controller_endpoint_is_ready(
+            hostnames=context["endpoint_hostnames"],
+            api_version=context["aviatrix_api_version"],
+            api_route=context["aviatrix_api_route"],
+            total_wait_time=plan["wait_time"],
+            interval_wait_time=2,
+            abort_event=abort_event,
+            probe_schedule=plan["probe_schedule"],
+            waited=waited,
+        )
+    except AviatrixException:
+        # not when the wait was aborted or cut short by the time budget of the initialization
+        if time.monotonic() - start_time >= plan["wait_time"]:
+            record_readiness_duration(context, kind, time.monotonic() - start_time)
+        raise
+    # a controller that was ready at once, e.g. on a re-run, tells nothing about the wake-up
+    if waited.is_set():
+        record_readiness_duration(context, kind, time.monotonic() - start_time)
+
+
+# End def wait_for_controller_readiness()
+
+
+@profiled("wait_until_controller_api_server_is_ready")
 def wait_until_controller_api_server_is_ready(
     hostname="123.123.123.123",
     api_version="v1",
     api_route="api",
     total_wait_time=300,
-    interval_wait_time=10,
+    interval_wait_time=2,
+    probe_timeout=3,
+    abort_event=None,
+    probe_schedule=None,
+    api_probe_timeout=30,
+    waited=None,
 ):
-    payload = {"action": "login", "username": "test", "password": "test"}
+    # Wait until the API server is ready, or raise AviatrixException once total_wait_time
+    # seconds of real (monotonic) time have passed or abort_event is set.
+    # The controller is probed in cheap stages, each stage must pass before the next one is tried:
+    #   tcp  : TCP connect to the HTTPS port
+    #   tls  : TLS handshake
+    #   http : any HTTP response from Apache
+    #   api  : dummy login, the API backend is ready
+    # Every probe is bounded by probe_timeout, except the answer to the dummy login that may be
+    # slow while the backend starts, bounded by api_probe_timeout. Failed probes are retried with
+    # a jittered exponential backoff capped at interval_wait_time, or at probe_schedule(elapsed seconds).
+    # waited (a threading.Event) is set when a probe fails, the controller was not ready at once.
     api_endpoint_url = "https://" + hostname + "/" + api_version + "/" + api_route
-
-    # invoke the aviatrix api with a non-existed api
-    # to resolve the issue where server status code is 200 but response message is "Valid action required: login"
-    # which means backend is not ready yet
-    payload = {"action": "login", "username": "test", "password": "test"}
-    remaining_wait_time = total_wait_time
-
-    """ Variable Description: (time_spent_for_requests_lib_timeout)
-    Description:
-        * This value represents how many seconds for "requests" lib to timeout by default.
-    Detail:
-        * The value 20 seconds is actually a rough number
-        * If there is a connection error and causing timeout when
-          invoking--> requests.get(xxx), it takes about 20 seconds for requests.get(xxx) to throw timeout exception.
-        * When calculating the remaining wait time, this value is considered.
-    """
-    time_spent_for_requests_lib_timeout = 20
+    base_url = "https://" + hostname + "/"
+    parsed_url = urlparse(api_endpoint_url)
+    host = parsed_url.hostname
+    port = parsed_url.port or 443
+
+    stages = [
+        ("tcp", lambda timeout: probe_controller_tcp_connect(host, port, timeout)),
+        ("tls", lambda timeout: probe_controller_tls_handshake(host, port, timeout)),
+        ("http", lambda timeout: probe_controller_http(base_url, timeout)),
+        ("api", lambda timeout: probe_controller_api(api_endpoint_url, timeout)),
+    ]
+    # the TCP and TLS probes do not go through the session and cannot be replayed
+    if is_replaying_cassette():
+        stages = stages[2:]
+
+    remaining_time = get_remaining_time()
+    if remaining_time is not None:
+        total_wait_time = max(0, min(total_wait_time, remaining_time))
+    start_time = time.monotonic()
+    deadline = start_time + total_wait_time
+    stage_index = 0
+    attempt = 0
     last_err_msg = ""
-    while remaining_wait_time > 0:
+    while True:
+        remaining_wait_time = deadline - time.monotonic()
+        if remaining_wait_time <= 0:
+            break
+
+        stage_name, probe = stages[stage_index]
+        span = start_trace_span(
+            "readiness probe " + stage_name, kind="probe", stage=stage_name, attempt=attempt
+        )
         try:
-            # Reset the checking flags
-            response_status_code = -1
-            is_apache_returned_200 = False
-            is_api_service_ready = False
-
-            # invoke a dummy REST API to Aviatrix controller
-            response = requests.post(url=api_endpoint_url, data=payload, verify=False)
-
-            # check response
-            # if the server is ready, the response code should be 200.
-            # there are two cases that the response code is 200
-            #   case1 : return value is false and the reason message is "Valid action required: login",
-            #           which means the server is not ready yet
-            #   case2 : return value is false and the reason message is "username ans password do not match",
-            #           which means the server is ready
-            if response is not None:
-                response_status_code = response.status_code
-                logging.info("Server status code is: %s", str(response_status_code))
-                py_dict = response.json()
-                if response.status_code == 200:
-                    is_apache_returned_200 = True
-
-                response_message = py_dict["reason"]
-                response_msg_indicates_backend_not_ready = "Valid action required"
-                response_msg_request_refused = "RequestRefused"
-                # case1:
-                if (
-                    py_dict["return"] is False
-                    and (response_msg_indicates_backend_not_ready in response_message
-                    or response_msg_request_refused in response_message)
-                ):
-                    is_api_service_ready = False
-                    logging.info(
-                        "Server is not ready, and the response is :(%s)",
-                        response_message,
-                    )
-                # case2:
-                else:
-                    is_api_service_ready = True
-            # END outer if
-
-            # if the response code is 200 and the server is ready
-            if is_apache_returned_200 and is_api_service_ready:
-                logging.info("Server is ready")
-                return True
+            timeout = min(probe_timeout, remaining_wait_time)
+            if stage_name == "api":
+                timeout = (timeout, min(api_probe_timeout, remaining_wait_time))
+            is_passed, last_err_msg = probe(timeout)
+            end_trace_span(span, passed=is_passed, message=last_err_msg)
+        except AviatrixException as e:
+            end_trace_span(span, error=e)
+            raise
         except Exception as e:
-            logging.exception(
-                "Aviatrix Controller %s is not available", api_endpoint_url
-            )
+            end_trace_span(span, error=e, passed=False)
+            is_passed = False
             last_err_msg = str(e)
-            pass
-            # END try-except
-
-            # handle the response code is 404
-            if response_status_code == 404:
-                err_msg = (
-                    "Error: Aviatrix Controller returns error code: 404 for "
-                    + api_endpoint_url
-                )
-                raise AviatrixException(
-                    message=err_msg,
+            logging.info(
+                "Aviatrix Controller %s is not available, %s probe failed: %s",
+                api_endpoint_url,
+                stage_name,
+                last_err_msg,
+            )
+            # a connection error on a later stage means the server went away again
+            # (e.g. Apache restarts), start over from the cheapest probe.
+            # A read timeout means it is up but slow, the stage is probed again.
+            if not isinstance(e, requests.exceptions.ReadTimeout):
+                stage_index = 0
+
+        if is_passed:
+            logging.info("Probe %s passed: %s", stage_name, last_err_msg)
+            if stage_index == len(stages) - 1:
+                logging.info("Server is ready")
+                get_circuit_breaker(api_endpoint_url).record_success()
+                get_metrics().observe(
+                    "aviatrix_api_server_wait_seconds", time.monotonic() - start_time, outcome="ready"
                 )
-            # END if
-
-        # if server response code is neither 200 nor 404, some other errors occurs
-        # repeat the process till reaches case 2
-
-        remaining_wait_time = (
-            remaining_wait_time
-            - interval_wait_time
-            - time_spent_for_requests_lib_timeout
+                return True
+            stage_index += 1
+            attempt = 0
+            continue
+
+        if waited is not None:
+            waited.set()
+        # full jitter backoff, never sleep past the deadline
+        if probe_schedule is None:
+            max_interval = interval_wait_time
+        else:
+            max_interval = probe_schedule(time.monotonic() - start_time)
+        backoff = min(max_interval, 0.5 * pow(2, min(attempt, 16)))
+        attempt += 1
+        wait_time_before_retry = min(
+            random.uniform(backoff / 2, backoff), deadline - time.monotonic()
         )
-        if remaining_wait_time > 0:
-            time.sleep(interval_wait_time)
+        if abort_event is None:
+            if wait_time_before_retry > 0:
+                time.sleep(wait_time_before_retry)
+        elif abort_event.wait(timeout=max(0, wait_time_before_retry)):
+            raise AviatrixException(
+                message="Wait for Aviatrix Controller " + api_endpoint_url + " aborted",
+            )
     # END while loop
 
     # if the server is still not ready after the default time
     # raise AviatrixException
+    get_metrics().observe("aviatrix_api_server_wait_seconds", time.monotonic() - start_time, outcome="timeout")
     err_msg = (
         "Aviatrix Controller "
         + api_endpoint_url
         + " is not available after "
         + str(total_wait_time)
-        + " seconds"
-        + "Server status code is: "
-        + str(response_status_code)
+        + " seconds. "
+        + "The last probe was: "
+        + stages[stage_index][0]
         + ". "
         + "The response message is: "
         + last_err_msg
@@ -319,6 +1457,8 @@ def login(
     username="admin",
     password="********",
     hide_password=True,
+    retry_count=None,
+    timeout=None,
 ):
     request_method = "POST"
     data = {"action": "login", "username": username, "password": password}
@@ -341,6 +1481,8 @@ def login(
         api_endpoint_url=api_endpoint_url,
         request_method=request_method,
         payload=data,
+        retry_count=retry_count,
+        timeout=timeout,
     )
     return response
 
@@ -348,76 +1490,203 @@ def login(
 # End def login()
 
 
+@profiled("send_aviatrix_api")
 def send_aviatrix_api(
     api_endpoint_url="https://123.123.123.123/v1/api",
     request_method="POST",
     payload=dict(),
-    retry_count=5,
+    retry_count=None,
     timeout=None,
+    use_cache=True,
+    use_circuit_breaker=True,
 ):
+    # Send one API call, retried as the retry policy decides (see RetryPolicy).
+    # Returns the AviatrixResponse of the first successful (200) attempt.
+    #   retry_count         : attempts of this call, overrides the max_attempts of the retry policy
+    #   timeout             : read timeout of each attempt, overrides the read_timeout of the retry policy
+    #   use_cache           : False always calls the controller, even for read-only actions
+    #   use_circuit_breaker : False neither checks nor updates the circuit breaker of the controller
+    # Attempts, waits and timeouts are bounded by the time budget of the initialization,
+    # and calls to a controller whose circuit breaker is open fail immediately.
+    # The error of the last attempt that got no response is the cause of the raised AviatrixException.
     response = None
     responses = list()
     request_type = request_method.upper()
     response_status_code = -1
 
-    for i in range(retry_count):
-        try:
-            if request_type == "GET":
-                response = requests.get(
-                    url=api_endpoint_url, params=payload, verify=False
-                )
-                response_status_code = response.status_code
-            elif request_type == "POST":
-                response = requests.post(
-                    url=api_endpoint_url, data=payload, verify=False, timeout=timeout
-                )
-                response_status_code = response.status_code
-            else:
-                failure_reason = "ERROR : Bad HTTPS request type: " + request_type
-                logging.error(failure_reason)
-        except requests.exceptions.Timeout as e:
-            logging.exception("WARNING: Request timeout...")
-            responses.append(str(e))
-        except requests.exceptions.ConnectionError as e:
-            logging.exception("WARNING: Server is not responding...")
-            responses.append(str(e))
-        except Exception as e:
-            traceback_msg = traceback.format_exc()
-            logging.exception("HTTP request failed")
-            responses.append(str(traceback_msg))
-            # For error message/debugging purposes
+    if request_type not in ("GET", "POST"):
+        failure_reason = "ERROR : Bad HTTPS request type: " + request_type
+        logging.error(failure_reason)
+        raise AviatrixException(
+            message=failure_reason,
+        )
 
-        finally:
-            if response_status_code == 200:
+    # serve read-only actions from the response cache, any state changing action invalidates it
+    cache_key = get_response_cache_key(api_endpoint_url=api_endpoint_url, payload=payload)
+    if cache_key is not None:
+        if not use_cache:
+            cache_key = None
+        else:
+            response = get_cached_response(cache_key)
+            if response is not None:
                 return response
-            elif response_status_code == 404:
-                failure_reason = "ERROR: 404 Not Found"
-                logging.error(failure_reason)
-
-            # if the response code is neither 200 nor 404, repeat the precess (retry)
-            # the default retry count is 5, the wait for each retry is i
-            # i           =  0  1  2  3  4
-            # wait time   =     1  2  4  8
-
-            if i + 1 < retry_count:
-                logging.info("START: retry")
-                logging.info("i == %d", i)
-                wait_time_before_retry = pow(2, i)
-                logging.info("Wait for: %ds for the next retry", wait_time_before_retry)
-                time.sleep(wait_time_before_retry)
-                logging.info("ENDED: Wait until retry")
-                # continue next iteration
-            else:
-                failure_reason = (
-                    "ERROR: Failed to invoke Aviatrix API. Exceed the max retry times. "
-                    + " All responses are listed as follows :  "
-                    + str(responses)
-                )
-                raise AviatrixException(
-                    message=failure_reason,
+    elif payload.get("action") not in non_mutating_api_actions:
+        invalidate_response_cache(api_endpoint_url=api_endpoint_url)
+
+    retry_policy = get_retry_policy()
+    if retry_count is None:
+        retry_count = retry_policy.max_attempts
+
+    if use_circuit_breaker:
+        circuit_breaker = get_circuit_breaker(api_endpoint_url)
+    else:
+        circuit_breaker = CircuitBreaker(failure_threshold=0)
+    if not circuit_breaker.allow_request():
+        failure_reason = (
+            "ERROR: Aviatrix Controller "
+            + api_endpoint_url
+            + " failed "
+            + str(circuit_breaker.consecutive_failures)
+            + " calls in a row, the next call is allowed in "
+            + str(int(circuit_breaker.get_retry_time()))
+            + " seconds"
+        )
+        raise CircuitBreakerOpenException(
+            message=failure_reason,
+        )
+
+    # the trial call of a half open circuit breaker must end with its state updated
+    # or the trial released, even when the time budget or a bug ends the call
+    is_circuit_breaker_updated = False
+    try:
+        session = get_aviatrix_session()
+        failure_reason = "ERROR: Failed to invoke Aviatrix API. Exceed the max retry times. "
+        span_error = None
+        attempt_count = 0
+        is_timeout_cut_short = False
+
+        for i in range(retry_count):
+            remaining_time = get_remaining_time()
+            if remaining_time is not None and remaining_time <= 0:
+                failure_reason = "ERROR: Failed to invoke Aviatrix API. The time budget of the initialization is exhausted. "
+                break
+
+            span = start_trace_span(
+                "aviatrix_api " + str(payload.get("action", "")),
+                kind="http",
+                action=str(payload.get("action", "")),
+                method=request_type,
+                attempt=i,
+            )
+            request_timeout = retry_policy.get_timeout(read_timeout=timeout, remaining_time=remaining_time)
+            is_timeout_cut_short = request_timeout != retry_policy.get_timeout(read_timeout=timeout)
+            attempt_count += 1
+            request_url = resolve_api_endpoint(api_endpoint_url)
+            response = None
+            response_status_code = -1
+            span_error = None
+            attempt_start_time = time.monotonic()
+            try:
+                if request_type == "GET":
+                    response = session.get(
+                        url=request_url, params=payload, verify=False, timeout=request_timeout
+                    )
+                else:
+                    response = session.post(
+                        url=request_url, data=payload, verify=False, timeout=request_timeout
+                    )
+                response_status_code = response.status_code
+            except requests.exceptions.Timeout as e:
+                logging.exception("WARNING: Request timeout...")
+                responses.append(str(e))
+                span_error = e
+            except requests.exceptions.ConnectionError as e:
+                logging.exception("WARNING: Server is not responding...")
+                responses.append(str(e))
+                span_error = e
+            except Exception as e:
+                traceback_msg = traceback.format_exc()
+                logging.exception("HTTP request failed")
+                responses.append(str(traceback_msg))
+                span_error = e
+                # For error message/debugging purposes
+            end_trace_span(span, error=span_error, status_code=response_status_code)
+            get_metrics().observe(
+                "aviatrix_api_request_duration_seconds",
+                time.monotonic() - attempt_start_time,
+                action=str(payload.get("action", "")),
+                status=type(span_error).__name__ if span_error is not None else str(response_status_code),
+            )
+
+            decision = retry_policy.classify(request_type, payload, response=response, error=span_error)
+            if decision == RetryPolicy.SUCCESS:
+                circuit_breaker.record_success()
+                is_circuit_breaker_updated = True
+                aviatrix_response = AviatrixResponse.from_http_response(
+                    response,
+                    action=str(payload.get("action", "")),
+                    elapsed=time.monotonic() - attempt_start_time,
+                    attempts=i + 1,
                 )
-            # END
-    return response
+                if cache_key is not None:
+                    put_cached_response(cache_key, aviatrix_response)
+                return aviatrix_response
+            if response is not None:
+                responses.append("HTTP status code " + str(response_status_code))
+                if response_status_code == 404:
+                    logging.error("ERROR: 404 Not Found")
+
+            if decision == RetryPolicy.FATAL:
+                failure_reason = "ERROR: Failed to invoke Aviatrix API. The error is not retryable. "
+                break
+            if decision == RetryPolicy.RETRYABLE_ONCE and i > 0:
+                failure_reason = "ERROR: Failed to invoke Aviatrix API. The call is not idempotent and is retried only once. "
+                break
+            if i + 1 >= retry_count:
+                break
+            # the request never reached the controller, try its other address right away
+            if isinstance(span_error, requests.exceptions.ConnectionError):
+                failover_url = failover_api_endpoint(api_endpoint_url, failed_url=request_url)
+                if failover_url is not None and failover_url != request_url:
+                    logging.info("Aviatrix Controller is not reachable at %s, fail over to %s", request_url, failover_url)
+                    continue
+
+            wait_time_before_retry = retry_policy.get_delay(i, response=response)
+            remaining_time = get_remaining_time()
+            if remaining_time is not None and wait_time_before_retry >= remaining_time:
+                failure_reason = "ERROR: Failed to invoke Aviatrix API. The time budget of the initialization is exhausted. "
+                break
+            get_metrics().inc(
+                "aviatrix_api_retries_total",
+                action=str(payload.get("action", "")),
+                reason=type(span_error).__name__ if span_error is not None else "http_" + str(response_status_code),
+            )
+            logging.info("START: retry")
+            logging.info("i == %d", i)
+            logging.info("Wait for: %.2fs for the next retry", wait_time_before_retry)
+            time.sleep(wait_time_before_retry)
+            logging.info("ENDED: Wait until retry")
+        # END for loop
+
+        # an unreachable or failing controller counts towards its circuit breaker,
+        # an error response means the controller itself is fine,
+        # and running out of the local time budget says nothing about the controller
+        if attempt_count == 0 or (isinstance(span_error, requests.exceptions.Timeout) and is_timeout_cut_short):
+            circuit_breaker.release_trial()
+        elif response is None or response_status_code >= 500 or response_status_code in (408, 429):
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+        is_circuit_breaker_updated = True
+
+        failure_reason += " All responses are listed as follows :  " + str(responses)
+        raise AviatrixException(
+            message=failure_reason,
+            status_code=response_status_code,
+        ) from (span_error if response is None else None)
+    finally:
+        if not is_circuit_breaker_updated:
+            circuit_breaker.release_trial()
 
 
 # End def send_aviatrix_api()
@@ -428,34 +1697,124 @@ def verify_aviatrix_api_response_login(response=None):
     # response_code == 200
     # api_return_boolean == true
     # response_message = "authorized successfully"
+    response = to_aviatrix_response(response, action="login")
+    logging.info("Aviatrix API response is %s", str(response.py_dict))
 
-    py_dict = response.json()
-    logging.info("Aviatrix API response is %s", str(py_dict))
-
-    response_code = response.status_code
-    if response_code != 200:
+    if response.status_code != 200:
         err_msg = (
-            "Fail to login Aviatrix Controller. The response code is" + response_code
+            "Fail to login Aviatrix Controller. The response code is " + str(response.status_code)
         )
         raise AviatrixException(message=err_msg)
 
-    api_return_boolean = py_dict["return"]
-    if api_return_boolean is not True:
-        err_msg = "Fail to Login Aviatrix Controller. The Response is" + str(py_dict)
+    if not response.succeeded():
+        err_msg = "Fail to Login Aviatrix Controller. The Response is" + str(response.py_dict)
         raise AviatrixException(
             message=err_msg,
         )
 
-    api_return_msg = py_dict["results"]
-    expected_string = "authorized successfully"
-    if (expected_string in api_return_msg) is not True:
-        err_msg = "Fail to Login Aviatrix Controller. The Response is" + str(py_dict)
-        raise AviatrixException(
-            message=err_msg,
+
+# End def verify_aviatrix_api_response_login()
+
+
+def is_auth_error_response(response=None):
+    # True if the call was rejected because its CID is invalid or expired
+    if response is None or response.status_code != 200:
+        return False
+    return to_aviatrix_response(response).error_kind() == "invalid_cid"
+
+
+# End def is_auth_error_response()
+
+
+def validate_cid(api_endpoint_url="https://123.123.123.123/v1/api", CID="ABCD1234"):
+    # Validate a CID with the read-only initial_setup check, whose response is cached
+    # and reused by the next check of the same run
+    data = {"action": "initial_setup", "CID": CID, "subaction": "check"}
+    try:
+        response = send_aviatrix_api(
+            api_endpoint_url=api_endpoint_url,
+            request_method="POST",
+            payload=data,
+            retry_count=1,
         )
+    except AviatrixException:
+        return False
+    return not is_auth_error_response(response)
 
 
-# End def verify_aviatrix_api_response_login()
+# End def validate_cid()
+
+
+def get_session_cid(
+    api_endpoint_url="https://123.123.123.123/v1/api",
+    username="admin",
+    password="********",
+    validate=False,
+    force_login=False,
+):
+    # Return the CID of the user, from the CID cache when possible, otherwise login and cache it.
+    #   validate    : check a cached CID with a read-only call before returning it
+    #   force_login : ignore the cached CID
+    cid_cache = get_cid_cache()
+    if not force_login:
+        CID = cid_cache.get(api_endpoint_url, username, password)
+        if CID is not None and (not validate or validate_cid(api_endpoint_url, CID)):
+            logging.info("Use the cached CID of %s on %s", username, api_endpoint_url)
+            return CID
+        if CID is not None:
+            cid_cache.invalidate(api_endpoint_url, username)
+
+    response = login(
+        api_endpoint_url=api_endpoint_url,
+        username=username,
+        password=password,
+    )
+    verify_aviatrix_api_response_login(response=response)
+    CID = get_response_json(response)["CID"]
+    cid_cache.put(api_endpoint_url, username, password, CID)
+    return CID
+
+
+# End def get_session_cid()
+
+
+def send_authenticated_aviatrix_api(
+    api_endpoint_url="https://123.123.123.123/v1/api",
+    username="admin",
+    password="********",
+    request_method="POST",
+    payload=dict(),
+    **kwargs
+):
+    # send_aviatrix_api() with the CID of the user added to the payload.
+    # The cached CID is used as is, a call rejected because of the CID logs in again
+    # and is sent once more.
+    CID = get_session_cid(api_endpoint_url=api_endpoint_url, username=username, password=password)
+    response = send_aviatrix_api(
+        api_endpoint_url=api_endpoint_url,
+        request_method=request_method,
+        payload=dict(payload, CID=CID),
+        **kwargs
+    )
+    if not is_auth_error_response(response):
+        return response
+
+    logging.info("The CID of %s on %s has expired, login again", username, api_endpoint_url)
+    CID = get_session_cid(
+        api_endpoint_url=api_endpoint_url,
+        username=username,
+        password=password,
+        force_login=True,
+    )
+    return send_aviatrix_api(
+        api_endpoint_url=api_endpoint_url,
+        request_method=request_method,
+        payload=dict(payload, CID=CID),
+        **kwargs
+    )
+
+
+# End def send_authenticated_aviatrix_api()
 
 
 def has_controller_initialized(
@@ -474,10 +1833,9 @@ def has_controller_initialized(
         payload=data,
     )
 
-    py_dict = response.json()
-    logging.info("Aviatrix API response is: %s", str(py_dict))
+    logging.info("Aviatrix API response is: %s", str(response.py_dict))
 
-    if py_dict["return"] is False and "not run" in py_dict["reason"]:
+    if response.error_kind() == "not_initialized":
         return False
     else:
         return True
@@ -512,23 +1870,20 @@ def set_admin_email(
 def verify_aviatrix_api_set_admin_email(response=None):
     # if the set admin email request is successful
     # the response code is 200 and the returned message is "admin email address has been successfully added"
-    py_dict = response.json()
-    logging.info("Aviatrix API response is %s", str(py_dict))
+    response = to_aviatrix_response(response, action="add_admin_email_addr")
+    logging.info("Aviatrix API response is %s", str(response.py_dict))
 
-    response_code = response.status_code
-    if response_code != 200:
+    if response.status_code != 200:
         err_msg = (
-            "Fail for set admin email for the Aviatrix Controller. The response code is"
-            + response_code
+            "Fail for set admin email for the Aviatrix Controller. The response code is "
+            + str(response.status_code)
         )
         raise AviatrixException(message=err_msg)
 
-    api_return_message = py_dict["results"]
-    expected_string = "admin email address has been successfully added"
-    if (expected_string in api_return_message) is False:
+    if not response.succeeded():
         err_msg = (
             "Fail for set admin email for Aviatrix Controller. The expected string "
-            + expected_string
+            + api_success_matchers["add_admin_email_addr"].pattern
             + " is not found in returned message"
         )
         raise AviatrixException(message=err_msg)
@@ -571,12 +1926,7 @@ def set_admin_password(
 
     # if response return false the "Valid action required"
     # the api doesn't exist
-    if (
-        response.json()["return"] == False
-        and "Valid action required" in response.json()["reason"]
-    ):
-        is_successfully_changed_password = False
-    else:
+    if response.error_kind() not in ("not_ready", "unsupported_action"):
         return response
 
     # if the api doesn't exist, try the "change_password" api
@@ -613,23 +1963,21 @@ def set_admin_password(
 def verify_aviatrix_api_set_admin_password(response=None):
     # if the set admin password request is successful
     # the response code is 200 and the return true
-    py_dict = response.json()
-    logging.info("Aviatrix API response is %s", str(py_dict))
+    response = to_aviatrix_response(response)
+    logging.info("Aviatrix API response is %s", str(response.py_dict))
 
-    response_code = response.status_code
-    if response_code != 200:
+    if response.status_code != 200:
         err_msg = (
             "Fail to set admin password, the response code is : "
-            + str(response_code)
+            + str(response.status_code)
             + ", which is not 200"
         )
         raise AviatrixException(message=err_msg)
 
-    api_return_boolean = py_dict["return"]
-    if api_return_boolean is not True:
+    if response.return_value is not True:
         err_msg = (
             "Fail to set admin password for Aviatrix Controller. API response is :"
-            + str(py_dict)
+            + str(response.py_dict)
         )
         raise AviatrixException(message=err_msg)
 
@@ -641,24 +1989,31 @@ def run_initial_setup(
     api_endpoint_url="123.123.123.123/v1/api",
     CID="ABCD1234",
     target_version="latest",
+    track_upgrade=default_track_upgrade,
+    upgrade_timeout=default_upgrade_timeout,
+    poll_interval=2,
+    poll_schedule=None,
+    on_upgrade_duration=None,
+    check_first=True,
 ):
+    #   check_first : False skips the check, the caller already knows the initial setup has not run
     request_method = "POST"
 
     # Step1 : Check if the controller has been already initialized
     #       --> yes
     #       --> no --> run init setup (upgrading to the latest controller version)
-    data = {"action": "initial_setup", "CID": CID, "subaction": "check"}
-    logging.info("Check if the initial setup has been already done or not")
-    response = send_aviatrix_api(
-        api_endpoint_url=api_endpoint_url,
-        request_method=request_method,
-        payload=data,
-    )
-    py_dict = response.json()
-    # The initial setup has been done
-    if py_dict["return"] is True:
-        logging.info("Initial setup for Aviatrix Controller has been already done")
-        return response
+    if check_first:
+        data = {"action": "initial_setup", "CID": CID, "subaction": "check"}
+        logging.info("Check if the initial setup has been already done or not")
+        response = send_aviatrix_api(
+            api_endpoint_url=api_endpoint_url,
+            request_method=request_method,
+            payload=data,
+        )
+        # The initial setup has been done
+        if response.return_value is True:
+            logging.info("Initial setup for Aviatrix Controller has been already done")
+            return response
 
     # The initial setup has not been done yet
     data = {
@@ -671,17 +2026,30 @@ def run_initial_setup(
     logging.info("API endpoint url: %s", str(api_endpoint_url))
     logging.info("Request method is: %s", str(request_method))
     logging.info("Request payload is : %s", str(json.dumps(obj=data, indent=4)))
+
+    if track_upgrade:
+        return track_initial_setup_upgrade(
+            api_endpoint_url=api_endpoint_url,
+            CID=CID,
+            payload=data,
+            target_version=target_version,
+            upgrade_timeout=upgrade_timeout,
+            poll_interval=poll_interval,
+            poll_schedule=poll_schedule,
+            on_upgrade_duration=on_upgrade_duration,
+        )
+
     try:
         response = send_aviatrix_api(
             api_endpoint_url=api_endpoint_url,
             request_method=request_method,
             payload=data,
             retry_count=1,
-            timeout=300,
+            timeout=upgrade_timeout,
         )
     except AviatrixException as ae:
-        # Ignore timeout exception since it is expected
-        if "Read timed out" in str(ae):
+        # Ignore timeout exception since it is expected, Apache restarts during the upgrade
+        if is_transport_error(ae):
             return None
     except:
         raise
@@ -691,29 +2059,229 @@ def run_initial_setup(
 # End def run_initial_setup()
 
 
+def track_initial_setup_upgrade(
+    api_endpoint_url="123.123.123.123/v1/api",
+    CID="ABCD1234",
+    payload=dict(),
+    target_version="latest",
+    upgrade_timeout=900,
+    poll_interval=2,
+    poll_schedule=None,
+    on_upgrade_duration=None,
+):
+    # Fire the "run" subaction of initial_setup in a background thread and poll the
+    # progress of the upgrade instead of blocking on the read timeout of the request.
+    # The upgrade is finished as soon as one of the following happens:
+    #   * the "run" request returns
+    #   * the "check" subaction reports the initial setup as done and the controller
+    #     reports the target version
+    # Returns the response that confirmed the upgrade, or None if it could not be
+    # confirmed within upgrade_timeout seconds.
+    # Apache restarts during the upgrade and may drop the "run" request: a request that got no
+    # response is not an error, the progress is polled until the upgrade is confirmed.
+    # The "run" request outlives the step when the upgrade is confirmed first, it does not
+    # count towards the circuit breaker of the controller.
+    # The progress is polled every poll_interval seconds, or poll_schedule(elapsed seconds).
+    # on_upgrade_duration(seconds) is called with the duration of a confirmed upgrade, and with
+    # the upgrade timeout when the upgrade could not be confirmed in time.
+    planned_upgrade_timeout = upgrade_timeout
+    remaining_time = get_remaining_time()
+    if remaining_time is not None:
+        upgrade_timeout = max(0, min(upgrade_timeout, remaining_time))
+    run_result = dict()
+    run_finished = threading.Event()
+
+    def send_run_request():
+        try:
+            run_result["response"] = send_aviatrix_api(
+                api_endpoint_url=api_endpoint_url,
+                request_method="POST",
+                payload=payload,
+                retry_count=1,
+                timeout=upgrade_timeout,
+                use_circuit_breaker=False,
+            )
+        except Exception as e:
+            run_result["error"] = e
+        finally:
+            run_finished.set()
+
+    context = contextvars.copy_context()
+    run_thread = threading.Thread(target=context.run, args=(send_run_request,))
+    run_thread.daemon = True
+    run_thread.start()
+
+    start_time = time.monotonic()
+    deadline = start_time + upgrade_timeout
+    run_dropped = False
+    while True:
+        # wait for the run request, but poll the progress every poll_interval seconds
+        remaining_time = deadline - time.monotonic()
+        if poll_schedule is not None:
+            poll_interval = poll_schedule(time.monotonic() - start_time)
+        wait_time = max(0, min(poll_interval, remaining_time))
+        if run_dropped:
+            time.sleep(wait_time)
+        elif run_finished.wait(timeout=wait_time):
+            if not is_transport_error(run_result.get("error")):
+                break
+            logging.info(
+                "Initial setup request got no response after %d seconds, polling the progress of the upgrade",
+                time.monotonic() - start_time,
+            )
+            run_dropped = True
+        if time.monotonic() >= deadline:
+            break
+
+        response = poll_initial_setup_progress(
+            api_endpoint_url=api_endpoint_url,
+            CID=CID,
+            target_version=target_version,
+        )
+        if response is not None:
+            logging.info(
+                "Upgrade of Aviatrix Controller has finished after %d seconds",
+                time.monotonic() - start_time,
+            )
+            get_metrics().observe(
+                "aviatrix_upgrade_duration_seconds", time.monotonic() - start_time, outcome="confirmed"
+            )
+            if on_upgrade_duration is not None:
+                on_upgrade_duration(time.monotonic() - start_time)
+            invalidate_response_cache(api_endpoint_url=api_endpoint_url)
+            return response
+    # END while loop
+
+    invalidate_response_cache(api_endpoint_url=api_endpoint_url)
+    if "response" in run_result:
+        logging.info(
+            "Initial setup request returned after %d seconds",
+            time.monotonic() - start_time,
+        )
+        get_metrics().observe(
+            "aviatrix_upgrade_duration_seconds", time.monotonic() - start_time, outcome="confirmed"
+        )
+        if on_upgrade_duration is not None:
+            on_upgrade_duration(time.monotonic() - start_time)
+        return run_result["response"]
+    get_metrics().observe(
+        "aviatrix_upgrade_duration_seconds", time.monotonic() - start_time, outcome="unconfirmed"
+    )
+    # not when the wait was cut short by the time budget of the initialization
+    if on_upgrade_duration is not None and time.monotonic() - start_time >= planned_upgrade_timeout:
+        on_upgrade_duration(time.monotonic() - start_time)
+
+    error = run_result.get("error")
+    if error is not None and not is_transport_error(error):
+        raise error
+    logging.warning(
+        "Upgrade of Aviatrix Controller could not be confirmed within %d seconds",
+        upgrade_timeout,
+    )
+    return None
+
+
+# End def track_initial_setup_upgrade()
+
+
+def parse_version(version=""):
+    # (6, 5, 1000) of "UserConnect-6.5.1000", () if the version has no number
+    match = version_number_pattern.search(version)
+    if match is None:
+        return tuple()
+    return tuple(int(number) for number in match.group(0).split("."))
+
+
+# End def parse_version()
+
+
+def is_target_version(current_version="UserConnect-6.5.1000", target_version="6.5"):
+    # A target version matches the current version it is a prefix of, component by component:
+    # 6.5 matches 6.5.1000 but neither 6.50.1 nor 16.5
+    target = parse_version(target_version)
+    if not target:
+        return False
+    return parse_version(current_version)[: len(target)] == target
+
+
+# End def is_target_version()
+
+
+def poll_initial_setup_progress(
+    api_endpoint_url="123.123.123.123/v1/api",
+    CID="ABCD1234",
+    target_version="latest",
+    timeout=5,
+):
+    # One progress poll of an ongoing upgrade.
+    # Returns the "check" response once the initial setup is done and the controller runs
+    # the target version, or None while the upgrade is still in progress.
+    # Apache restarts during the upgrade, so connection errors are expected here.
+    session = get_aviatrix_session()
+    api_endpoint_url = resolve_api_endpoint(api_endpoint_url)
+    span = start_trace_span("upgrade progress poll", kind="probe")
+    try:
+        data = {"action": "initial_setup", "CID": CID, "subaction": "check"}
+        response = session.post(
+            url=api_endpoint_url, data=data, verify=False, timeout=timeout
+        )
+        py_dict = get_response_json(response)
+        if response.status_code != 200 or py_dict.get("return") is not True:
+            logging.info(
+                "Upgrade is in progress, the response is: %s",
+                str(py_dict.get("reason", "")),
+            )
+            end_trace_span(span, done=False)
+            return None
+
+        if target_version and target_version != "latest":
+            data = {"action": "list_version_info", "CID": CID}
+            version_response = session.post(
+                url=api_endpoint_url, data=data, verify=False, timeout=timeout
+            )
+            version_results = get_response_json(version_response).get("results")
+            current_version = ""
+            if isinstance(version_results, dict):
+                current_version = str(version_results.get("current_version", ""))
+            if not is_target_version(current_version=current_version, target_version=target_version):
+                logging.info(
+                    "Upgrade is in progress, the current version is: %s",
+                    current_version,
+                )
+                end_trace_span(span, done=False, current_version=current_version)
+                return None
+        end_trace_span(span, done=True)
+        return response
+    except Exception as e:
+        logging.info("Upgrade is in progress, the controller is not responding: %s", str(e))
+        end_trace_span(span, error=e, done=False)
+        return None
+
+
+# End def poll_initial_setup_progress()
+
+
 def verify_aviatrix_api_run_initial_setup(response=None):
-    if not response:
+    # None: the upgrade could not be confirmed, the next readiness wait will tell
+    if response is None:
         return
-    py_dict = response.json()
-    logging.info("Aviatrix API response is: %s", str(py_dict))
+    response = to_aviatrix_response(response, action="initial_setup")
+    logging.info("Aviatrix API response is: %s", str(response.py_dict))
 
-    response_code = response.status_code
-    if response_code != 200:
+    if response.status_code != 200:
         err_msg = (
             "Fail to run initial setup for the Aviatrix Controller. The actual response code is "
-            + str(response_code)
+            + str(response.status_code)
             + ", which is not 200"
         )
         raise AviatrixException(message=err_msg)
 
-    api_return_boolean = py_dict["return"]
-    if api_return_boolean is not True:
+    if response.return_value is not True:
         err_msg = (
             "Fail to run initial setup for the Aviatrix Controller. The actual api response is  "
-            + str(py_dict)
+            + str(response.py_dict)
         )
         raise AviatrixException(message=err_msg)
-    pass
 
 
 # End def verify_aviatrix_api_run_initial_setup()
@@ -790,30 +2358,28 @@ def create_access_account(
 def verify_aviatrix_api_create_access_account(
     response=None,
     admin_email="test@aviatrix.com",
+    account_email="test@aviatrix.com",
 ):
-    py_dict = response.json()
-    logging.info("Aviatrix API response is: %s", str(py_dict))
+    response = to_aviatrix_response(response, action="setup_account_profile")
+    logging.info("Aviatrix API response is: %s", str(response.py_dict))
 
-    response_code = response.status_code
-    if response_code != 200:
+    if response.status_code != 200:
         err_msg = (
             "Fail to create the access account. The actual response code is : "
-            + str(response_code)
+            + str(response.status_code)
             + ", which is not 200"
         )
         raise AviatrixException(message=err_msg)
-    api_return_boolean = py_dict["return"]
-    if api_return_boolean is not True:
-        err_msg = "Fail to create the access account. The response is : " + str(py_dict)
+    if response.return_value is not True:
+        err_msg = "Fail to create the access account. The response is : " + str(response.py_dict)
         raise AviatrixException(message=err_msg)
 
-    api_return_msg = py_dict["results"]
     expected_string = "An email confirmation has been sent to {email_address}"
     expected_string = expected_string.format(email_address=account_email)
-    if (expected_string in api_return_msg) is False:
+    if not response.succeeded() or expected_string not in str(response.results):
         avx_err_msg = (
             "Fail to create the access account. API actual return message is: "
-            + str(py_dict)
+            + str(response.py_dict)
             + " The string we expect to find is: "
             + expected_string
         )
@@ -829,39 +2395,86 @@ if __name__ == "__main__":
         format="%(asctime)s aviatrix-azure-function--- %(message)s", level=logging.INFO
     )
 
-    hostname = sys.argv[1]
-    ucc_private_ip = sys.argv[2]
-    admin_email = sys.argv[3]
-    new_admin_password = sys.argv[4]
-    arm_subscription_id = sys.argv[5]
-    arm_application_client_id = sys.argv[6]
-    arm_application_client_secret = sys.argv[7]
-    directory_tenant_id = sys.argv[8]
-    account_email = sys.argv[9]
-    access_account_name = sys.argv[10]
-    aviatrix_customer_id = sys.argv[11]
-    controller_version = sys.argv[12]
-
-    event = {
-        "hostname": hostname,
-        "ucc_private_ip": ucc_private_ip,
-        "aviatrix_api_version": "v1",
-        "aviatrix_api_route": "api",
-        "admin_email": admin_email,
-        "new_admin_password": new_admin_password,
-        "controller_init_version": controller_version,
-        "arm_subscription_id": arm_subscription_id,
-        "arm_application_client_id": arm_application_client_id,
-        "arm_application_client_secret": arm_application_client_secret,
-        "directory_tenant_id": directory_tenant_id,
-        "account_email": account_email,
-        "aviatrix_customer_id": aviatrix_customer_id,
-        "access_account_name": access_account_name,
-    }
+    # Legacy invocation: the 12 fields of one event as positional arguments
+    if len(sys.argv) == 13:
+        event = build_event_from_arguments(sys.argv[1:])
 
-    try:
-        function_handler(event)
-    except Exception as e:
-        logging.exception("")
+        try:
+            function_handler(event)
+        except Exception:
+            logging.exception("")
+        else:
+            logging.info("Aviatrix Controller has been initialized successfully")
+        finally:
+            close_aviatrix_session()
+        sys.exit(0)
+
+    # Events as JSON on stdin or in a JSONL manifest, results as JSONL
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Initialize Aviatrix Controllers")
+    parser.add_argument(
+        "manifest",
+        nargs="?",
+        default="-",
+        help='JSON or JSONL file of events, "-" for stdin (default)',
+    )
+    parser.add_argument(
+        "--event-env",
+        help="read one event from this environment variable instead of the manifest, as the Terraform module "
+        + "does; like the 12 positional arguments, a failed initialization is logged and the exit code is 0",
+    )
+    parser.add_argument(
+        "--results",
+        default="-",
+        help='JSONL file the result of every controller is appended to, "-" for stdout (default)',
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=default_fleet_max_concurrency,
+        help="controllers initialized at the same time",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=default_profile_dir,
+        help="write the profile of every run to a directory in this directory",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        default=default_profile_memory,
+        help="add the tracemalloc snapshots of the steps to the profile",
+    )
+    args = parser.parse_args()
+    aviatrix_profiler.default_profile_dir = args.profile_dir
+    aviatrix_profiler.default_profile_memory = args.profile_memory
+
+    start_metrics_server()
+    if args.event_env:
+        if args.event_env not in os.environ:
+            parser.error(args.event_env + " is not set")
+        manifest = io.StringIO(os.environ[args.event_env])
     else:
-        logging.info("Aviatrix Controller has been initialized successfully")
+        manifest = sys.stdin if args.manifest == "-" else open(args.manifest)
+    results = sys.stdout if args.results == "-" else open(args.results, "a")
+
+    def write_result(result):
+        results.write(json.dumps(result) + "\n")
+        results.flush()
+
+    try:
+        failures = function_handler_stream(
+            events=read_events(manifest),
+            max_concurrency=args.max_concurrency,
+            on_result=write_result,
+            initialize=initialize_controller,
+        )
+    finally:
+        close_aviatrix_session()
+        if manifest is not sys.stdin:
+            manifest.close()
+        if results is not sys.stdout:
+            results.close()
+    if failures and not args.event_env:
+        sys.exit(1)
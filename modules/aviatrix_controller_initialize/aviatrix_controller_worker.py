@@ -0,0 +1,556 @@
+import argparse
+import contextvars
+import io
+import json
+import logging
+import os
+import re
+import socket
+import socketserver
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+# Persistent worker of aviatrix_controller_init.py.
+#   serve  : the daemon, keeps the interpreter, the imported modules, the pooled HTTPS session
+#            and the response cache warm, and runs init jobs received over a Unix socket
+#   run    : the thin client, takes the arguments of aviatrix_controller_init.py or a JSON event on
+#            stdin, sends the job to the daemon (started on demand) and prints the log of the job
+#            as it runs
+#   status : prints the state of the daemon
+#   stop   : stops the daemon
+# The client only uses the standard library, so it does not pay the import of requests.
+
+# Unix socket of the daemon, in a directory only accessible by the user running it:
+# $XDG_RUNTIME_DIR, or a per-user directory in the temporary directory
+default_worker_socket = os.environ.get(
+    "AVIATRIX_WORKER_SOCKET",
+    os.path.join(
+        os.environ.get("XDG_RUNTIME_DIR")
+        or os.path.join(tempfile.gettempdir(), "aviatrix_controller_init_%d" % os.getuid()),
+        "aviatrix_controller_init.sock",
+    ),
+)
+# The daemon exits after this many seconds without any job, 0 keeps it running
+default_worker_idle_timeout = int(os.environ.get("AVIATRIX_WORKER_IDLE_TIMEOUT", "600"))
+# Log file of a daemon started by the client
+default_worker_log_file = os.environ.get("AVIATRIX_WORKER_LOG_FILE", os.devnull)
+# Seconds the client waits for a daemon it started to accept connections
+default_worker_start_timeout = 10
+
+# Settings of aviatrix_controller_init.py that apply to one run, by the event key that overrides them.
+# The client sends them with every job, the daemon only reads the other settings when it starts,
+# see get_process_settings().
+job_setting_variables = {
+    "AVIATRIX_INIT_DEADLINE": "deadline",
+    "AVIATRIX_METRICS_FILE": "metrics_file",
+    "AVIATRIX_TRACE_FILE": "trace_file",
+    "AVIATRIX_TRACE_FORMAT": "trace_format",
+    "AVIATRIX_INIT_JOURNAL_DIR": "journal_dir",
+    "AVIATRIX_PROFILE_DIR": "profile_dir",
+    "AVIATRIX_PROFILE_MEMORY": "profile_memory",
+    "AVIATRIX_ENDPOINT_MODE": "endpoint_mode",
+    "AVIATRIX_PREFLIGHT_ARM_CHECK": "preflight_arm_check",
+    "AVIATRIX_ARM_ENDPOINT": "arm_endpoint",
+    "AVIATRIX_ARM_LOGIN_ENDPOINT": "arm_login_endpoint",
+    "AVIATRIX_WAKEUP_HISTORY_FILE": "wakeup_history_file",
+}
+# Variables a daemon started by the client does not inherit: the event of the first job and the
+# credentials of its environment would otherwise stay in the long-lived process
+worker_scrubbed_variable_pattern = re.compile(r"^AVIATRIX_INIT_EVENT$|PASSWORD|SECRET|TOKEN|ACCESS_KEY", re.I)
+
+log_format = "%(asctime)s aviatrix-azure-function--- %(message)s"
+
+_job_writer = contextvars.ContextVar("aviatrix_worker_job_writer", default=None)
+
+
+def build_job(arguments=list(), stream=sys.stdin):
+    # The job of the client: the 12 positional arguments of aviatrix_controller_init.py, or the
+    # JSON event on stream, e.g. piped from the environment of the local-exec. The daemon turns
+    # them into the event with the readers of aviatrix_controller_init.
+    if arguments:
+        return {"arguments": list(arguments)}
+    return {"event": json.load(stream)}
+
+
+# End def build_job()
+
+
+def build_job_event(job):
+    import aviatrix_controller_init
+
+    if "arguments" in job:
+        return aviatrix_controller_init.build_event_from_arguments(job["arguments"])
+    return aviatrix_controller_init.complete_event(job.get("event", dict()))
+
+
+# End def build_job_event()
+
+
+def get_job_settings(environ=os.environ):
+    # The per-run settings of the environment of the client, as event keys
+    settings = dict()
+    for variable, key in job_setting_variables.items():
+        if variable not in environ:
+            continue
+        settings[key] = environ[variable]
+        if key == "preflight_arm_check":
+            settings[key] = environ[variable].lower() != "false"
+    return settings
+
+
+# End def get_job_settings()
+
+
+def get_process_settings(environ=os.environ):
+    # The other AVIATRIX_* settings of the environment, by variable: the daemon only reads them when it
+    # starts, so a job whose settings differ from the ones of the daemon is refused. The AVIATRIX_WORKER_*
+    # settings are only read by the client.
+    return dict(
+        (variable, value)
+        for variable, value in environ.items()
+        if variable.startswith("AVIATRIX_")
+        and not variable.startswith("AVIATRIX_WORKER_")
+        and variable not in job_setting_variables
+        and not worker_scrubbed_variable_pattern.search(variable)
+    )
+
+
+# End def get_process_settings()
+
+
+def get_changed_settings(worker_settings, job_settings):
+    # The variables set differently in the environment of a job than in the one of the daemon
+    return sorted(
+        variable
+        for variable in set(worker_settings) | set(job_settings)
+        if worker_settings.get(variable) != job_settings.get(variable)
+    )
+
+
+# End def get_changed_settings()
+
+
+def get_worker_environment(environ=os.environ):
+    # The environment of a daemon started by the client, without the event and the credentials
+    return dict(
+        (variable, value)
+        for variable, value in environ.items()
+        if not worker_scrubbed_variable_pattern.search(variable)
+    )
+
+
+# End def get_worker_environment()
+
+
+class JobLogHandler(logging.Handler):
+    # Forwards the log records of a job to the client that submitted it.
+    # The steps of a job run in threads started with a copy of the job context,
+    # so the writer of the job is found in the context of every record.
+    def emit(self, record):
+        writer = _job_writer.get()
+        if writer is None:
+            return
+        try:
+            writer({"log": self.format(record)})
+        except Exception:
+            pass
+
+
+# END class JobLogHandler
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, handler_class):
+        # the socket carries passwords and client secrets, keep it private to the user
+        old_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, handler_class)
+        finally:
+            os.umask(old_umask)
+        self.socket_path = socket_path
+        self.start_time = time.time()
+        self.last_activity = time.monotonic()
+        self.active_jobs = 0
+        self.jobs_served = 0
+        self.jobs_failed = 0
+        self.state_lock = threading.Lock()
+        self.process_settings = get_process_settings()
+
+    def job_started(self):
+        with self.state_lock:
+            self.active_jobs += 1
+            self.last_activity = time.monotonic()
+
+    def job_finished(self, success):
+        with self.state_lock:
+            self.active_jobs -= 1
+            self.jobs_served += 1
+            if not success:
+                self.jobs_failed += 1
+            self.last_activity = time.monotonic()
+
+    def get_status(self):
+        with self.state_lock:
+            return {
+                "pid": os.getpid(),
+                "socket": self.socket_path,
+                "uptime": round(time.time() - self.start_time, 3),
+                "active_jobs": self.active_jobs,
+                "jobs_served": self.jobs_served,
+                "jobs_failed": self.jobs_failed,
+            }
+
+
+# END class WorkerServer
+
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+    # One JSON request per connection:
+    #   {"command": "run", "event": {...} | "arguments": [...], "settings": {...}, "process_settings": {...}}
+    #                                       -> {"log": ...} lines, then {"result": {...}}
+    #                                          settings are event keys, the keys of the event win,
+    #                                          process_settings must match the ones of the daemon
+    #   {"command": "status"}               -> {"result": {...}}
+    #   {"command": "stop"}                 -> {"result": {...}}, then the daemon exits
+    def handle(self):
+        write_lock = threading.Lock()
+
+        def write_message(message):
+            data = (json.dumps(message) + "\n").encode("utf-8")
+            with write_lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+
+        try:
+            check_worker_peer(self.request, self.server.socket_path)
+        except (RuntimeError, OSError) as e:
+            logging.error("Rejected a connection to the Aviatrix init worker: %s", str(e))
+            return
+
+        line = self.rfile.readline()
+        # a connection without a request is the liveness check of is_worker_running()
+        if not line.strip():
+            return
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError:
+            write_message({"result": {"success": False, "error": "Invalid request"}})
+            return
+
+        command = request.get("command")
+        if command == "status":
+            write_message({"result": self.server.get_status()})
+        elif command == "stop":
+            write_message({"result": self.server.get_status()})
+            threading.Thread(target=self.server.shutdown).start()
+        elif command == "run":
+            changed_settings = get_changed_settings(
+                self.server.process_settings, request.get("process_settings", self.server.process_settings)
+            )
+            if changed_settings:
+                write_message(
+                    {
+                        "result": {
+                            "success": False,
+                            "error": "The Aviatrix init worker was started with other settings: "
+                            + ", ".join(changed_settings)
+                            + ". Stop it (aviatrix_controller_worker.py stop) to run the job with the settings of "
+                            + "this environment",
+                        }
+                    }
+                )
+                return
+            try:
+                event = dict(request.get("settings", dict()))
+                event.update(build_job_event(request))
+            except Exception as e:
+                write_message({"result": {"success": False, "error": str(e)}})
+                return
+            write_message({"result": self.run_job(event, write_message)})
+        else:
+            write_message({"result": {"success": False, "error": "Unknown command: " + str(command)}})
+
+    def run_job(self, event, write_message):
+        import aviatrix_controller_init
+
+        self.server.job_started()
+        token = _job_writer.set(write_message)
+        start_time = time.monotonic()
+        result = {"hostname": event.get("hostname"), "success": True, "error": ""}
+        try:
+            aviatrix_controller_init.function_handler(event)
+        except Exception as e:
+            logging.error(traceback.format_exc().rstrip())
+            result["success"] = False
+            result["error"] = str(e)
+        else:
+            logging.info("Aviatrix Controller has been initialized successfully")
+        finally:
+            _job_writer.reset(token)
+            result["duration"] = round(time.monotonic() - start_time, 3)
+            self.server.job_finished(result["success"])
+        return result
+
+
+# END class WorkerRequestHandler
+
+
+def watch_idle_timeout(server, idle_timeout=default_worker_idle_timeout):
+    # Stop the daemon once it had no job for idle_timeout seconds
+    while True:
+        time.sleep(min(5, idle_timeout))
+        with server.state_lock:
+            idle = server.active_jobs == 0 and time.monotonic() - server.last_activity >= idle_timeout
+        if idle:
+            logging.info("Aviatrix init worker idle for %d seconds, exiting", idle_timeout)
+            server.shutdown()
+            return
+
+
+# End def watch_idle_timeout()
+
+
+def check_socket_directory(socket_path=default_worker_socket, create=False):
+    # The jobs carry passwords and client secrets: the directory of the socket must belong to
+    # the user and be closed to everyone else, or another user could bind the socket first
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    if create and not os.path.isdir(socket_dir):
+        try:
+            os.makedirs(socket_dir, mode=0o700)
+        except FileExistsError:
+            pass
+    dir_stat = os.lstat(socket_dir)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid():
+        raise RuntimeError("The directory of the Aviatrix init worker socket is not owned by this user: " + socket_dir)
+    if dir_stat.st_mode & 0o077:
+        raise RuntimeError(
+            "The directory of the Aviatrix init worker socket is accessible by other users: "
+            + socket_dir
+            + " (mode "
+            + oct(stat.S_IMODE(dir_stat.st_mode))
+            + ")"
+        )
+
+
+# End def check_socket_directory()
+
+
+def get_peer_uid(connection, socket_path=default_worker_socket):
+    # The user of the process at the other end of a Unix socket connection, from SO_PEERCRED
+    # where the platform has it, else the owner of the socket file
+    if hasattr(socket, "SO_PEERCRED"):
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        pid, uid, gid = struct.unpack("3i", credentials)
+        return uid
+    return os.stat(socket_path).st_uid
+
+
+# End def get_peer_uid()
+
+
+def check_worker_peer(connection, socket_path=default_worker_socket):
+    peer_uid = get_peer_uid(connection, socket_path)
+    if peer_uid != os.getuid():
+        raise RuntimeError(
+            "The Aviatrix init worker socket " + socket_path + " is served by another user (uid " + str(peer_uid) + ")"
+        )
+
+
+# End def check_worker_peer()
+
+
+def is_worker_running(socket_path=default_worker_socket):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+        return True
+    except (OSError, socket.error):
+        return False
+
+
+# End def is_worker_running()
+
+
+def serve(socket_path=default_worker_socket, idle_timeout=default_worker_idle_timeout):
+    check_socket_directory(socket_path, create=True)
+    if is_worker_running(socket_path):
+        raise RuntimeError("An Aviatrix init worker is already listening on " + socket_path)
+    # a socket file left behind by a killed daemon
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    # Import before the first job so that the first job starts warm too
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import aviatrix_controller_init  # noqa: F401
+
+    aviatrix_controller_init.start_metrics_server()
+
+    handler = JobLogHandler()
+    handler.setFormatter(logging.Formatter(log_format))
+    logging.getLogger().addHandler(handler)
+
+    server = WorkerServer(socket_path, WorkerRequestHandler)
+    if idle_timeout > 0:
+        threading.Thread(target=watch_idle_timeout, args=(server, idle_timeout), daemon=True).start()
+    logging.info("Aviatrix init worker %d listening on %s", os.getpid(), socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        logging.getLogger().removeHandler(handler)
+        aviatrix_controller_init.close_aviatrix_session()
+
+
+# End def serve()
+
+
+def start_worker(socket_path=default_worker_socket, idle_timeout=default_worker_idle_timeout,
+                 log_file=default_worker_log_file, start_timeout=default_worker_start_timeout):
+    # Start the daemon in its own session, so that it outlives the local-exec of the first job.
+    # It does not inherit the event and the credentials of the environment of the first job.
+    with open(log_file, "a") as log:
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-W",
+                "ignore",
+                os.path.abspath(__file__),
+                "serve",
+                "--socket",
+                socket_path,
+                "--idle-timeout",
+                str(idle_timeout),
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            env=get_worker_environment(),
+            start_new_session=True,
+        )
+    deadline = time.monotonic() + start_timeout
+    while time.monotonic() < deadline:
+        if is_worker_running(socket_path):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+# End def start_worker()
+
+
+def send_worker_request(request, socket_path=default_worker_socket, on_log=None):
+    # Send one request to the daemon and return its result, on_log is called with every log line
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        check_worker_peer(client, socket_path)
+        client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with client.makefile("rb") as stream:
+            for line in stream:
+                message = json.loads(line.decode("utf-8"))
+                if "log" in message:
+                    if on_log is not None:
+                        on_log(message["log"])
+                elif "result" in message:
+                    return message["result"]
+    raise RuntimeError("The Aviatrix init worker closed the connection without a result")
+
+
+# End def send_worker_request()
+
+
+def run_in_process(job):
+    # Fallback when no daemon can be started, same as running aviatrix_controller_init.py
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import aviatrix_controller_init
+
+    logging.basicConfig(format=log_format, level=logging.INFO)
+    try:
+        return aviatrix_controller_init.initialize_controller(build_job_event(job))
+    finally:
+        aviatrix_controller_init.close_aviatrix_session()
+
+
+# End def run_in_process()
+
+
+def run_job(job, socket_path=default_worker_socket, idle_timeout=default_worker_idle_timeout):
+    # job is {"event": {...}} or {"arguments": [...]}, see build_job()
+    check_socket_directory(socket_path, create=True)
+    if not is_worker_running(socket_path) and not start_worker(
+        socket_path=socket_path, idle_timeout=idle_timeout
+    ):
+        sys.stderr.write("Aviatrix init worker is not available, running in process\n")
+        return run_in_process(job)
+
+    def print_log(line):
+        print(line, flush=True)
+
+    request = dict(job)
+    request.update({"command": "run", "settings": get_job_settings(), "process_settings": get_process_settings()})
+    return send_worker_request(
+        request,
+        socket_path=socket_path,
+        on_log=print_log,
+    )
+
+
+# End def run_job()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Persistent worker of aviatrix_controller_init.py")
+    parser.add_argument("command", choices=["serve", "run", "status", "stop"])
+    parser.add_argument(
+        "arguments",
+        nargs="*",
+        help='run: the 12 arguments of aviatrix_controller_init.py, or "-" to read a JSON event from stdin',
+    )
+    parser.add_argument(
+        "--event-env",
+        help="run: read the JSON event from this environment variable, as the Terraform module does; like the 12 "
+        + "arguments, a failed initialization is logged and the exit code is 0",
+    )
+    parser.add_argument("--socket", default=default_worker_socket)
+    parser.add_argument(
+        "--idle-timeout",
+        type=int,
+        default=default_worker_idle_timeout,
+        help="seconds without a job before the daemon exits, 0 keeps it running",
+    )
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        logging.basicConfig(format=log_format, level=logging.INFO)
+        serve(socket_path=args.socket, idle_timeout=args.idle_timeout)
+    elif args.command == "run":
+        if args.event_env:
+            if args.event_env not in os.environ:
+                parser.error(args.event_env + " is not set")
+            job = build_job(stream=io.StringIO(os.environ[args.event_env]))
+        elif args.arguments in ([], ["-"]):
+            job = build_job(stream=sys.stdin)
+        elif len(args.arguments) == 12:
+            job = build_job(arguments=args.arguments)
+        else:
+            parser.error('run takes the 12 arguments of aviatrix_controller_init.py or "-"')
+        result = run_job(
+            job,
+            socket_path=args.socket,
+            idle_timeout=args.idle_timeout,
+        )
+        if not result["success"] and not args.event_env:
+            sys.exit(1)
+    elif not is_worker_running(args.socket):
+        print(json.dumps({"running": False, "socket": args.socket}))
+    else:
+        print(json.dumps(send_worker_request({"command": args.command}, socket_path=args.socket), indent=2))
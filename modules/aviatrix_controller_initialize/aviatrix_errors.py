@@ -0,0 +1,11 @@
+# Errors of the initialization of a controller, shared by the modules of the init flow
+
+
+class AviatrixException(Exception):
+    # status_code: HTTP status code of the last response of a failed call, -1 without a response
+    def __init__(self, message="Aviatrix Error Message: ...", status_code=-1):
+        super(AviatrixException, self).__init__(message)
+        self.status_code = status_code
+
+
+# END class MyException
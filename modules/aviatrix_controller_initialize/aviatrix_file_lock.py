@@ -0,0 +1,26 @@
+import contextlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the shared files are only locked within the process, see locked_file()
+    fcntl = None
+
+# Locks of the files shared by processes: the metrics file and the wake-up history
+
+_file_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def locked_file(path):
+    # Serialize the writers of a file shared by processes with path.lock,
+    # only within this process where fcntl is missing
+    with _file_lock:
+        with open(path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+# End def locked_file()
@@ -0,0 +1,259 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import json
+import os
+import threading
+
+import aviatrix_session
+from aviatrix_errors import AviatrixException
+from aviatrix_session import configure_aviatrix_session, default_http_pool_connections
+
+# Fleet and stream modes: many controllers initialized concurrently, and the readers of the
+# events of a manifest, see function_handler_stream()
+
+# Number of controllers initialized at the same time in fleet mode
+default_fleet_max_concurrency = int(os.environ.get("AVIATRIX_FLEET_MAX_CONCURRENCY", "10"))
+
+
+def get_initialize_controller(initialize=None):
+    # The function that initializes one controller of a fleet: initialize_controller() of
+    # aviatrix_controller_init unless another one is given. aviatrix_controller_init imports
+    # this module, so it is only imported here when a fleet runs.
+    if initialize is not None:
+        return initialize
+    import aviatrix_controller_init
+
+    return aviatrix_controller_init.initialize_controller
+
+
+# End def get_initialize_controller()
+
+
+async def function_handler_fleet_async(
+    events=list(),
+    max_concurrency=default_fleet_max_concurrency,
+    on_result=None,
+    initialize=None,
+):
+    # Initialize many controllers concurrently.
+    # Every event runs the full function_handler() flow in a worker thread, at most
+    # max_concurrency controllers are initialized at the same time.
+    # on_result(result) is called as soon as each controller finishes, the result is
+    #   {"hostname": ..., "success": True/False, "error": ..., "duration": seconds}
+    # Returns the list of results in the order of completion.
+    # initialize(event) initializes one controller, see get_initialize_controller().
+    initialize = get_initialize_controller(initialize)
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    if aviatrix_session._aviatrix_session is None:
+        configure_aviatrix_session(
+            pool_connections=max(default_http_pool_connections, max_concurrency)
+        )
+
+    async def run_one(event):
+        async with semaphore:
+            return await loop.run_in_executor(executor, initialize, event)
+
+    results = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        tasks = [run_one(event) for event in events]
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+    return results
+
+
+# End def function_handler_fleet_async()
+
+
+def function_handler_fleet(
+    events=list(),
+    max_concurrency=default_fleet_max_concurrency,
+    on_result=None,
+    initialize=None,
+):
+    # Blocking wrapper of function_handler_fleet_async()
+    return asyncio.run(
+        function_handler_fleet_async(
+            events=events,
+            max_concurrency=max_concurrency,
+            on_result=on_result,
+            initialize=initialize,
+        )
+    )
+
+
+# End def function_handler_fleet()
+
+
+def function_handler_stream(
+    events=iter(()),
+    max_concurrency=default_fleet_max_concurrency,
+    on_result=None,
+    initialize=None,
+):
+    # Initialize the controllers of an iterable of events as it is read.
+    # A controller starts as soon as its event is read and a slot is free, at most
+    # max_concurrency controllers are in flight, so a stream of any length is processed
+    # in constant memory. on_result(result) is called as soon as each controller finishes,
+    # see initialize_controller(). Returns the number of controllers that failed.
+    initialize = get_initialize_controller(initialize)
+    failures = [0]
+    result_lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(max_concurrency)
+
+    if aviatrix_session._aviatrix_session is None:
+        configure_aviatrix_session(
+            pool_connections=max(default_http_pool_connections, max_concurrency)
+        )
+
+    def run_one(event):
+        try:
+            result = initialize(event)
+            with result_lock:
+                if not result["success"]:
+                    failures[0] += 1
+                if on_result is not None:
+                    on_result(result)
+        finally:
+            in_flight.release()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for event in events:
+            in_flight.acquire()
+            executor.submit(contextvars.copy_context().run, run_one, event)
+    return failures[0]
+
+
+# End def function_handler_stream()
+
+
+class InvalidRecord(object):
+    # A record of a stream that cannot be read, yielded by the readers in its place so that the
+    # consumer reports it as one failed record and goes on with the next ones
+    def __init__(self, text="", error="", line_number=None):
+        self.text = text
+        self.error = str(error)
+        self.line_number = line_number
+
+    def to_exception(self):
+        location = "" if self.line_number is None else " on line %d" % self.line_number
+        return AviatrixException(message="Invalid record" + location + ": " + self.error + ": " + self.text[:200])
+
+
+# END class InvalidRecord
+
+
+def read_json_records(stream, read_line=json.loads):
+    # Yield the records of a stream one by one: one per line (JSONL), or a single JSON list
+    # or object that may span several lines. Blank lines and lines starting with # are skipped.
+    # A line that is not a JSON object is parsed with read_line, e.g. a plain hostname.
+    # A line that cannot be parsed is yielded as an InvalidRecord, the next lines are still read.
+    # Shared by the event, account and audit target readers.
+    def read_record(line, line_number):
+        try:
+            return json.loads(line) if line.startswith("{") else read_line(line)
+        except ValueError as e:
+            return InvalidRecord(text=line, error=e, line_number=line_number)
+
+    def read_lines(lines, first_line_number):
+        for line_number, line in enumerate(lines, first_line_number):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield read_record(line, line_number)
+
+    first_line = ""
+    first_line_number = 0
+    for first_line_number, line in enumerate(stream, 1):
+        if line.strip() and not line.lstrip().startswith("#"):
+            first_line = line.strip()
+            break
+    if not first_line:
+        return
+    if first_line.startswith("["):
+        text = first_line + "\n" + stream.read()
+        try:
+            records = json.loads(text)
+        except ValueError as e:
+            yield InvalidRecord(text=text, error=e, line_number=first_line_number)
+            return
+        for record in records:
+            yield record
+        return
+    record = read_record(first_line, first_line_number)
+    if isinstance(record, InvalidRecord) and first_line.startswith("{"):
+        # a single object spanning several lines, or an invalid first line of a JSONL stream
+        rest = stream.read()
+        try:
+            yield json.loads(first_line + "\n" + rest)
+            return
+        except ValueError:
+            pass
+        yield record
+        for record in read_lines(rest.splitlines(), first_line_number + 1):
+            yield record
+        return
+    yield record
+    for record in read_lines(stream, first_line_number + 1):
+        yield record
+
+
+# End def read_json_records()
+
+
+def read_events(stream):
+    # Yield the events of a stream (see read_json_records()), missing optional keys get their defaults.
+    # A line that is not an event is yielded as an InvalidRecord.
+    for event in read_json_records(stream):
+        if isinstance(event, InvalidRecord):
+            yield event
+            continue
+        try:
+            yield complete_event(event)
+        except AviatrixException as e:
+            yield InvalidRecord(text=json.dumps(event), error=e)
+
+
+# End def read_events()
+
+
+def complete_event(event):
+    if not isinstance(event, dict):
+        raise AviatrixException(message="An event must be a JSON object, got: " + json.dumps(event))
+    event = dict(event)
+    event.setdefault("aviatrix_api_version", "v1")
+    event.setdefault("aviatrix_api_route", "api")
+    event.setdefault("controller_init_version", "latest")
+    return event
+
+
+# End def complete_event()
+
+
+def build_event_from_arguments(arguments=list()):
+    # The event of the legacy invocation: the 12 fields of one event as positional arguments
+    if len(arguments) != 12:
+        raise AviatrixException(message="The legacy invocation takes 12 arguments, got " + str(len(arguments)))
+    return complete_event(
+        {
+            "hostname": arguments[0],
+            "ucc_private_ip": arguments[1],
+            "admin_email": arguments[2],
+            "new_admin_password": arguments[3],
+            "arm_subscription_id": arguments[4],
+            "arm_application_client_id": arguments[5],
+            "arm_application_client_secret": arguments[6],
+            "directory_tenant_id": arguments[7],
+            "account_email": arguments[8],
+            "access_account_name": arguments[9],
+            "aviatrix_customer_id": arguments[10],
+            "controller_init_version": arguments[11],
+        }
+    )
+
+
+# End def build_event_from_arguments()
@@ -0,0 +1,260 @@
+import argparse
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+import requests
+import urllib3
+
+import aviatrix_account_onboarding
+import aviatrix_controller_init
+
+# Read-only audit of a fleet of controllers.
+# Every controller is probed with calls of the init flow that do not change its state:
+#   reachable   : the API server answers the dummy login of the readiness probe
+#   logged_in   : login with the credentials of the target
+#   initialized : the initial_setup "check" of has_controller_initialized()
+#   version     : list_version_info
+#   accounts    : list_accounts
+# Controllers are probed concurrently, each one within its own time budget, so a sweep takes
+# about as long as the slowest controller instead of the sum of all of them.
+# Targets are read as hostnames, one per line, or as JSON objects (JSONL or a JSON list):
+#   {"hostname": "1.2.3.4", "username": "admin", "password": "..."}
+# A target without a password uses AVIATRIX_CONTROLLER_PASSWORD.
+
+# Number of controllers probed at the same time
+default_audit_max_concurrency = int(os.environ.get("AVIATRIX_AUDIT_MAX_CONCURRENCY", "32"))
+# Time budget of the audit of one controller in seconds
+default_audit_host_timeout = float(os.environ.get("AVIATRIX_AUDIT_HOST_TIMEOUT", "20"))
+
+# Columns of the report, in order
+audit_columns = [
+    "hostname",
+    "reachable",
+    "logged_in",
+    "initialized",
+    "version",
+    "account_count",
+    "accounts",
+    "error",
+    "duration",
+]
+
+
+def read_audit_targets(stream):
+    # Yield the targets of a stream: hostnames or JSON objects, one per line, or a single JSON list.
+    # A line that cannot be read is yielded as an InvalidRecord, audit_fleet() reports it as a failed row.
+    for target in aviatrix_controller_init.read_json_records(stream, read_line=str):
+        if isinstance(target, (dict, aviatrix_controller_init.InvalidRecord)):
+            yield target
+        else:
+            yield {"hostname": str(target)}
+
+
+# End def read_audit_targets()
+
+
+def audit_controller_api(row, api_endpoint_url, username, password, timeout):
+    # Fill the row of one controller, column after column, stops at the first failure
+    is_ready, message = aviatrix_controller_init.probe_controller_api(
+        api_endpoint_url=api_endpoint_url,
+        timeout=min(timeout, aviatrix_controller_init.default_connect_timeout),
+    )
+    if not is_ready:
+        raise aviatrix_controller_init.AviatrixException(message="API server is not ready: " + message)
+    row["reachable"] = True
+
+    CID = aviatrix_controller_init.get_session_cid(
+        api_endpoint_url=api_endpoint_url,
+        username=username,
+        password=password,
+        validate=True,
+    )
+    row["logged_in"] = True
+
+    row["initialized"] = aviatrix_controller_init.has_controller_initialized(
+        api_endpoint_url=api_endpoint_url,
+        CID=CID,
+    )
+
+    response = aviatrix_controller_init.send_authenticated_aviatrix_api(
+        api_endpoint_url=api_endpoint_url,
+        username=username,
+        password=password,
+        payload={"action": "list_version_info"},
+    )
+    if response.return_value is True and isinstance(response.results, dict):
+        row["version"] = str(response.results.get("current_version", "")).replace("UserConnect-", "")
+
+    accounts = sorted(
+        aviatrix_account_onboarding.list_account_names(
+            api_endpoint_url=api_endpoint_url,
+            username=username,
+            password=password,
+        )
+    )
+    row["account_count"] = len(accounts)
+    row["accounts"] = accounts
+
+
+# End def audit_controller_api()
+
+
+def build_audit_row(hostname=None, error=""):
+    row = dict((column, None) for column in audit_columns)
+    row.update({"hostname": hostname, "reachable": False, "logged_in": False, "error": error})
+    return row
+
+
+# End def build_audit_row()
+
+
+def audit_controller(
+    hostname="123.123.123.123",
+    username="admin",
+    password="********",
+    api_version="v1",
+    api_route="api",
+    timeout=default_audit_host_timeout,
+):
+    # Audit one controller, failures are reported in the row instead of raised.
+    # Every wait, retry and request timeout of the audit is capped by the time budget of the host.
+    start_time = time.monotonic()
+    row = build_audit_row(hostname)
+    api_endpoint_url = "https://" + hostname + "/" + api_version + "/" + api_route
+    try:
+        with aviatrix_controller_init.time_budget(timeout):
+            audit_controller_api(row, api_endpoint_url, username, password, timeout)
+    except requests.exceptions.RequestException as e:
+        row["error"] = type(e).__name__ + ": " + str(e)
+    except Exception as e:
+        row["error"] = str(e)
+    finally:
+        row["duration"] = round(time.monotonic() - start_time, 3)
+    return row
+
+
+# End def audit_controller()
+
+
+def audit_fleet(
+    targets=list(),
+    max_concurrency=default_audit_max_concurrency,
+    timeout=default_audit_host_timeout,
+    password="",
+    on_row=None,
+):
+    # Audit the controllers of an iterable of targets, at most max_concurrency at the same time.
+    # on_row(row) is called as soon as each controller is done.
+    # Returns the rows in the order of the targets.
+    # one pool of connections per controller probed at the same time
+    aviatrix_controller_init.configure_aviatrix_session(
+        pool_connections=max(aviatrix_controller_init.default_http_pool_connections, max_concurrency)
+    )
+
+    def run_one(target):
+        if isinstance(target, aviatrix_controller_init.InvalidRecord):
+            row = build_audit_row(error=str(target.to_exception()))
+            row["duration"] = 0.0
+        elif not target.get("hostname"):
+            row = build_audit_row(error="The target has no hostname: " + json.dumps(target))
+            row["duration"] = 0.0
+        else:
+            row = audit_controller(
+                hostname=target["hostname"],
+                username=target.get("username", "admin"),
+                password=target.get("password", password),
+                api_version=target.get("aviatrix_api_version", "v1"),
+                api_route=target.get("aviatrix_api_route", "api"),
+                timeout=float(target.get("timeout", timeout)),
+            )
+        if on_row is not None:
+            on_row(row)
+        return row
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(executor.map(run_one, targets))
+
+
+# End def audit_fleet()
+
+
+def write_audit_report(rows, stream, output_format="json"):
+    # json : one list per column, {"hostname": [...], "reachable": [...], ...}
+    # csv  : one line per controller, the accounts are separated by ";"
+    if output_format == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(audit_columns)
+        for row in rows:
+            writer.writerow(
+                [";".join(row[column]) if column == "accounts" and row[column] else row[column] for column in audit_columns]
+            )
+    else:
+        json.dump(dict((column, [row[column] for row in rows]) for column in audit_columns), stream, indent=2)
+        stream.write("\n")
+
+
+# End def write_audit_report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read-only audit of a fleet of Aviatrix Controllers")
+    parser.add_argument("hostnames", nargs="*", help="public ip or hostname of the controllers")
+    parser.add_argument("--targets", help='file of hostnames or JSON targets, "-" for stdin')
+    parser.add_argument("--output", default="-", help='file of the report, "-" for stdout')
+    parser.add_argument("--format", default="json", choices=["json", "csv"])
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--max-concurrency", type=int, default=default_audit_max_concurrency)
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=default_audit_host_timeout,
+        help="time budget of the audit of one controller in seconds",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s aviatrix-azure-function--- %(message)s", level=logging.INFO)
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    targets = [{"hostname": hostname, "username": args.username} for hostname in args.hostnames]
+    if args.targets:
+        targets_stream = sys.stdin if args.targets == "-" else open(args.targets)
+        try:
+            for target in read_audit_targets(targets_stream):
+                if isinstance(target, dict):
+                    target.setdefault("username", args.username)
+                targets.append(target)
+        finally:
+            if targets_stream is not sys.stdin:
+                targets_stream.close()
+    if not targets:
+        parser.error("no controller to audit, give hostnames or --targets")
+
+    start_time = time.monotonic()
+    try:
+        rows = audit_fleet(
+            targets=targets,
+            max_concurrency=max(args.max_concurrency, 1),
+            timeout=args.timeout,
+            password=os.environ.get("AVIATRIX_CONTROLLER_PASSWORD", ""),
+        )
+    finally:
+        aviatrix_controller_init.close_aviatrix_session()
+
+    output_stream = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    try:
+        write_audit_report(rows, output_stream, output_format=args.format)
+    finally:
+        if output_stream is not sys.stdout:
+            output_stream.close()
+    logging.info(
+        "Audited %d controllers in %.2f seconds: %d reachable, %d initialized",
+        len(rows),
+        time.monotonic() - start_time,
+        sum(1 for row in rows if row["reachable"]),
+        sum(1 for row in rows if row["initialized"]),
+    )
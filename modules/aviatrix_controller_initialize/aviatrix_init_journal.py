@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+import re
+import time
+
+# Resumable initialization: the steps completed by a run are journaled per controller and a
+# re-run skips them, see InitJournal
+
+# Directory of the journals of completed initialization steps, a re-run resumes at the first
+# incomplete step. Journaling is disabled when empty.
+default_journal_dir = os.environ.get("AVIATRIX_INIT_JOURNAL_DIR", "")
+
+
+class InitJournal(object):
+    # Append-only journal of the completed initialization steps of one controller.
+    # Every line of the journal file is a JSON object:
+    #   {"hostname": ..., "ucc_private_ip": ..., "instance_id": ..., "step": 5, "name": ..., "time": ...}
+    # Entries written for another private ip or instance id belong to a previous controller
+    # that had the same public ip and are ignored. The journal is cleared once the
+    # initialization succeeded, it only serves to resume a failed one.
+    # A journal without a directory is disabled and never skips a step.
+    def __init__(self, journal_dir="", hostname="123.123.123.123", ucc_private_ip="", instance_id=""):
+        self.hostname = hostname
+        self.ucc_private_ip = ucc_private_ip
+        self.instance_id = instance_id
+        self.completed_steps = set()
+        self.path = None
+        if not journal_dir:
+            return
+
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        file_name = re.sub(r"[^A-Za-z0-9_.-]", "_", hostname) + ".jsonl"
+        self.path = os.path.join(journal_dir, file_name)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partially written last line from an interrupted run
+                    continue
+                if (
+                    entry.get("ucc_private_ip") == self.ucc_private_ip
+                    and entry.get("instance_id", "") == self.instance_id
+                ):
+                    self.completed_steps.add(entry["step"])
+        if self.completed_steps:
+            logging.info(
+                "Journal %s: steps %s have already been completed",
+                self.path,
+                str(sorted(self.completed_steps)),
+            )
+
+    def is_completed(self, step):
+        return step in self.completed_steps
+
+    def record(self, step, name=""):
+        self.completed_steps.add(step)
+        if self.path is None:
+            return
+        entry = {
+            "hostname": self.hostname,
+            "ucc_private_ip": self.ucc_private_ip,
+            "instance_id": self.instance_id,
+            "step": step,
+            "name": name,
+            "time": time.time(),
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        self.completed_steps = set()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# END class InitJournal
@@ -0,0 +1,237 @@
+import http.server
+import json
+import logging
+import os
+import threading
+
+from aviatrix_file_lock import locked_file
+
+# Counters and histograms of the runs, the API calls and the readiness waits, exported in the
+# Prometheus text format, see AviatrixMetrics
+
+# Prometheus metrics of all runs: a text file for the node exporter textfile collector, updated
+# after every run and accumulated across processes, and/or a local HTTP endpoint (0 disables it)
+default_metrics_file = os.environ.get("AVIATRIX_METRICS_FILE", "")
+default_metrics_port = int(os.environ.get("AVIATRIX_METRICS_PORT", "0"))
+
+# name: (type, help, histogram buckets)
+metric_definitions = {
+    "aviatrix_init_duration_seconds": (
+        "histogram",
+        "Duration of the initialization of a controller",
+        [60, 120, 300, 600, 900, 1200, 1800, 3600],
+    ),
+    "aviatrix_api_server_wait_seconds": (
+        "histogram",
+        "Time until the API server of a controller woke up",
+        [1, 5, 10, 30, 60, 120, 300, 600, 900],
+    ),
+    "aviatrix_upgrade_duration_seconds": (
+        "histogram",
+        "Duration of the initial setup upgrade",
+        [30, 60, 120, 300, 600, 900, 1200, 1800],
+    ),
+    "aviatrix_api_request_duration_seconds": (
+        "histogram",
+        "Latency of each attempt of an API call",
+        [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120],
+    ),
+    "aviatrix_api_retries_total": ("counter", "Retried API call attempts", None),
+    "aviatrix_api_backend_not_ready_total": (
+        "counter",
+        "Responses of an API server whose backend is not ready",
+        None,
+    ),
+}
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+class AviatrixMetrics(object):
+    # Counters and histograms of all runs of this process, see metric_definitions.
+    # Every sample is kept twice: since the start of the process, served by the HTTP
+    # endpoint, and since the last write_text_file(), merged into the text file so that
+    # the file accumulates the runs of every process that writes it.
+    def __init__(self, definitions=metric_definitions):
+        self.definitions = definitions
+        self.samples = dict()
+        self.unwritten_samples = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            for samples in (self.samples, self.unwritten_samples):
+                samples[key] = samples.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.definitions[name][2]
+        with self.lock:
+            for samples in (self.samples, self.unwritten_samples):
+                histogram = samples.get(key)
+                if histogram is None:
+                    histogram = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+                    samples[key] = histogram
+                merge_histogram(histogram, value=value, buckets=buckets)
+
+    def to_text(self, samples=None):
+        # Prometheus text exposition format
+        if samples is None:
+            with self.lock:
+                samples = samples_from_list(samples_to_list(self.samples))
+
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(
+                '%s="%s"' % (label, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for label, value in pairs
+            ) + "}"
+
+        lines = list()
+        for name, (metric_type, help_text, buckets) in sorted(self.definitions.items()):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+            for key in sorted(key for key in samples if key[0] == name):
+                labels = key[1]
+                value = samples[key]
+                if metric_type == "counter":
+                    lines.append(name + format_labels(labels) + " " + repr(float(value)))
+                    continue
+                for bucket, count in zip(buckets, value["buckets"]):
+                    lines.append(
+                        name + "_bucket" + format_labels(labels, [("le", repr(float(bucket)))]) + " " + str(count)
+                    )
+                lines.append(name + "_bucket" + format_labels(labels, [("le", "+Inf")]) + " " + str(value["count"]))
+                lines.append(name + "_sum" + format_labels(labels) + " " + repr(float(value["sum"])))
+                lines.append(name + "_count" + format_labels(labels) + " " + str(value["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write_text_file(self, path=default_metrics_file):
+        # Merge the samples since the last write into the state kept next to the text file,
+        # and rewrite the text file atomically. Concurrent writers are serialized with a lock file.
+        with self.lock:
+            unwritten_samples = self.unwritten_samples
+            self.unwritten_samples = dict()
+        state_path = path + ".state.json"
+        with locked_file(path):
+            try:
+                with open(state_path) as f:
+                    samples = samples_from_list(json.load(f))
+            except (IOError, ValueError):
+                samples = dict()
+            for key, value in unwritten_samples.items():
+                if isinstance(value, dict):
+                    histogram = samples.get(key)
+                    if histogram is None:
+                        samples[key] = value
+                    else:
+                        merge_histogram(histogram, other=value)
+                else:
+                    samples[key] = samples.get(key, 0) + value
+            for target, content in [
+                (state_path, json.dumps(samples_to_list(samples))),
+                (path, self.to_text(samples)),
+            ]:
+                with open(target + ".tmp", "w") as f:
+                    f.write(content)
+                os.replace(target + ".tmp", target)
+
+
+# END class AviatrixMetrics
+
+
+def merge_histogram(histogram, value=None, buckets=None, other=None):
+    # Add one observation, or the counts of another histogram, to a histogram
+    if other is not None:
+        histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+        histogram["sum"] += other["sum"]
+        histogram["count"] += other["count"]
+        return
+    for i, bucket in enumerate(buckets):
+        if value <= bucket:
+            histogram["buckets"][i] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+
+# End def merge_histogram()
+
+
+def samples_to_list(samples):
+    return [[name, [list(label) for label in labels], value] for (name, labels), value in samples.items()]
+
+
+# End def samples_to_list()
+
+
+def samples_from_list(samples):
+    # copies the histograms, so that the result can be used without holding the lock of the registry
+    return dict(
+        (
+            (name, tuple(tuple(label) for label in labels)),
+            dict(value, buckets=list(value["buckets"])) if isinstance(value, dict) else value,
+        )
+        for name, labels, value in samples
+    )
+
+
+# End def samples_from_list()
+
+
+def get_metrics():
+    global _metrics
+
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = AviatrixMetrics()
+        return _metrics
+
+
+# End def get_metrics()
+
+
+def write_metrics_file(path=default_metrics_file):
+    if not path:
+        return
+    try:
+        get_metrics().write_text_file(path)
+    except (IOError, OSError) as e:
+        logging.warning("Failed to write the metrics to %s: %s", path, str(e))
+
+
+# End def write_metrics_file()
+
+
+def start_metrics_server(port=default_metrics_port, host="127.0.0.1"):
+    # Serve the metrics of this process on http://host:port/metrics in a daemon thread,
+    # used by the long-running modes (stream, fleet and the persistent worker)
+    if not port:
+        return None
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = get_metrics().to_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Metrics are served on http://%s:%d/metrics", host, server.server_address[1])
+    return server
+
+
+# End def start_metrics_server()
@@ -0,0 +1,228 @@
+import contextlib
+import contextvars
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+
+# Profiles of the runs: cProfile stats, wall and CPU time per section and optional tracemalloc
+# snapshots, written to a directory per run, see profile_run()
+
+# Write a profile of every run (cProfile stats, wall and CPU time per step) to a directory per run
+# in this directory, and optionally the tracemalloc snapshots of the steps
+default_profile_dir = os.environ.get("AVIATRIX_PROFILE_DIR", "")
+default_profile_memory = os.environ.get("AVIATRIX_PROFILE_MEMORY", "false").lower() == "true"
+# Categories of the own time of the profiled functions, by "file:function"
+profile_category_patterns = [
+    ("tls", re.compile(r"ssl")),
+    ("json", re.compile(r"json")),
+    ("logging", re.compile(r"logging")),
+    ("sleep_and_wait", re.compile(r"time\.sleep|acquire|threading\.py:wait|select|poll")),
+    ("http", re.compile(r"urllib3|requests|http.client|socket")),
+]
+
+_current_profiler = contextvars.ContextVar("aviatrix_profiler", default=None)
+
+
+class AviatrixProfiler(object):
+    # Profile of one initialization run, written to its own directory:
+    #   sections.json         : calls, wall time, CPU time and wait time (wall - CPU) of every
+    #                           step, send_aviatrix_api() and readiness wait
+    #   step<N>.prof          : cProfile stats of every step, readable with pstats or snakeviz
+    #   run.prof / run.txt    : the stats of all steps together, and their top functions
+    #   categories.json       : own time of the profiled functions per category (TLS, HTTP,
+    #                           JSON, logging, sleeping and waiting)
+    #   step<N>.tracemalloc   : tracemalloc snapshot at the end of every step (profile_memory)
+    #   memory.txt            : the lines that allocated the most memory during the run
+    # CPU time is the CPU time of the thread, so the steps running in parallel are told apart.
+    # cProfile and tracemalloc are process wide: in fleet mode the stats of the controllers
+    # running at the same time are mixed.
+    def __init__(self, run_dir, trace_memory=False):
+        self.run_dir = run_dir
+        self.trace_memory = trace_memory
+        self.sections = dict()
+        self.profile_files = list()
+        self.lock = threading.Lock()
+        self.started_tracemalloc = False
+        self.start_wall_time = time.perf_counter()
+        self.start_cpu_time = time.process_time()
+
+    def start(self):
+        os.makedirs(self.run_dir, exist_ok=True)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            # one frame per allocation, every additional frame multiplies the overhead
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    def record_section(self, name, wall_time, cpu_time):
+        with self.lock:
+            section = self.sections.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+            section["calls"] += 1
+            section["wall_s"] += wall_time
+            section["cpu_s"] += cpu_time
+
+    def get_file_name(self, name):
+        return os.path.join(self.run_dir, re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_"))
+
+    def save_profile(self, name, profile):
+        file_name = self.get_file_name(name) + ".prof"
+        profile.dump_stats(file_name)
+        with self.lock:
+            self.profile_files.append(file_name)
+
+    def save_memory_snapshot(self, name):
+        if tracemalloc.is_tracing():
+            tracemalloc.take_snapshot().dump(self.get_file_name(name) + ".tracemalloc")
+
+    def stop(self):
+        # the memory of the run, before the stats below allocate theirs
+        if self.started_tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(self.get_file_name("run") + ".tracemalloc")
+            snapshot = snapshot.filter_traces(
+                [tracemalloc.Filter(False, pstats.__file__), tracemalloc.Filter(False, cProfile.__file__)]
+            )
+            with open(os.path.join(self.run_dir, "memory.txt"), "w") as f:
+                for statistic in snapshot.statistics("lineno")[:40]:
+                    f.write(str(statistic) + "\n")
+
+        # the CPU time of the whole run is the CPU time of the process
+        self.sections["run"] = {
+            "calls": 1,
+            "wall_s": time.perf_counter() - self.start_wall_time,
+            "cpu_s": time.process_time() - self.start_cpu_time,
+        }
+        sections = list()
+        for name, section in sorted(self.sections.items()):
+            section = dict(section, name=name)
+            section["wait_s"] = max(section["wall_s"] - section["cpu_s"], 0.0)
+            sections.append(section)
+        with open(os.path.join(self.run_dir, "sections.json"), "w") as f:
+            json.dump(sections, f, indent=2)
+
+        if self.profile_files:
+            stats = pstats.Stats(self.profile_files[0])
+            for file_name in self.profile_files[1:]:
+                stats.add(file_name)
+            stats.dump_stats(os.path.join(self.run_dir, "run.prof"))
+            with open(os.path.join(self.run_dir, "run.txt"), "w") as f:
+                stats.stream = f
+                stats.sort_stats("cumulative").print_stats(40)
+                stats.sort_stats("tottime").print_stats(40)
+            with open(os.path.join(self.run_dir, "categories.json"), "w") as f:
+                json.dump(get_profile_categories(stats), f, indent=2)
+
+        logging.info("Profile of the run written to %s", self.run_dir)
+
+
+# END class AviatrixProfiler
+
+
+def get_profile_categories(stats):
+    # Own time of the profiled functions per category, the first matching pattern wins
+    categories = dict((name, 0.0) for name, pattern in profile_category_patterns)
+    categories["other"] = 0.0
+    for (file_name, line, function_name), (cc, nc, tottime, cumtime, callers) in stats.stats.items():
+        location = file_name + ":" + function_name
+        for name, pattern in profile_category_patterns:
+            if pattern.search(location):
+                categories[name] += tottime
+                break
+        else:
+            categories["other"] += tottime
+    return dict((name, round(seconds, 6)) for name, seconds in categories.items())
+
+
+# End def get_profile_categories()
+
+
+@contextlib.contextmanager
+def profile_run(event):
+    # Profile the enclosed initialization run when a profile directory is configured
+    # (event["profile_dir"] or AVIATRIX_PROFILE_DIR), one directory per run
+    profile_dir = event.get("profile_dir", default_profile_dir)
+    if not profile_dir:
+        yield None
+        return
+    run_dir = os.path.join(
+        profile_dir,
+        "%s-%s-%d"
+        % (
+            event.get("hostname", "controller").replace(":", "_"),
+            time.strftime("%Y%m%dT%H%M%S"),
+            os.getpid(),
+        ),
+    )
+    trace_memory = str(event.get("profile_memory", default_profile_memory)).lower() == "true"
+    profiler = AviatrixProfiler(run_dir, trace_memory=trace_memory)
+    profiler.start()
+    token = _current_profiler.set(profiler)
+    try:
+        yield profiler
+    finally:
+        _current_profiler.reset(token)
+        try:
+            profiler.stop()
+        except Exception:
+            logging.exception("Failed to write the profile of the run to %s", run_dir)
+
+
+# End def profile_run()
+
+
+@contextlib.contextmanager
+def profile_section(name, cprofile=False):
+    # Record the wall and CPU time of the enclosed block in the profile of the run,
+    # cprofile also collects the cProfile stats of the block (and its memory snapshot)
+    profiler = _current_profiler.get()
+    if profiler is None:
+        yield
+        return
+    profile = None
+    if cprofile:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active, e.g. a step running at the same time on Python 3.12+
+            profile = None
+    start_wall_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+        profiler.record_section(name, time.perf_counter() - start_wall_time, time.thread_time() - start_cpu_time)
+        if profile is not None:
+            profiler.save_profile(name, profile)
+        if cprofile:
+            profiler.save_memory_snapshot(name)
+
+
+# End def profile_section()
+
+
+def profiled(name):
+    # Decorator recording every call of a function as a section of the profile of the run
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _current_profiler.get() is None:
+                return function(*args, **kwargs)
+            with profile_section(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# End def profiled()
@@ -0,0 +1,289 @@
+import email.utils
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+
+from aviatrix_errors import AviatrixException
+
+# Retries of the API calls and the circuit breakers of the controllers, see RetryPolicy and CircuitBreaker
+
+# Retries of send_aviatrix_api(), see RetryPolicy
+default_retry_max_attempts = int(os.environ.get("AVIATRIX_RETRY_MAX_ATTEMPTS", "5"))
+default_retry_base_delay = float(os.environ.get("AVIATRIX_RETRY_BASE_DELAY", "1"))
+default_retry_max_delay = float(os.environ.get("AVIATRIX_RETRY_MAX_DELAY", "30"))
+default_connect_timeout = float(os.environ.get("AVIATRIX_CONNECT_TIMEOUT", "10"))
+default_read_timeout = float(os.environ.get("AVIATRIX_READ_TIMEOUT", "120"))
+
+# (action, subaction) pairs that must not be sent twice blindly, a timed out or failed
+# attempt may still have been processed by the controller
+non_idempotent_api_actions = {
+    ("initial_setup", "run"),
+    ("setup_account_profile", None),
+    ("edit_account_user", None),
+    ("change_password", None),
+}
+
+# A controller that failed this many calls in a row is not called for the reset timeout,
+# 0 disables the circuit breaker
+default_circuit_breaker_threshold = int(os.environ.get("AVIATRIX_CIRCUIT_BREAKER_THRESHOLD", "3"))
+default_circuit_breaker_reset_timeout = float(os.environ.get("AVIATRIX_CIRCUIT_BREAKER_RESET_TIMEOUT", "30"))
+
+_retry_policy = None
+
+_circuit_breakers = dict()
+_circuit_breakers_lock = threading.Lock()
+
+
+class CircuitBreakerOpenException(AviatrixException):
+    # The call was not sent, the circuit breaker of the controller is open
+    pass
+
+
+# END class CircuitBreakerOpenException
+
+
+class RetryPolicy(object):
+    # How send_aviatrix_api() retries a failed attempt.
+    # Every attempt is classified as:
+    #   success        : status code 200
+    #   retryable      : connection errors, timeouts of idempotent calls, 408, 429 and 5xx
+    #   retryable-once : timeouts, dropped connections and 5xx of non-idempotent calls, which
+    #                    may have been processed already, are retried only after the first attempt
+    #   fatal          : other status codes (e.g. 404) and local errors, never retried
+    # Retries wait with full jitter, random(0, min(max_delay, base_delay * 2 ^ attempt)),
+    # or as long as the Retry-After header of the response asks for, capped at max_delay.
+    # classify_call() classifies a whole call, for the callers that send it again on a longer budget.
+    # Subclasses can override classify(), classify_call() and get_delay(), see configure_retry_policy().
+    SUCCESS = "success"
+    RETRYABLE = "retryable"
+    RETRYABLE_ONCE = "retryable-once"
+    FATAL = "fatal"
+
+    def __init__(
+        self,
+        max_attempts=default_retry_max_attempts,
+        base_delay=default_retry_base_delay,
+        max_delay=default_retry_max_delay,
+        connect_timeout=default_connect_timeout,
+        read_timeout=default_read_timeout,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def is_idempotent(self, request_type, payload=dict()):
+        if request_type == "GET":
+            return True
+        return (payload.get("action"), payload.get("subaction")) not in non_idempotent_api_actions
+
+    def classify(self, request_type, payload=dict(), response=None, error=None):
+        idempotent = self.is_idempotent(request_type, payload)
+        if error is not None:
+            # the request never reached the controller
+            if isinstance(error, requests.exceptions.ConnectTimeout):
+                return self.RETRYABLE
+            if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+                return self.RETRYABLE if idempotent else self.RETRYABLE_ONCE
+            return self.FATAL
+        status_code = response.status_code
+        if status_code == 200:
+            return self.SUCCESS
+        if status_code in (429, 503):
+            return self.RETRYABLE
+        if status_code == 408 or status_code >= 500:
+            return self.RETRYABLE if idempotent else self.RETRYABLE_ONCE
+        return self.FATAL
+
+    def classify_call(self, request_type, payload=dict(), response=None, error=None):
+        # Classify the AviatrixResponse of a send_aviatrix_api() call, or the AviatrixException it raised:
+        #   retryable : the controller refused the call without processing it ("RequestRefused" or a
+        #               refused connection), or an idempotent call got no response
+        #   success   : any other response, the caller checks it
+        #   fatal     : any other error
+        if error is not None:
+            cause = getattr(error, "__cause__", None)
+            if is_connection_refused(cause):
+                return self.RETRYABLE
+            if is_transport_error(error) and self.is_idempotent(request_type, payload):
+                return self.RETRYABLE
+            return self.FATAL
+        if response.error_kind() == "not_ready" and "RequestRefused" in response.reason:
+            return self.RETRYABLE
+        return self.SUCCESS
+
+    def get_delay(self, attempt, response=None):
+        retry_after = None
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * pow(2, attempt)))
+
+    def get_timeout(self, read_timeout=None, remaining_time=None):
+        # (connect, read) timeout of one attempt, never longer than the remaining time budget
+        connect_timeout = self.connect_timeout
+        if read_timeout is None:
+            read_timeout = self.read_timeout
+        if remaining_time is not None:
+            connect_timeout = min(connect_timeout, remaining_time)
+            read_timeout = min(read_timeout, remaining_time)
+        return (connect_timeout, read_timeout)
+
+
+# END class RetryPolicy
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_time is None:
+        return None
+    return max(0.0, retry_time.timestamp() - time.time())
+
+
+# End def parse_retry_after()
+
+
+def configure_retry_policy(retry_policy=None):
+    # Replace the retry policy of send_aviatrix_api(), None restores the default policy
+    global _retry_policy
+
+    _retry_policy = retry_policy
+    return get_retry_policy()
+
+
+# End def configure_retry_policy()
+
+
+def get_retry_policy():
+    global _retry_policy
+
+    if _retry_policy is None:
+        _retry_policy = RetryPolicy()
+    return _retry_policy
+
+
+# End def get_retry_policy()
+
+
+class CircuitBreaker(object):
+    # Circuit breaker of one controller.
+    # After failure_threshold consecutive failed calls the circuit opens and calls fail
+    # immediately for reset_timeout seconds. Then a single trial call is let through
+    # (half open): its success closes the circuit, its failure opens it again.
+    def __init__(
+        self,
+        failure_threshold=default_circuit_breaker_threshold,
+        reset_timeout=default_circuit_breaker_reset_timeout,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.open_until = None
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        if self.failure_threshold <= 0:
+            return True
+        with self.lock:
+            if self.open_until is None:
+                return True
+            if time.monotonic() < self.open_until or self.trial_in_progress:
+                return False
+            self.trial_in_progress = True
+            return True
+
+    def get_retry_time(self):
+        with self.lock:
+            if self.open_until is None:
+                return 0
+            return max(0, self.open_until - time.monotonic())
+
+    def release_trial(self):
+        # The trial call ended without telling anything about the controller,
+        # e.g. the time budget ran out, let the next call be the trial
+        with self.lock:
+            self.trial_in_progress = False
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.open_until = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.trial_in_progress = False
+            if self.failure_threshold > 0 and self.consecutive_failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.reset_timeout
+
+
+# END class CircuitBreaker
+
+
+def get_circuit_breaker(api_endpoint_url="https://123.123.123.123/v1/api"):
+    # One circuit breaker per controller (host and port)
+    netloc = urlparse(api_endpoint_url).netloc
+    with _circuit_breakers_lock:
+        circuit_breaker = _circuit_breakers.get(netloc)
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker()
+            _circuit_breakers[netloc] = circuit_breaker
+        return circuit_breaker
+
+
+# End def get_circuit_breaker()
+
+
+def configure_circuit_breaker(api_endpoint_url="https://123.123.123.123/v1/api", circuit_breaker=None):
+    # Replace the circuit breaker of one controller, None restores the default one
+    netloc = urlparse(api_endpoint_url).netloc
+    with _circuit_breakers_lock:
+        _circuit_breakers.pop(netloc, None)
+        if circuit_breaker is not None:
+            _circuit_breakers[netloc] = circuit_breaker
+    return get_circuit_breaker(api_endpoint_url)
+
+
+# End def configure_circuit_breaker()
+
+
+def is_transport_error(error=None):
+    # The call got no response: it timed out, or the connection was refused, reset or dropped
+    return isinstance(error, requests.exceptions.RequestException) or isinstance(
+        getattr(error, "__cause__", None), requests.exceptions.RequestException
+    )
+
+
+# End def is_transport_error()
+
+
+def is_connection_refused(error=None):
+    # The request never reached the controller: the connection was refused or could not be set up in time
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError) or not error.args:
+        return False
+    reason = getattr(error.args[0], "reason", None)
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+# End def is_connection_refused()
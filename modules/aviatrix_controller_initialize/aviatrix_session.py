@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from aviatrix_cassette import (
+    RecordingHTTPAdapter,
+    ReplayHTTPAdapter,
+    default_cassette_file,
+    default_cassette_mode,
+    default_cassette_speed,
+)
+
+# The shared HTTPS session of every call to a controller, see configure_aviatrix_session()
+
+# Connection pool settings of the shared HTTPS session, can be overridden by environment variables
+default_http_pool_connections = int(os.environ.get("AVIATRIX_HTTP_POOL_CONNECTIONS", "10"))
+default_http_pool_maxsize = int(os.environ.get("AVIATRIX_HTTP_POOL_MAXSIZE", "10"))
+default_http_keep_alive = os.environ.get("AVIATRIX_HTTP_KEEP_ALIVE", "true").lower() != "false"
+
+_aviatrix_session = None
+_aviatrix_session_lock = threading.Lock()
+
+
+def configure_aviatrix_session(
+    pool_connections=default_http_pool_connections,
+    pool_maxsize=default_http_pool_maxsize,
+    keep_alive=default_http_keep_alive,
+    cassette_mode=default_cassette_mode,
+    cassette_file=default_cassette_file,
+    cassette_speed=default_cassette_speed,
+):
+    # Build the shared HTTPS session used for every call to the controller.
+    # The session keeps the TCP connection and the TLS session of each controller
+    # alive between calls, so that only the first call pays the TCP and TLS handshake.
+    #   pool_connections : number of controllers (hosts) to keep a connection pool for
+    #   pool_maxsize     : number of connections kept alive per controller
+    #   keep_alive       : False sends "Connection: close" and forces a new handshake per call
+    #   cassette_mode    : "record" writes every exchange to cassette_file when the session
+    #                      is closed, "replay" serves the exchanges of cassette_file at
+    #                      cassette_speed instead of calling the controller
+    global _aviatrix_session
+
+    session = requests.Session()
+    if cassette_mode == "replay":
+        adapter = ReplayHTTPAdapter(cassette_file=cassette_file, speed=cassette_speed)
+    elif cassette_mode == "record":
+        adapter = RecordingHTTPAdapter(
+            cassette_file=cassette_file,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=0,
+        )
+    else:
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=0,
+        )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+
+    with _aviatrix_session_lock:
+        old_session = _aviatrix_session
+        _aviatrix_session = session
+    if old_session is not None:
+        old_session.close()
+
+    logging.info(
+        "HTTPS session configured: pool_connections=%d, pool_maxsize=%d, keep_alive=%s",
+        pool_connections,
+        pool_maxsize,
+        str(keep_alive),
+    )
+    return session
+
+
+# End def configure_aviatrix_session()
+
+
+def get_aviatrix_session():
+    # Return the shared HTTPS session, build it with the default settings on first use
+    session = _aviatrix_session
+    if session is None:
+        session = configure_aviatrix_session()
+    return session
+
+
+# End def get_aviatrix_session()
+
+
+def close_aviatrix_session():
+    # Close all pooled connections of the shared HTTPS session
+    global _aviatrix_session
+
+    with _aviatrix_session_lock:
+        old_session = _aviatrix_session
+        _aviatrix_session = None
+    if old_session is not None:
+        old_session.close()
+
+
+# End def close_aviatrix_session()
+
+
+def is_replaying_cassette():
+    session = get_aviatrix_session()
+    return isinstance(session.get_adapter("https://"), ReplayHTTPAdapter)
+
+
+# End def is_replaying_cassette()
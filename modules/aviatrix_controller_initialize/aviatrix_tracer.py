@@ -0,0 +1,210 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+# Spans of the steps, HTTP calls and readiness probes of a run, written as a timeline per run.
+# The tracer and the current span are context variables, so that concurrent runs of a fleet
+# each record their own timeline.
+
+# Write a timeline of the spans of every run to this file, "{hostname}" is replaced by the controller.
+# Without it, in fleet mode the address of the controller and the time are added to the file name.
+default_trace_file = os.environ.get("AVIATRIX_TRACE_FILE", "")
+# "json" for the plain timeline, "otlp" for OTLP-compatible JSON
+default_trace_format = os.environ.get("AVIATRIX_TRACE_FORMAT", "json")
+
+_current_tracer = contextvars.ContextVar("aviatrix_tracer", default=None)
+_current_span = contextvars.ContextVar("aviatrix_span", default=None)
+
+
+class AviatrixTracer(object):
+    # Collects timing spans of one initialization run.
+    # Spans are kept in memory and written out by write_timeline() as a plain JSON
+    # timeline or as OTLP-compatible JSON (ExportTraceServiceRequest).
+    def __init__(self, run_name="aviatrix-controller-init"):
+        self.run_name = run_name
+        self.trace_id = os.urandom(16).hex()
+        self.spans = list()
+        self.lock = threading.Lock()
+
+    def start_span(self, name, parent=None, attributes=None):
+        span = {
+            "name": name,
+            "trace_id": self.trace_id,
+            "span_id": os.urandom(8).hex(),
+            "parent_span_id": parent["span_id"] if parent else "",
+            "start_time_unix_nano": time.time_ns(),
+            "start_monotonic": time.monotonic(),
+            "end_time_unix_nano": None,
+            "duration_ms": None,
+            "attributes": dict(attributes or {}),
+            "status": "unset",
+            "status_message": "",
+        }
+        return span
+
+    def end_span(self, span, error=None, attributes=None):
+        duration = time.monotonic() - span.pop("start_monotonic")
+        span["end_time_unix_nano"] = span["start_time_unix_nano"] + int(duration * 1e9)
+        span["duration_ms"] = round(duration * 1000, 3)
+        if attributes:
+            span["attributes"].update(attributes)
+        if error is not None:
+            span["status"] = "error"
+            span["status_message"] = str(error)
+        else:
+            span["status"] = "ok"
+        with self.lock:
+            self.spans.append(span)
+
+    def to_timeline(self):
+        spans = sorted(self.spans, key=lambda span: span["start_time_unix_nano"])
+        return {"run_name": self.run_name, "trace_id": self.trace_id, "spans": spans}
+
+    def to_otlp(self):
+        def to_otlp_value(value):
+            if isinstance(value, bool):
+                return {"boolValue": value}
+            if isinstance(value, int):
+                return {"intValue": str(value)}
+            if isinstance(value, float):
+                return {"doubleValue": value}
+            return {"stringValue": str(value)}
+
+        otlp_spans = list()
+        for span in sorted(self.spans, key=lambda span: span["start_time_unix_nano"]):
+            otlp_spans.append(
+                {
+                    "traceId": span["trace_id"],
+                    "spanId": span["span_id"],
+                    "parentSpanId": span["parent_span_id"],
+                    "name": span["name"],
+                    "kind": 3 if span["attributes"].get("kind") == "http" else 1,
+                    "startTimeUnixNano": str(span["start_time_unix_nano"]),
+                    "endTimeUnixNano": str(span["end_time_unix_nano"]),
+                    "attributes": [
+                        {"key": key, "value": to_otlp_value(value)}
+                        for key, value in sorted(span["attributes"].items())
+                    ],
+                    "status": {
+                        "code": 2 if span["status"] == "error" else 1,
+                        "message": span["status_message"],
+                    },
+                }
+            )
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": {"stringValue": self.run_name}}
+                        ]
+                    },
+                    "scopeSpans": [
+                        {"scope": {"name": "aviatrix_controller_init"}, "spans": otlp_spans}
+                    ],
+                }
+            ]
+        }
+
+    def write_timeline(self, path, trace_format="json"):
+        py_dict = self.to_otlp() if trace_format == "otlp" else self.to_timeline()
+        with open(path, "w") as f:
+            json.dump(py_dict, f, indent=2)
+        logging.info("Run timeline has been written to %s", path)
+
+
+# END class AviatrixTracer
+
+
+def start_trace_span(name, **attributes):
+    # Start a span under the current span of the active tracer.
+    # Returns None when tracing is not enabled for this run.
+    tracer = _current_tracer.get()
+    if tracer is None:
+        return None
+    span = tracer.start_span(
+        name=name, parent=_current_span.get(), attributes=attributes
+    )
+    return span
+
+
+# End def start_trace_span()
+
+
+def end_trace_span(span, error=None, **attributes):
+    tracer = _current_tracer.get()
+    if span is None or tracer is None:
+        return
+    tracer.end_span(span, error=error, attributes=attributes)
+
+
+# End def end_trace_span()
+
+
+@contextlib.contextmanager
+def trace_span(name, **attributes):
+    # Record the enclosed block as a span, nested spans become its children
+    span = start_trace_span(name, **attributes)
+    if span is None:
+        yield None
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        end_trace_span(span, error=e)
+        raise
+    else:
+        end_trace_span(span)
+    finally:
+        _current_span.reset(token)
+
+
+# End def trace_span()
+
+
+@contextlib.contextmanager
+def trace_run(event, fleet_run=False):
+    # When a trace file is configured (event["trace_file"] or AVIATRIX_TRACE_FILE), every step,
+    # HTTP call and readiness probe of the enclosed run is recorded as a span and the run
+    # timeline is written to it. fleet_run gives every controller of a fleet its own timeline.
+    trace_file = event.get("trace_file", default_trace_file)
+    if not trace_file:
+        yield None
+        return
+
+    hostname = event["hostname"].replace(":", "_")
+    if "{hostname}" in trace_file:
+        trace_file = trace_file.replace("{hostname}", hostname)
+    elif fleet_run:
+        # like the profiles of profile_run()
+        trace_root, trace_extension = os.path.splitext(trace_file)
+        trace_file = "%s-%s-%s-%d%s" % (
+            trace_root,
+            hostname,
+            time.strftime("%Y%m%dT%H%M%S"),
+            os.getpid(),
+            trace_extension,
+        )
+    tracer = AviatrixTracer()
+    token = _current_tracer.set(tracer)
+    try:
+        with trace_span(
+            "function_handler",
+            hostname=event["hostname"],
+            controller_init_version=event["controller_init_version"],
+        ):
+            yield tracer
+    finally:
+        _current_tracer.reset(token)
+        tracer.write_timeline(
+            path=trace_file,
+            trace_format=event.get("trace_format", default_trace_format),
+        )
+
+
+# End def trace_run()
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import threading
+
+from aviatrix_file_lock import locked_file
+
+# Wake-up history: the readiness waits of earlier runs set the wait budget and the probe schedule
+# of the next runs, see WakeupHistory
+
+# The wait time from experience is between 60 to 600 seconds
+# without history of earlier runs, see WakeupHistory
+default_wait_time_for_apache_wakeup = 300
+
+# History of the readiness waits of earlier runs, per region, VM size and controller version.
+# It sets the wait budget and schedules the readiness probes. Disabled when empty.
+default_wakeup_history_file = os.environ.get("AVIATRIX_WAKEUP_HISTORY_FILE", "")
+# Durations kept per region, VM size and controller version
+default_wakeup_history_size = int(os.environ.get("AVIATRIX_WAKEUP_HISTORY_SIZE", "50"))
+# Durations needed to use a breakdown, with fewer the next coarser breakdown is used
+default_wakeup_min_samples = int(os.environ.get("AVIATRIX_WAKEUP_MIN_SAMPLES", "5"))
+# The wait budget is this percentile of the durations times wakeup_wait_margin
+default_wakeup_wait_percentile = float(os.environ.get("AVIATRIX_WAKEUP_WAIT_PERCENTILE", "99"))
+wakeup_wait_margin = 1.5
+wakeup_min_wait_time = 60
+# Longest time between two probes while the controller is expected to get ready, and before
+wakeup_dense_probe_interval = 0.5
+wakeup_sparse_probe_interval = 30
+
+_wakeup_history = None
+_wakeup_histories = dict()
+_wakeup_history_lock = threading.Lock()
+
+
+class WakeupHistory(object):
+    # Durations in seconds of earlier runs, per kind, region, VM size and controller version.
+    # The kinds are "wakeup" (readiness wait before the initial setup), "upgrade" (the tracked
+    # upgrade of the initial setup) and "restart" (readiness wait after it).
+    # The file is shared by the runs of all processes, updates are serialized with a lock file.
+    def __init__(
+        self,
+        history_file=default_wakeup_history_file,
+        size=default_wakeup_history_size,
+        min_samples=default_wakeup_min_samples,
+    ):
+        self.history_file = history_file
+        self.size = size
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def get_key(self, kind, region, vm_size, version):
+        return "|".join([kind, region or "*", vm_size or "*", version or "*"])
+
+    def load(self):
+        if not self.history_file:
+            return dict()
+        try:
+            with open(self.history_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def add(self, kind, region, vm_size, version, duration):
+        if not self.history_file:
+            return
+        key = self.get_key(kind, region, vm_size, version)
+        directory = os.path.dirname(self.history_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.lock:
+            with locked_file(self.history_file):
+                # start from the file, other processes may have added durations since it was loaded
+                self.entries = self.load()
+                self.entries[key] = (self.entries.get(key, list()) + [round(duration, 3)])[-self.size:]
+                with open(self.history_file + ".tmp", "w") as f:
+                    json.dump(self.entries, f, indent=2, sort_keys=True)
+                os.replace(self.history_file + ".tmp", self.history_file)
+
+    def get_durations(self, kind, region, vm_size, version):
+        # The sorted durations of the finest breakdown that has at least min_samples of them:
+        # region, VM size and version, then region and VM size, then region, then all runs
+        fields = [region or "*", vm_size or "*", version or "*"]
+        with self.lock:
+            entries = dict(self.entries)
+        for level in range(len(fields), -1, -1):
+            durations = list()
+            for key, values in entries.items():
+                key_fields = key.split("|")
+                if key_fields[0] == kind and key_fields[1 : 1 + level] == fields[:level]:
+                    durations.extend(values)
+            if len(durations) >= max(self.min_samples, 1):
+                return sorted(durations)
+        return list()
+
+
+# END class WakeupHistory
+
+
+def get_wakeup_history(history_file=None):
+    # The wake-up history shared by all runs of this process, built from the environment on first use,
+    # or the one of history_file for the runs that set another file (event["wakeup_history_file"])
+    global _wakeup_history
+
+    with _wakeup_history_lock:
+        if _wakeup_history is None:
+            _wakeup_history = WakeupHistory()
+        if history_file is None or history_file == _wakeup_history.history_file:
+            return _wakeup_history
+        if history_file not in _wakeup_histories:
+            _wakeup_histories[history_file] = WakeupHistory(history_file=history_file)
+        return _wakeup_histories[history_file]
+
+
+# End def get_wakeup_history()
+
+
+def get_percentile(sorted_values, percentile):
+    # Nearest-rank percentile of a sorted list
+    if not sorted_values:
+        return float("nan")
+    rank = max(int(round(percentile / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+# End def get_percentile()
+
+
+def build_probe_schedule(durations=list(), interval_wait_time=2):
+    # The longest time between two readiness probes, by the seconds elapsed since the wait started:
+    #   before the 5th percentile of durations : half the time left until it, probes get denser as it nears
+    #   up to the 95th percentile              : wakeup_dense_probe_interval
+    #   after it                               : interval_wait_time, the controller is late
+    # Returns None without durations, the probes are then spaced by interval_wait_time.
+    if not durations:
+        return None
+    early_time = get_percentile(durations, 5)
+    late_time = get_percentile(durations, 95)
+
+    def get_probe_interval(elapsed_time):
+        if elapsed_time < early_time:
+            return min(wakeup_sparse_probe_interval, max(interval_wait_time, (early_time - elapsed_time) / 2))
+        if elapsed_time <= late_time:
+            return wakeup_dense_probe_interval
+        return interval_wait_time
+
+    return get_probe_interval
+
+
+# End def build_probe_schedule()
+
+
+def get_readiness_plan(context, kind="wakeup", default_wait_time=default_wait_time_for_apache_wakeup, interval_wait_time=2):
+    # Wait budget and probe schedule of a wait, from the durations of the earlier waits of the same
+    # kind on controllers like this one. Without enough history the budget is default_wait_time
+    # and the probes follow the default backoff.
+    durations = get_wakeup_history(context.get("wakeup_history_file")).get_durations(
+        kind, context.get("location"), context.get("vm_size"), context.get("controller_init_version")
+    )
+    wait_time = default_wait_time
+    if durations:
+        wait_time = max(
+            wakeup_min_wait_time,
+            int(get_percentile(durations, default_wakeup_wait_percentile) * wakeup_wait_margin) + 1,
+        )
+        logging.info(
+            "Wait budget of the %s is %d seconds, from %d earlier runs (median %.1f seconds)",
+            kind,
+            wait_time,
+            len(durations),
+            get_percentile(durations, 50),
+        )
+    return {"wait_time": wait_time, "probe_schedule": build_probe_schedule(durations, interval_wait_time)}
+
+
+# End def get_readiness_plan()
+
+
+def record_readiness_duration(context, kind="wakeup", duration=0):
+    # A wait that timed out is recorded too, as a duration of at least its budget,
+    # otherwise a budget that got too short would never grow back
+    try:
+        get_wakeup_history(context.get("wakeup_history_file")).add(
+            kind,
+            context.get("location"),
+            context.get("vm_size"),
+            context.get("controller_init_version"),
+            duration,
+        )
+    except (IOError, OSError) as e:
+        logging.warning("The %s duration could not be saved to the history: %s", kind, str(e))
+
+
+# End def record_readiness_duration()
@@ -0,0 +1,224 @@
+import argparse
+import logging
+import time
+
+import urllib3
+
+import aviatrix_controller_init
+import mock_controller
+
+# Benchmarks of function_handler() against the local stand-in controller.
+#   connection : compares a new TCP connection and TLS handshake per API call with
+#                the pooled keep-alive HTTPS session
+#   scenarios  : runs the init flow against the scenarios of mock_controller.SCENARIOS
+#                and reports wall time, requests and readiness detection lag
+
+
+def build_event(hostname, private_ip):
+    return {
+        "hostname": hostname,
+        "ucc_private_ip": private_ip,
+        "aviatrix_api_version": "v1",
+        "aviatrix_api_route": "api",
+        "admin_email": "admin@example.com",
+        "new_admin_password": "Aviatrix123#",
+        "controller_init_version": "latest",
+        "arm_subscription_id": "00000000-0000-0000-0000-000000000000",
+        "arm_application_client_id": "00000000-0000-0000-0000-000000000001",
+        "arm_application_client_secret": "secret",
+        "directory_tenant_id": "00000000-0000-0000-0000-000000000002",
+        "account_email": "account@example.com",
+        "aviatrix_customer_id": "aviatrix-1234567.89",
+        "access_account_name": "azure-account",
+        # the stand-in does not cover the ARM token endpoint
+        "preflight_arm_check": False,
+    }
+
+
+# End def build_event()
+
+
+def mean(values):
+    if not values:
+        return float("nan")
+    return sum(values) / float(len(values))
+
+
+# End def mean()
+
+
+def run_connection_benchmark(server, hostname, runs=5, keep_alive=True):
+    state = server.state
+    aviatrix_controller_init.configure_aviatrix_session(keep_alive=keep_alive)
+    durations = list()
+    handshakes = list()
+    requests_sent = list()
+    for i in range(runs):
+        state.reset()
+        start = time.perf_counter()
+        aviatrix_controller_init.function_handler(
+            build_event(hostname=hostname, private_ip=state.private_ip)
+        )
+        durations.append(time.perf_counter() - start)
+        handshakes.append(state.handshake_count)
+        requests_sent.append(state.request_count)
+        # start each run with a cold pool, like a new local-exec process does
+        aviatrix_controller_init.configure_aviatrix_session(keep_alive=keep_alive)
+    aviatrix_controller_init.close_aviatrix_session()
+    return {
+        "mode": "pooled keep-alive" if keep_alive else "new connection per call",
+        "runs": runs,
+        "requests_per_run": mean(requests_sent),
+        "handshakes_per_run": mean(handshakes),
+        "wall_time_ms_per_run": 1000 * mean(durations),
+    }
+
+
+# End def run_connection_benchmark()
+
+
+def print_connection_results(results):
+    header = "%-26s %6s %10s %12s %14s" % (
+        "mode",
+        "runs",
+        "requests",
+        "handshakes",
+        "wall time ms",
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            "%-26s %6d %10.1f %12.1f %14.1f"
+            % (
+                result["mode"],
+                result["runs"],
+                result["requests_per_run"],
+                result["handshakes_per_run"],
+                result["wall_time_ms_per_run"],
+            )
+        )
+
+
+# End def print_connection_results()
+
+
+def run_scenario_benchmark(scenario_name, runs=3, ssl_context=None):
+    # A new stand-in controller is started for every run so that each run goes
+    # through the whole boot sequence of the scenario
+    durations = list()
+    requests_sent = list()
+    boot_lags = list()
+    upgrade_lags = list()
+    failures = list()
+    for i in range(runs):
+        server, hostname = mock_controller.start_mock_controller(
+            scenario=scenario_name, ssl_context=ssl_context, seed=i
+        )
+        aviatrix_controller_init.configure_aviatrix_session()
+        state = server.state
+        start = time.perf_counter()
+        try:
+            aviatrix_controller_init.function_handler(
+                build_event(hostname=hostname, private_ip=state.private_ip)
+            )
+        except Exception as e:
+            failures.append(str(e))
+        durations.append(time.perf_counter() - start)
+        requests_sent.append(state.request_count)
+        if "boot" in state.detection_lags:
+            boot_lags.append(state.detection_lags["boot"])
+        if "upgrade" in state.detection_lags:
+            upgrade_lags.append(state.detection_lags["upgrade"])
+        mock_controller.stop_mock_controller(server)
+    aviatrix_controller_init.close_aviatrix_session()
+    return {
+        "scenario": scenario_name,
+        "runs": runs,
+        "succeeded": runs - len(failures),
+        "wall_time_s": mean(durations),
+        "requests_per_run": mean(requests_sent),
+        "boot_detection_lag_ms": 1000 * mean(boot_lags),
+        "upgrade_detection_lag_ms": 1000 * mean(upgrade_lags),
+        "failures": failures,
+    }
+
+
+# End def run_scenario_benchmark()
+
+
+def print_scenario_results(results):
+    header = "%-22s %5s %5s %12s %10s %16s %19s" % (
+        "scenario",
+        "runs",
+        "ok",
+        "wall time s",
+        "requests",
+        "boot lag ms",
+        "upgrade lag ms",
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            "%-22s %5d %5d %12.2f %10.1f %16.1f %19.1f"
+            % (
+                result["scenario"],
+                result["runs"],
+                result["succeeded"],
+                result["wall_time_s"],
+                result["requests_per_run"],
+                result["boot_detection_lag_ms"],
+                result["upgrade_detection_lag_ms"],
+            )
+        )
+    for result in results:
+        for failure in sorted(set(result["failures"])):
+            print("%s failed: %s" % (result["scenario"], failure[:200]))
+
+
+# End def print_scenario_results()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark function_handler() against a local HTTPS stand-in controller"
+    )
+    parser.add_argument(
+        "benchmark",
+        nargs="?",
+        default="connection",
+        choices=["connection", "scenarios"],
+        help="connection pooling comparison, or end-to-end scenarios",
+    )
+    parser.add_argument("--runs", type=int, default=5, help="function_handler runs per mode or scenario")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(mock_controller.SCENARIOS),
+        help="scenario to run, can be repeated (default: all)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    if args.benchmark == "connection":
+        server, hostname = mock_controller.start_mock_controller()
+        server.started.wait()
+        try:
+            results = [
+                run_connection_benchmark(server, hostname, runs=args.runs, keep_alive=False),
+                run_connection_benchmark(server, hostname, runs=args.runs, keep_alive=True),
+            ]
+        finally:
+            mock_controller.stop_mock_controller(server)
+        print_connection_results(results)
+    else:
+        ssl_context = mock_controller.create_server_ssl_context()
+        results = list()
+        for scenario_name in args.scenario or sorted(mock_controller.SCENARIOS):
+            results.append(
+                run_scenario_benchmark(scenario_name, runs=args.runs, ssl_context=ssl_context)
+            )
+        print_scenario_results(results)
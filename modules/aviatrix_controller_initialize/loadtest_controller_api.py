@@ -0,0 +1,371 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+import urllib3
+
+import aviatrix_controller_init
+import mock_controller
+from aviatrix_controller_init import AviatrixException, get_percentile
+
+# Load test of the controller API, built on login() and send_aviatrix_api().
+# A weighted mix of read-only actions is sent in stages of increasing concurrency (and
+# optionally rate), every call is made once, without retries, response cache or circuit
+# breaker, so that the first refusals and timeouts of the controller are not hidden.
+# Each stage reports its throughput, p50/p95/p99 latency and errors per kind; the first stage
+# whose error rate exceeds the threshold is the error onset point, and the ramp stops there
+# unless --continue-after-onset is given.
+# Without --hostname the test runs against the local stand-in controller, e.g. in CI.
+
+# Read-only actions of the mix: (action, subaction) -> HTTP method
+load_test_actions = {
+    ("login", None): "POST",
+    ("initial_setup", "check"): "GET",
+    ("list_version_info", None): "POST",
+    ("list_accounts", None): "POST",
+}
+default_load_test_mix = "initial_setup:check=4,list_version_info=2,list_accounts=2,login=1"
+default_load_test_concurrency = "1,2,4,8,16,32"
+
+
+def parse_action_mix(mix=default_load_test_mix):
+    # "action[:subaction]=weight,..." -> [((action, subaction), weight), ...]
+    action_mix = list()
+    for item in mix.split(","):
+        name, _, weight = item.strip().partition("=")
+        action, _, subaction = name.partition(":")
+        key = (action, subaction or None)
+        if key not in load_test_actions:
+            raise ValueError("Not a read-only action of the load test: " + name)
+        action_mix.append((key, float(weight or 1)))
+    return action_mix
+
+
+# End def parse_action_mix()
+
+
+def parse_stage_values(values="1", value_type=int):
+    return [value_type(value) for value in values.split(",") if value.strip()]
+
+
+# End def parse_stage_values()
+
+
+def classify_call_error(error):
+    # Kind of a failed call: http_<status code>, timeout, connection or the exception type
+    if isinstance(error, AviatrixException) and error.status_code > 0:
+        return "http_" + str(error.status_code)
+    cause = error.__cause__ if isinstance(error, AviatrixException) else error
+    if isinstance(cause, requests.exceptions.Timeout):
+        return "timeout"
+    if isinstance(cause, requests.exceptions.ConnectionError):
+        return "connection"
+    return type(error).__name__
+
+
+# End def classify_call_error()
+
+
+def send_load_test_call(
+    api_endpoint_url="https://123.123.123.123/v1/api",
+    username="admin",
+    password="********",
+    CID="ABCD1234",
+    action_key=("login", None),
+    timeout=10,
+):
+    # Send one call of the mix, returns its outcome: "ok", or the kind of error
+    action, subaction = action_key
+    try:
+        if action == "login":
+            response = aviatrix_controller_init.login(
+                api_endpoint_url=api_endpoint_url,
+                username=username,
+                password=password,
+                retry_count=1,
+                timeout=timeout,
+            )
+        else:
+            payload = {"action": action, "CID": CID}
+            if subaction is not None:
+                payload["subaction"] = subaction
+            response = aviatrix_controller_init.send_aviatrix_api(
+                api_endpoint_url=api_endpoint_url,
+                request_method=load_test_actions[action_key],
+                payload=payload,
+                retry_count=1,
+                timeout=timeout,
+                use_cache=False,
+            )
+    except Exception as e:
+        return classify_call_error(e)
+    # "RequestRefused" and "Valid action required" are the answers of a busy controller,
+    # any other answer (e.g. "Initial setup has not run yet") is a successful call
+    error_kind = response.error_kind()
+    if error_kind == "not_ready":
+        return "refused"
+    if error_kind == "invalid_cid" or (action == "login" and not response.succeeded()):
+        return "rejected"
+    return "ok"
+
+
+# End def send_load_test_call()
+
+
+def run_load_test_stage(
+    api_endpoint_url="https://123.123.123.123/v1/api",
+    username="admin",
+    password="********",
+    CID="ABCD1234",
+    action_mix=list(),
+    concurrency=1,
+    rate=0,
+    duration=5,
+    timeout=10,
+    seed=None,
+):
+    # Send the mix with concurrency callers for duration seconds.
+    # rate > 0 caps the calls started per second across all callers.
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    keys = [key for key, weight in action_mix]
+    weights = [weight for key, weight in action_mix]
+    samples = list()
+    samples_lock = threading.Lock()
+    schedule = {"next_start": time.monotonic()}
+    schedule_lock = threading.Lock()
+    stage_start_time = time.monotonic()
+    stage_end_time = stage_start_time + duration
+
+    def wait_for_slot():
+        # pace the callers so that at most rate calls start per second
+        if rate <= 0:
+            return time.monotonic() < stage_end_time
+        with schedule_lock:
+            start_time = max(schedule["next_start"], time.monotonic())
+            schedule["next_start"] = start_time + 1.0 / rate
+        if start_time >= stage_end_time:
+            return False
+        time.sleep(max(start_time - time.monotonic(), 0))
+        return True
+
+    def caller():
+        while wait_for_slot():
+            with rng_lock:
+                action_key = rng.choices(keys, weights)[0]
+            start_time = time.monotonic()
+            outcome = send_load_test_call(
+                api_endpoint_url=api_endpoint_url,
+                username=username,
+                password=password,
+                CID=CID,
+                action_key=action_key,
+                timeout=timeout,
+            )
+            end_time = time.monotonic()
+            with samples_lock:
+                samples.append((end_time - stage_start_time, end_time - start_time, outcome))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(caller) for i in range(concurrency)]:
+            future.result()
+    elapsed = max(time.monotonic() - stage_start_time, 1e-9)
+
+    ok_latencies = sorted(latency for end, latency, outcome in samples if outcome == "ok")
+    errors = dict()
+    first_error_at = None
+    for end, latency, outcome in samples:
+        if outcome != "ok":
+            errors[outcome] = errors.get(outcome, 0) + 1
+            if first_error_at is None or end < first_error_at:
+                first_error_at = end
+    return {
+        "concurrency": concurrency,
+        "rate": rate,
+        "requests": len(samples),
+        "ok": len(ok_latencies),
+        "errors": errors,
+        "error_rate": (len(samples) - len(ok_latencies)) / float(len(samples)) if samples else 0.0,
+        "first_error_after_s": first_error_at,
+        "throughput_rps": len(ok_latencies) / elapsed,
+        "p50_ms": 1000 * get_percentile(ok_latencies, 50),
+        "p95_ms": 1000 * get_percentile(ok_latencies, 95),
+        "p99_ms": 1000 * get_percentile(ok_latencies, 99),
+    }
+
+
+# End def run_load_test_stage()
+
+
+def run_load_test(
+    api_endpoint_url="https://123.123.123.123/v1/api",
+    username="admin",
+    password="********",
+    action_mix=list(),
+    concurrency_stages=[1],
+    rate_stages=[0],
+    duration=5,
+    timeout=10,
+    error_threshold=0.01,
+    continue_after_onset=False,
+    on_stage=None,
+):
+    # Run the stages in order and return {"stages": [...], "onset": <first stage over the
+    # error threshold or None>}. on_stage(stage) is called after every stage.
+    aviatrix_controller_init.configure_aviatrix_session(pool_maxsize=max(concurrency_stages))
+    # every failed call is counted, the circuit breaker would turn them into immediate failures
+    aviatrix_controller_init.configure_circuit_breaker(
+        api_endpoint_url, aviatrix_controller_init.CircuitBreaker(failure_threshold=0)
+    )
+    try:
+        response = aviatrix_controller_init.login(
+            api_endpoint_url=api_endpoint_url,
+            username=username,
+            password=password,
+        )
+        aviatrix_controller_init.verify_aviatrix_api_response_login(response=response)
+        CID = response.py_dict["CID"]
+
+        result = {"stages": list(), "onset": None}
+        for i in range(max(len(concurrency_stages), len(rate_stages))):
+            stage = run_load_test_stage(
+                api_endpoint_url=api_endpoint_url,
+                username=username,
+                password=password,
+                CID=CID,
+                action_mix=action_mix,
+                concurrency=concurrency_stages[min(i, len(concurrency_stages) - 1)],
+                rate=rate_stages[min(i, len(rate_stages) - 1)],
+                duration=duration,
+                timeout=timeout,
+                seed=i,
+            )
+            result["stages"].append(stage)
+            if on_stage is not None:
+                on_stage(stage)
+            if result["onset"] is None and stage["error_rate"] > error_threshold:
+                result["onset"] = stage
+                if not continue_after_onset:
+                    break
+    finally:
+        aviatrix_controller_init.configure_circuit_breaker(api_endpoint_url, None)
+    return result
+
+
+# End def run_load_test()
+
+
+def print_stage(stage):
+    print(
+        "%11d %8s %9d %9.1f %9.1f %9.1f %9.1f %8.2f%%  %s"
+        % (
+            stage["concurrency"],
+            str(stage["rate"]) if stage["rate"] > 0 else "-",
+            stage["requests"],
+            stage["throughput_rps"],
+            stage["p50_ms"],
+            stage["p95_ms"],
+            stage["p99_ms"],
+            100 * stage["error_rate"],
+            " ".join("%s=%d" % (kind, count) for kind, count in sorted(stage["errors"].items())),
+        ),
+        flush=True,
+    )
+
+
+# End def print_stage()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the Aviatrix Controller API")
+    parser.add_argument("--hostname", help="controller to load, the local stand-in controller when omitted")
+    parser.add_argument(
+        "--scenario",
+        default="limited-capacity",
+        choices=sorted(mock_controller.SCENARIOS),
+        help="scenario of the local stand-in controller",
+    )
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--mix", default=default_load_test_mix, help="action[:subaction]=weight,...")
+    parser.add_argument("--concurrency", default=default_load_test_concurrency, help="callers per stage")
+    parser.add_argument("--rate", default="0", help="calls started per second per stage, 0 is unlimited")
+    parser.add_argument("--stage-duration", type=float, default=5, help="seconds per stage")
+    parser.add_argument("--timeout", type=float, default=10, help="read timeout of each call in seconds")
+    parser.add_argument(
+        "--error-threshold",
+        type=float,
+        default=0.01,
+        help="error rate of a stage that marks the error onset point",
+    )
+    parser.add_argument("--continue-after-onset", action="store_true", help="run the remaining stages anyway")
+    parser.add_argument("--output", help="JSON file of the results")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    server = None
+    if args.hostname:
+        hostname = args.hostname
+        # the password is read from the environment so that it does not show up in process listings
+        password = os.environ.get("AVIATRIX_CONTROLLER_PASSWORD", "")
+        if not password:
+            parser.error("AVIATRIX_CONTROLLER_PASSWORD is not set")
+    else:
+        server, hostname = mock_controller.start_mock_controller(scenario=args.scenario)
+        server.started.wait()
+        password = server.state.password
+
+    header = "%11s %8s %9s %9s %9s %9s %9s %9s  %s" % (
+        "concurrency",
+        "rate",
+        "requests",
+        "ok/s",
+        "p50 ms",
+        "p95 ms",
+        "p99 ms",
+        "errors",
+        "error kinds",
+    )
+    print(header)
+    print("-" * len(header))
+    try:
+        result = run_load_test(
+            api_endpoint_url="https://" + hostname + "/v1/api",
+            username=args.username,
+            password=password,
+            action_mix=parse_action_mix(args.mix),
+            concurrency_stages=parse_stage_values(args.concurrency, int),
+            rate_stages=parse_stage_values(args.rate, float),
+            duration=args.stage_duration,
+            timeout=args.timeout,
+            error_threshold=args.error_threshold,
+            continue_after_onset=args.continue_after_onset,
+            on_stage=print_stage,
+        )
+    finally:
+        aviatrix_controller_init.close_aviatrix_session()
+        if server is not None:
+            mock_controller.stop_mock_controller(server)
+
+    onset = result["onset"]
+    if onset is None:
+        print("No error onset up to concurrency %d" % result["stages"][-1]["concurrency"])
+    else:
+        print(
+            "Error onset at concurrency %d%s, first error after %.2f s of the stage"
+            % (
+                onset["concurrency"],
+                ", rate %s/s" % onset["rate"] if onset["rate"] > 0 else "",
+                onset["first_error_after_s"],
+            )
+        )
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(result, output_file, indent=2)
@@ -13,18 +13,37 @@ terraform {
 }
 
 locals {
-  option = format("%s/aviatrix_controller_init.py",
-    var.terraform_module_path == "" ? path.module : format("%s/%s", var.terraform_module_path, "aviatrix_controller_initialize")
-  )
-  argument = format("'%s' '%s' '%s' '%s' '%s' '%s' '%s' '%s' '%s' '%s' '%s' '%s'",
-    var.avx_controller_public_ip, var.avx_controller_private_ip, var.avx_controller_admin_email,
-    var.avx_controller_admin_password, var.arm_subscription_id, var.arm_application_id,
-    var.arm_application_key, var.directory_id, var.account_email, var.access_account_name,
-    var.aviatrix_customer_id, var.controller_version
-  )
+  module_path         = var.terraform_module_path == "" ? path.module : format("%s/%s", var.terraform_module_path, "aviatrix_controller_initialize")
+  journal_dir         = var.init_journal_dir == "" ? format("%s/.terraform/aviatrix_init_journal", path.root) : var.init_journal_dir
+  wakeup_history_file = var.wakeup_history_file == "" ? format("%s/.terraform/aviatrix_wakeup_history.json", path.root) : var.wakeup_history_file
+  option              = var.use_init_worker ? format("%s/aviatrix_controller_worker.py run", local.module_path) : format("%s/aviatrix_controller_init.py", local.module_path)
+  # the script reads the event from the environment, so that the passwords and the client
+  # secret do not show up in process listings, without a shell pipe that Windows runners lack
+  event = jsonencode({
+    hostname                      = var.avx_controller_public_ip
+    ucc_private_ip                = var.avx_controller_private_ip
+    instance_id                   = var.avx_controller_instance_id
+    admin_email                   = var.avx_controller_admin_email
+    new_admin_password            = var.avx_controller_admin_password
+    arm_subscription_id           = var.arm_subscription_id
+    arm_application_client_id     = var.arm_application_id
+    arm_application_client_secret = var.arm_application_key
+    directory_tenant_id           = var.directory_id
+    account_email                 = var.account_email
+    access_account_name           = var.access_account_name
+    aviatrix_customer_id          = var.aviatrix_customer_id
+    controller_init_version       = var.controller_version
+    location                      = var.location
+    vm_size                       = var.controller_virtual_machine_size
+  })
 }
 resource "null_resource" "run_script" {
   provisioner "local-exec" {
-    command = "python3 -W ignore ${local.option} ${local.argument}"
+    command     = "python3 -W ignore ${local.option} --event-env AVIATRIX_INIT_EVENT"
+    environment = {
+      AVIATRIX_INIT_EVENT          = local.event
+      AVIATRIX_INIT_JOURNAL_DIR    = local.journal_dir
+      AVIATRIX_WAKEUP_HISTORY_FILE = local.wakeup_history_file
+    }
   }
 }
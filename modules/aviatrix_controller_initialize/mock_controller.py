@@ -0,0 +1,518 @@
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+# Local HTTPS stand-in of the Aviatrix Controller API.
+# It implements the actions used by aviatrix_controller_init.py so that the init
+# flow can be tested and benchmarked without a real controller.
+#
+# The life cycle of the stand-in follows a scenario:
+#   boot_delay          : seconds the HTTPS port refuses connections (VM is booting)
+#   boot_phases         : phases Apache goes through before the API is ready
+#   boot_requests       : behaviors of the first HTTP requests after the boot, by request count
+#                         instead of time, for tests that need a deterministic wake-up
+#   upgrade_duration    : seconds the initial_setup upgrade takes
+#   run_request_drop    : seconds after which the "run" request is dropped without a response,
+#                         the upgrade goes on (Apache restarts during the upgrade)
+#   post_upgrade_phases : phases Apache goes through after the upgrade restarted it
+# Every phase is (behavior, duration) where behavior is one of
+#   "reset"                 : connections are closed before the TLS handshake
+#   "http_503"              : Apache answers 503 Service Unavailable
+#   "placeholder_page"      : Apache answers 200 with an HTML placeholder page
+#   "valid_action_required" : every action returns "Valid action required"
+#   "request_refused"       : every action returns "RequestRefused"
+# max_concurrent_requests refuses the requests above that many in flight with "RequestRefused",
+# like a controller under load.
+# Durations are distributions, sampled again on every reset:
+#   ("fixed", seconds), ("uniform", low, high), ("exponential", mean), ("lognormal", mu, sigma)
+
+SCENARIOS = {
+    "ready": {},
+    "fast-wakeup": {
+        "boot_delay": ("fixed", 0.5),
+        "boot_phases": [
+            ("reset", ("fixed", 0.3)),
+            ("valid_action_required", ("fixed", 0.5)),
+        ],
+        "upgrade_duration": ("fixed", 1),
+        "post_upgrade_phases": [
+            ("reset", ("fixed", 0.3)),
+            ("valid_action_required", ("fixed", 0.3)),
+        ],
+    },
+    "slow-wakeup": {
+        "boot_delay": ("uniform", 2, 4),
+        "boot_phases": [
+            ("reset", ("uniform", 0.5, 1)),
+            ("http_503", ("uniform", 0.5, 1)),
+            ("valid_action_required", ("lognormal", 0.5, 0.5)),
+        ],
+        "upgrade_duration": ("uniform", 2, 4),
+        "post_upgrade_phases": [
+            ("reset", ("uniform", 0.5, 1)),
+            ("valid_action_required", ("exponential", 1)),
+        ],
+    },
+    "request-refused": {
+        "boot_phases": [
+            ("valid_action_required", ("fixed", 0.5)),
+            ("request_refused", ("uniform", 1, 2)),
+        ],
+        "upgrade_duration": ("fixed", 1),
+        "post_upgrade_phases": [("request_refused", ("fixed", 1))],
+    },
+    "upgrade-read-timeout": {
+        "upgrade_duration": ("fixed", 2),
+        "run_request_duration": ("fixed", 30),
+    },
+    "upgrade-connection-drop": {
+        "upgrade_duration": ("fixed", 2),
+        "run_request_drop": ("fixed", 0.5),
+        "post_upgrade_phases": [("reset", ("fixed", 0.5))],
+    },
+    "legacy-password-api": {"legacy_password_api": True},
+    "slow-responses": {
+        "response_delays": {
+            "login": ("uniform", 0.1, 0.3),
+            "setup_account_profile": ("uniform", 0.5, 1),
+        },
+    },
+    "not-found": {"not_found": True},
+    # the first request gets a 503, the next two dummy logins "Valid action required", whatever their timing
+    "counted-wakeup": {"boot_requests": [("http_503", 1), ("valid_action_required", 2)]},
+    "limited-capacity": {
+        "max_concurrent_requests": 8,
+        "response_delays": {
+            "login": ("uniform", 0.02, 0.05),
+            "initial_setup": ("uniform", 0.01, 0.03),
+            "list_version_info": ("uniform", 0.01, 0.03),
+            "list_accounts": ("uniform", 0.02, 0.06),
+        },
+    },
+}
+
+
+def sample_duration(distribution, rng=random):
+    # Sample one duration in seconds from a distribution tuple
+    if distribution is None:
+        return 0
+    if isinstance(distribution, (int, float)):
+        return float(distribution)
+    kind = distribution[0]
+    if kind == "fixed":
+        return float(distribution[1])
+    if kind == "uniform":
+        return rng.uniform(distribution[1], distribution[2])
+    if kind == "exponential":
+        return rng.expovariate(1.0 / distribution[1])
+    if kind == "lognormal":
+        return rng.lognormvariate(distribution[1], distribution[2])
+    raise ValueError("Unknown distribution: " + str(distribution))
+
+
+# End def sample_duration()
+
+
+def generate_self_signed_certificate(directory=None):
+    # Generate a throw-away self-signed certificate with the openssl CLI
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="aviatrix-mock-controller-")
+    cert_file = os.path.join(directory, "cert.pem")
+    key_file = os.path.join(directory, "key.pem")
+    subprocess.check_call(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=127.0.0.1",
+            "-keyout",
+            key_file,
+            "-out",
+            cert_file,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return cert_file, key_file
+
+
+# End def generate_self_signed_certificate()
+
+
+def create_server_ssl_context():
+    cert_dir = tempfile.mkdtemp(prefix="aviatrix-mock-controller-")
+    try:
+        cert_file, key_file = generate_self_signed_certificate(directory=cert_dir)
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+    finally:
+        shutil.rmtree(cert_dir, ignore_errors=True)
+    return ssl_context
+
+
+# End def create_server_ssl_context()
+
+
+class MockControllerState(object):
+    def __init__(self, private_ip="10.0.0.4", current_version="6.5.1000", scenario=None, seed=None):
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.private_ip = private_ip
+        self.initial_version = current_version
+        self.scenario = dict(scenario or {})
+        self.reset()
+
+    def reset(self):
+        # Restart the scenario, the durations of the phases are sampled again
+        with self.lock:
+            scenario = self.scenario
+            self.password = self.private_ip
+            self.admin_email = None
+            self.customer_id = None
+            self.accounts = dict()
+            self.sessions = set()
+            self.upgrade_done_at = None
+            self.current_version = self.initial_version
+            self.legacy_password_api = scenario.get("legacy_password_api", False)
+            self.not_found = scenario.get("not_found", False)
+            # seconds the "run" subaction of initial_setup takes to upgrade the controller
+            self.upgrade_duration = sample_duration(scenario.get("upgrade_duration"), self.rng)
+            # seconds before the "run" request returns, None returns when the upgrade has finished
+            self.run_request_duration = None
+            if scenario.get("run_request_duration") is not None:
+                self.run_request_duration = sample_duration(scenario["run_request_duration"], self.rng)
+            self.run_request_drop = None
+            if scenario.get("run_request_drop") is not None:
+                self.run_request_drop = sample_duration(scenario["run_request_drop"], self.rng)
+            self.response_delays = dict(scenario.get("response_delays", {}))
+            self.max_concurrent_requests = scenario.get("max_concurrent_requests")
+            self.in_flight = 0
+            self.boot_phases = [
+                (behavior, sample_duration(duration, self.rng))
+                for behavior, duration in scenario.get("boot_phases", [])
+            ]
+            self.post_upgrade_phases = [
+                (behavior, sample_duration(duration, self.rng))
+                for behavior, duration in scenario.get("post_upgrade_phases", [])
+            ]
+            self.boot_requests = list(scenario.get("boot_requests", []))
+            self.boot_at = time.monotonic()
+            # detection lag: time between the API becoming ready and the first readiness probe seeing it
+            self.detection_lags = dict()
+            self.request_count = 0
+            self.handshake_count = 0
+            self.action_count = dict()
+
+    def current_phase(self, now=None):
+        # Returns (phase_name, behavior, ready_at) of the controller at time now
+        if now is None:
+            now = time.monotonic()
+        if self.upgrade_done_at is not None and now >= self.upgrade_done_at:
+            phase_name, start, phases = "upgrade", self.upgrade_done_at, self.post_upgrade_phases
+        else:
+            phase_name, start, phases = "boot", self.boot_at, self.boot_phases
+        ready_at = start + sum(duration for behavior, duration in phases)
+        for behavior, duration in phases:
+            if now < start + duration:
+                return phase_name, behavior, ready_at
+            start += duration
+        return phase_name, "ready", ready_at
+
+    def current_request_behavior(self):
+        # The behavior the boot_requests give the current request, None once they are used up
+        if self.upgrade_done_at is not None:
+            return None
+        count = 0
+        for behavior, request_count in self.boot_requests:
+            count += request_count
+            if self.request_count <= count:
+                return behavior
+        return None
+
+    def upgrade_is_done(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self.upgrade_done_at is not None and now >= self.upgrade_done_at
+
+
+# END class MockControllerState
+
+
+class MockControllerRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that the client can keep the connection alive
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("mock-controller: " + format, *args)
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        self.handle_action(dict((k, v[0]) for k, v in query.items()))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        form = parse_qs(body)
+        self.handle_action(dict((k, v[0]) for k, v in form.items()))
+
+    def send_json(self, py_dict, status_code=200):
+        self.send_body(json.dumps(py_dict).encode("utf-8"), status_code=status_code)
+
+    def send_body(self, body, status_code=200, content_type="application/json"):
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            # like Apache, tell the client when the connection is not kept alive
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_action(self, data):
+        state = self.server.state
+        action = data.get("action", "")
+        now = time.monotonic()
+        with state.lock:
+            state.request_count += 1
+            state.action_count[action] = state.action_count.get(action, 0) + 1
+            phase_name, behavior, ready_at = state.current_phase(now)
+            behavior = state.current_request_behavior() or behavior
+            overloaded = (
+                behavior == "ready"
+                and state.max_concurrent_requests is not None
+                and state.in_flight >= state.max_concurrent_requests
+            )
+            if overloaded:
+                behavior = "request_refused"
+            status_code = 200
+            handler = getattr(self, "action_" + action, None)
+            if behavior == "reset":
+                # Apache restarts, kept-alive connections are dropped without a response
+                self.close_connection = True
+                return
+            if behavior == "placeholder_page" and not state.not_found:
+                py_dict = None
+            elif state.not_found:
+                status_code = 404
+                py_dict = {"return": False, "reason": "Not Found"}
+            elif behavior == "http_503":
+                status_code = 503
+                py_dict = {"return": False, "reason": "Service Unavailable"}
+            elif behavior == "valid_action_required":
+                py_dict = {"return": False, "reason": "Valid action required: " + action}
+            elif behavior == "request_refused":
+                py_dict = {"return": False, "reason": "RequestRefused: the server is busy"}
+            elif handler is None:
+                py_dict = {"return": False, "reason": "Valid action required: " + action}
+            elif action != "login" and data.get("CID") not in state.sessions:
+                py_dict = {"return": False, "reason": "CID is invalid or expired."}
+            else:
+                py_dict = handler(state, data)
+
+            # the readiness probe logs in with a dummy user
+            if (
+                behavior == "ready"
+                and action == "login"
+                and data.get("username") == "test"
+                and phase_name not in state.detection_lags
+            ):
+                state.detection_lags[phase_name] = max(0, now - ready_at)
+            delay = 0 if overloaded else sample_duration(state.response_delays.get(action), state.rng)
+            state.in_flight += 1
+
+        try:
+            if py_dict is None:
+                self.send_body(
+                    b"<html><body><h1>It works!</h1></body></html>", content_type="text/html"
+                )
+                return
+            if action == "initial_setup" and data.get("subaction") == "run" and behavior == "ready":
+                # the upgrade request only returns when the upgrade has finished
+                if state.run_request_drop is not None:
+                    time.sleep(state.run_request_drop)
+                    self.close_connection = True
+                    return
+                if state.run_request_duration is None:
+                    delay += state.upgrade_duration
+                else:
+                    delay += state.run_request_duration
+            if delay > 0:
+                time.sleep(delay)
+            self.send_json(py_dict, status_code=status_code)
+        finally:
+            with state.lock:
+                state.in_flight -= 1
+
+    def action_login(self, state, data):
+        if data.get("username") != "admin" or data.get("password") != state.password:
+            return {"return": False, "reason": "username and password do not match"}
+        cid = "CID%06d" % (len(state.sessions) + 1)
+        state.sessions.add(cid)
+        return {"return": True, "results": "User login:admin authorized successfully", "CID": cid}
+
+    def action_initial_setup(self, state, data):
+        if data.get("subaction") == "check":
+            if state.upgrade_is_done():
+                return {"return": True, "results": "Initial setup has been done."}
+            return {"return": False, "reason": "Initial setup has not run yet."}
+        if state.upgrade_done_at is not None:
+            return {"return": False, "reason": "Initial setup is already running."}
+        state.upgrade_done_at = time.monotonic() + state.upgrade_duration
+        target_version = data.get("target_version", "latest")
+        if target_version != "latest":
+            state.current_version = target_version
+        return {"return": True, "results": "Upgrade to " + target_version + " done"}
+
+    def action_list_version_info(self, state, data):
+        current_version = state.current_version
+        if not state.upgrade_is_done():
+            current_version = state.initial_version
+        return {"return": True, "results": {"current_version": "UserConnect-" + current_version}}
+
+    def action_add_admin_email_addr(self, state, data):
+        state.admin_email = data.get("admin_email")
+        return {"return": True, "results": "admin email address has been successfully added"}
+
+    def action_edit_account_user(self, state, data):
+        if state.legacy_password_api:
+            return {"return": False, "reason": "Valid action required: edit_account_user"}
+        if data.get("old_password") != state.password:
+            return {"return": False, "reason": "Old password does not match"}
+        state.password = data.get("new_password")
+        return {"return": True, "results": "Password has been changed"}
+
+    def action_change_password(self, state, data):
+        if not state.legacy_password_api:
+            return {"return": False, "reason": "Valid action required: change_password"}
+        if data.get("old_password") != state.password:
+            return {"return": False, "reason": "Old password does not match"}
+        state.password = data.get("password")
+        return {"return": True, "results": "Password has been changed"}
+
+    def action_setup_customer_id(self, state, data):
+        state.customer_id = data.get("customer_id")
+        return {"return": True, "results": "Customer ID has been set"}
+
+    def action_list_accounts(self, state, data):
+        account_list = [
+            {"account_name": account_name, "cloud_type": int(account.get("cloud_type", 8))}
+            for account_name, account in state.accounts.items()
+        ]
+        return {"return": True, "results": {"account_list": account_list}}
+
+    def action_setup_account_profile(self, state, data):
+        account_name = data.get("account_name")
+        if account_name in state.accounts:
+            return {"return": False, "reason": "Account " + account_name + " already exists"}
+        state.accounts[account_name] = data
+        return {
+            "return": True,
+            "results": "An email confirmation has been sent to " + data.get("account_email", ""),
+        }
+
+
+# END class MockControllerRequestHandler
+
+
+class MockControllerServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # a backlog like Apache's, the default of 5 drops connections under load
+    request_queue_size = 128
+
+    def __init__(self, server_address, ssl_context, state):
+        # the port is bound now but only listens once the boot delay has passed,
+        # until then connections are refused like on a booting VM
+        HTTPServer.__init__(
+            self, server_address, MockControllerRequestHandler, bind_and_activate=False
+        )
+        self.server_bind()
+        self.ssl_context = ssl_context
+        self.state = state
+        self.started = threading.Event()
+        self.stopping = threading.Event()
+
+    def get_request(self):
+        # every accepted connection pays one full TLS handshake
+        sock, address = self.socket.accept()
+        phase_name, behavior, ready_at = self.state.current_phase()
+        if behavior == "reset":
+            sock.close()
+            raise OSError("mock-controller: connection reset")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tls_sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        with self.state.lock:
+            self.state.handshake_count += 1
+        return tls_sock, address
+
+    def handle_error(self, request, client_address):
+        logging.debug("mock-controller: connection from %s closed", str(client_address))
+
+
+# END class MockControllerServer
+
+
+def start_mock_controller(
+    host="127.0.0.1",
+    port=0,
+    private_ip="10.0.0.4",
+    scenario=None,
+    ssl_context=None,
+    seed=None,
+):
+    # Start the stand-in controller in a background thread.
+    # scenario is a dict like the ones in SCENARIOS, or the name of one of them.
+    # Returns (server, hostname) where hostname is "<host>:<port>" and can be used
+    # as the "hostname" of the init event.
+    if isinstance(scenario, str):
+        scenario = SCENARIOS[scenario]
+    scenario = scenario or {}
+    if ssl_context is None:
+        ssl_context = create_server_ssl_context()
+
+    state = MockControllerState(private_ip=private_ip, scenario=scenario, seed=seed)
+    server = MockControllerServer((host, port), ssl_context, state)
+    boot_delay = sample_duration(scenario.get("boot_delay"), state.rng)
+
+    def boot():
+        if server.stopping.wait(boot_delay):
+            return
+        state.reset()
+        server.server_activate()
+        server.started.set()
+        server.serve_forever()
+
+    thread = threading.Thread(target=boot, daemon=True)
+    thread.start()
+    hostname = "%s:%d" % (host, server.server_address[1])
+    return server, hostname
+
+
+# End def start_mock_controller()
+
+
+def stop_mock_controller(server):
+    server.stopping.set()
+    if server.started.is_set():
+        server.shutdown()
+    server.server_close()
+
+
+# End def stop_mock_controller()
@@ -0,0 +1,102 @@
+import os
+import socket
+import sys
+
+import pytest
+
+module_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, module_dir)
+# mock_marketplace.py of the aviatrix_controller_azure module
+sys.path.insert(1, os.path.join(os.path.dirname(module_dir), "aviatrix_controller_azure"))
+
+import aviatrix_cid_cache  # noqa: E402
+import aviatrix_controller_init  # noqa: E402
+import aviatrix_retry  # noqa: E402
+import aviatrix_wakeup_history  # noqa: E402
+import mock_controller  # noqa: E402
+import mock_marketplace  # noqa: E402
+
+# The tests run the init flow against the local stand-in controller of mock_controller.py,
+# and the preflight against the stand-in Azure AD token endpoint of mock_marketplace.py.
+# The state shared by the runs of a process (session, caches, circuit breakers, endpoints,
+# wake-up history) is reset before every test, and retries wait tenths of a second.
+
+
+def pytest_configure(config):
+    # the stand-in controller has a self-signed certificate
+    config.addinivalue_line("filterwarnings", "ignore::urllib3.exceptions.InsecureRequestWarning")
+
+
+# End def pytest_configure()
+
+
+@pytest.fixture(autouse=True)
+def fresh_init_state(monkeypatch):
+    monkeypatch.setattr(aviatrix_retry, "_circuit_breakers", dict())
+    monkeypatch.setattr(aviatrix_controller_init, "_api_endpoints", dict())
+    monkeypatch.setattr(aviatrix_cid_cache, "_cid_cache", aviatrix_cid_cache.CIDCache(cache_file=""))
+    monkeypatch.setattr(
+        aviatrix_wakeup_history, "_wakeup_history", aviatrix_wakeup_history.WakeupHistory(history_file="")
+    )
+    monkeypatch.setattr(aviatrix_wakeup_history, "_wakeup_histories", dict())
+    aviatrix_controller_init.invalidate_response_cache()
+    aviatrix_controller_init.configure_retry_policy(
+        aviatrix_controller_init.RetryPolicy(base_delay=0.05, max_delay=0.2, connect_timeout=2, read_timeout=10)
+    )
+    aviatrix_controller_init.configure_aviatrix_session()
+    yield
+    aviatrix_controller_init.close_aviatrix_session()
+    aviatrix_controller_init.configure_retry_policy(None)
+    aviatrix_controller_init.invalidate_response_cache()
+
+
+# End def fresh_init_state()
+
+
+@pytest.fixture
+def start_controller():
+    # start_controller(scenario, **kwargs) starts a stand-in controller, stopped after the test
+    servers = list()
+
+    def start(scenario=None, **kwargs):
+        server, hostname = mock_controller.start_mock_controller(scenario=scenario, seed=0, **kwargs)
+        servers.append(server)
+        return server, hostname
+
+    yield start
+    for server in servers:
+        mock_controller.stop_mock_controller(server)
+
+
+# End def start_controller()
+
+
+@pytest.fixture
+def start_marketplace():
+    # start_marketplace(**kwargs) starts a stand-in token endpoint, returns (server, endpoint)
+    servers = list()
+
+    def start(**kwargs):
+        server, endpoint = mock_marketplace.start_mock_marketplace(**kwargs)
+        servers.append(server)
+        return server, endpoint
+
+    yield start
+    for server in servers:
+        mock_marketplace.stop_mock_marketplace(server)
+
+
+# End def start_marketplace()
+
+
+@pytest.fixture
+def closed_port():
+    # A local port nothing listens on, connections to it are refused
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# End def closed_port()
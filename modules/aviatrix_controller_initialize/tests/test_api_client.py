@@ -0,0 +1,360 @@
+import time
+
+import pytest
+import requests
+import urllib3
+
+import aviatrix_controller_init
+from aviatrix_controller_init import (
+    AviatrixException,
+    CIDCache,
+    CircuitBreaker,
+    CircuitBreakerOpenException,
+    RetryPolicy,
+)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or dict()
+
+
+# END class FakeResponse
+
+
+def login_admin(api_endpoint_url, password):
+    response = aviatrix_controller_init.login(api_endpoint_url=api_endpoint_url, username="admin", password=password)
+    aviatrix_controller_init.verify_aviatrix_api_response_login(response=response)
+    return aviatrix_controller_init.get_response_json(response)["CID"]
+
+
+# End def login_admin()
+
+
+@pytest.mark.parametrize(
+    "request_type, payload, response, error, decision",
+    [
+        ("POST", {"action": "login"}, FakeResponse(200), None, RetryPolicy.SUCCESS),
+        ("POST", {"action": "login"}, FakeResponse(503), None, RetryPolicy.RETRYABLE),
+        ("POST", {"action": "login"}, FakeResponse(502), None, RetryPolicy.RETRYABLE),
+        ("POST", {"action": "login"}, FakeResponse(404), None, RetryPolicy.FATAL),
+        ("POST", {"action": "login"}, None, requests.exceptions.ReadTimeout(), RetryPolicy.RETRYABLE),
+        ("POST", {"action": "login"}, None, ValueError(), RetryPolicy.FATAL),
+        (
+            "POST",
+            {"action": "initial_setup", "subaction": "run"},
+            None,
+            requests.exceptions.ReadTimeout(),
+            RetryPolicy.RETRYABLE_ONCE,
+        ),
+        (
+            "POST",
+            {"action": "initial_setup", "subaction": "run"},
+            None,
+            requests.exceptions.ConnectTimeout(),
+            RetryPolicy.RETRYABLE,
+        ),
+        ("POST", {"action": "setup_account_profile"}, FakeResponse(500), None, RetryPolicy.RETRYABLE_ONCE),
+        ("GET", {"action": "setup_account_profile"}, FakeResponse(500), None, RetryPolicy.RETRYABLE),
+    ],
+)
+def test_retry_policy_classify(request_type, payload, response, error, decision):
+    assert RetryPolicy().classify(request_type, payload, response=response, error=error) == decision
+
+
+# End def test_retry_policy_classify()
+
+
+def test_retry_policy_delay():
+    retry_policy = RetryPolicy(base_delay=1, max_delay=10)
+    assert retry_policy.get_delay(0, response=FakeResponse(429, {"Retry-After": "3"})) == 3
+    assert retry_policy.get_delay(0, response=FakeResponse(429, {"Retry-After": "120"})) == 10
+    for attempt in range(8):
+        assert 0 <= retry_policy.get_delay(attempt) <= min(10, pow(2, attempt))
+    assert retry_policy.get_timeout(read_timeout=30, remaining_time=5) == (5, 5)
+
+
+# End def test_retry_policy_delay()
+
+
+def caused_by(error):
+    exception = AviatrixException(message="ERROR: Failed to invoke Aviatrix API.")
+    exception.__cause__ = error
+    return exception
+
+
+# End def caused_by()
+
+
+def test_retry_policy_classify_call():
+    # callers that send a call again on a longer budget, e.g. the onboarding of access accounts
+    retry_policy = RetryPolicy()
+    payload = {"action": "setup_account_profile"}
+    refused = aviatrix_controller_init.AviatrixResponse(
+        status_code=200, py_dict={"return": False, "reason": "RequestRefused: the server is busy"}
+    )
+    exists = aviatrix_controller_init.AviatrixResponse(
+        status_code=200, py_dict={"return": False, "reason": "Account azure-1 already exists"}
+    )
+    assert retry_policy.classify_call("POST", payload, response=refused) == RetryPolicy.RETRYABLE
+    assert retry_policy.classify_call("POST", payload, response=exists) == RetryPolicy.SUCCESS
+
+    # a dropped connection may have created the account, a refused one did not
+    connection_refused = requests.exceptions.ConnectionError(
+        urllib3.exceptions.MaxRetryError(
+            pool=None, url="/v1/api", reason=urllib3.exceptions.NewConnectionError(None, "Connection refused")
+        )
+    )
+    connection_dropped = requests.exceptions.ConnectionError("Connection aborted")
+    assert retry_policy.classify_call("POST", payload, error=caused_by(connection_refused)) == RetryPolicy.RETRYABLE
+    assert retry_policy.classify_call("POST", payload, error=caused_by(connection_dropped)) == RetryPolicy.FATAL
+    assert retry_policy.classify_call(
+        "GET", {"action": "list_accounts"}, error=caused_by(connection_dropped)
+    ) == RetryPolicy.RETRYABLE
+    assert retry_policy.classify_call("POST", payload, error=CircuitBreakerOpenException()) == RetryPolicy.FATAL
+
+
+# End def test_retry_policy_classify_call()
+
+
+def test_circuit_breaker_opens_and_closes():
+    circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    circuit_breaker.record_failure()
+    assert circuit_breaker.allow_request()
+    circuit_breaker.record_failure()
+    assert not circuit_breaker.allow_request()
+    assert 0 < circuit_breaker.get_retry_time() <= 0.2
+
+    time.sleep(0.25)
+    # half open: a single trial call is let through
+    assert circuit_breaker.allow_request()
+    assert not circuit_breaker.allow_request()
+    circuit_breaker.record_success()
+    assert circuit_breaker.allow_request()
+    assert circuit_breaker.get_retry_time() == 0
+
+
+# End def test_circuit_breaker_opens_and_closes()
+
+
+def test_open_circuit_breaker_fails_fast(closed_port):
+    api_endpoint_url = "https://127.0.0.1:%d/v1/api" % closed_port
+    aviatrix_controller_init.configure_circuit_breaker(
+        api_endpoint_url, CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    )
+    with pytest.raises(AviatrixException) as excinfo:
+        aviatrix_controller_init.send_aviatrix_api(api_endpoint_url=api_endpoint_url, payload={"action": "login"})
+    assert not isinstance(excinfo.value, CircuitBreakerOpenException)
+    assert aviatrix_controller_init.is_transport_error(excinfo.value)
+
+    with pytest.raises(CircuitBreakerOpenException):
+        aviatrix_controller_init.send_aviatrix_api(api_endpoint_url=api_endpoint_url, payload={"action": "login"})
+
+    # calls that bypass the circuit breaker still reach the controller
+    with pytest.raises(AviatrixException) as excinfo:
+        aviatrix_controller_init.send_aviatrix_api(
+            api_endpoint_url=api_endpoint_url,
+            payload={"action": "login"},
+            retry_count=1,
+            use_circuit_breaker=False,
+        )
+    assert not isinstance(excinfo.value, CircuitBreakerOpenException)
+
+
+# End def test_open_circuit_breaker_fails_fast()
+
+
+def test_failover_to_other_address(start_controller):
+    server, hostname = start_controller("ready", private_ip="127.0.0.1")
+    public_url = "https://127.0.0.2:%d/v1/api" % server.server_address[1]
+    private_url = "https://" + hostname + "/v1/api"
+    server.started.wait()
+    aviatrix_controller_init.configure_api_endpoints(public_url, [public_url, private_url])
+
+    assert login_admin(public_url, "127.0.0.1")
+    assert aviatrix_controller_init.resolve_api_endpoint(public_url) == private_url
+    assert aviatrix_controller_init.get_circuit_breaker(public_url).consecutive_failures == 0
+
+
+# End def test_failover_to_other_address()
+
+
+def test_response_cache(start_controller):
+    server, hostname = start_controller("ready")
+    api_endpoint_url = "https://" + hostname + "/v1/api"
+    server.started.wait()
+    CID = login_admin(api_endpoint_url, server.state.private_ip)
+
+    for i in range(3):
+        assert not aviatrix_controller_init.has_controller_initialized(api_endpoint_url=api_endpoint_url, CID=CID)
+    assert server.state.action_count["initial_setup"] == 1
+
+    # a state changing call invalidates the cached responses of the controller
+    aviatrix_controller_init.set_admin_email(
+        api_endpoint_url=api_endpoint_url, CID=CID, admin_email="admin@example.com"
+    )
+    aviatrix_controller_init.has_controller_initialized(api_endpoint_url=api_endpoint_url, CID=CID)
+    assert server.state.action_count["initial_setup"] == 2
+
+
+# End def test_response_cache()
+
+
+def test_cid_cache_entries():
+    cid_cache = CIDCache(ttl=60, cache_file="")
+    cid_cache.put("https://1.1.1.1/v1/api", "admin", "password", "CID1")
+    assert cid_cache.get("https://1.1.1.1/v1/api", "admin", "password") == "CID1"
+    # an entry is only returned for the password and the controller it was created with
+    assert cid_cache.get("https://1.1.1.1/v1/api", "admin", "new password") is None
+    assert cid_cache.get("https://2.2.2.2/v1/api", "admin", "password") is None
+
+    cid_cache.invalidate("https://1.1.1.1/v1/api")
+    assert cid_cache.get("https://1.1.1.1/v1/api", "admin", "password") is None
+
+    expired_cache = CIDCache(ttl=0.1, cache_file="")
+    expired_cache.put("https://1.1.1.1/v1/api", "admin", "password", "CID1")
+    time.sleep(0.15)
+    assert expired_cache.get("https://1.1.1.1/v1/api", "admin", "password") is None
+
+
+# End def test_cid_cache_entries()
+
+
+def test_cid_cache_file_is_encrypted(tmp_path):
+    pytest.importorskip("cryptography")
+    cache_file = str(tmp_path / "cid_cache")
+    cid_cache = CIDCache(ttl=60, cache_file=cache_file, passphrase="passphrase")
+    cid_cache.put("https://1.1.1.1/v1/api", "admin", "password", "CID123456")
+    with open(cache_file, "rb") as f:
+        assert b"CID123456" not in f.read()
+
+    assert CIDCache(ttl=60, cache_file=cache_file, passphrase="passphrase").get(
+        "https://1.1.1.1/v1/api", "admin", "password"
+    ) == "CID123456"
+    assert CIDCache(ttl=60, cache_file=cache_file, passphrase="other").get(
+        "https://1.1.1.1/v1/api", "admin", "password"
+    ) is None
+
+
+# End def test_cid_cache_file_is_encrypted()
+
+
+def test_cached_cid_is_reused(start_controller):
+    server, hostname = start_controller("ready")
+    api_endpoint_url = "https://" + hostname + "/v1/api"
+    server.started.wait()
+    password = server.state.private_ip
+
+    for i in range(3):
+        aviatrix_controller_init.send_authenticated_aviatrix_api(
+            api_endpoint_url=api_endpoint_url,
+            password=password,
+            payload={"action": "list_version_info"},
+            use_cache=False,
+        )
+    assert server.state.action_count["login"] == 1
+
+    # a CID the controller no longer knows logs in again
+    server.state.sessions.clear()
+    aviatrix_controller_init.send_authenticated_aviatrix_api(
+        api_endpoint_url=api_endpoint_url,
+        password=password,
+        payload={"action": "list_version_info"},
+        use_cache=False,
+    )
+    assert server.state.action_count["login"] == 2
+
+
+# End def test_cached_cid_is_reused()
+
+
+def test_exhausted_budget_is_not_a_controller_failure(start_controller):
+    # the answers are slower than the time budget left, the controller itself is fine
+    server, hostname = start_controller({"response_delays": {"login": ("fixed", 1)}})
+    api_endpoint_url = "https://" + hostname + "/v1/api"
+    server.started.wait()
+    for i in range(3):
+        with pytest.raises(AviatrixException):
+            with aviatrix_controller_init.time_budget(0.3):
+                aviatrix_controller_init.send_aviatrix_api(api_endpoint_url=api_endpoint_url, payload={"action": "login"})
+    assert aviatrix_controller_init.get_circuit_breaker(api_endpoint_url).consecutive_failures == 0
+
+
+# End def test_exhausted_budget_is_not_a_controller_failure()
+
+
+@pytest.mark.parametrize("budget", [0.3, 0.001])
+def test_budget_cut_trial_releases_circuit_breaker(start_controller, budget):
+    # the trial call of a half open circuit breaker runs out of time budget (slow answer, or
+    # no attempt at all), the next call is the trial instead of failing fast for ever
+    server, hostname = start_controller({"response_delays": {"login": ("fixed", 1)}})
+    api_endpoint_url = "https://" + hostname + "/v1/api"
+    server.started.wait()
+    circuit_breaker = aviatrix_controller_init.configure_circuit_breaker(
+        api_endpoint_url, CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    )
+    circuit_breaker.record_failure()
+    time.sleep(0.15)
+    with pytest.raises(AviatrixException) as excinfo:
+        with aviatrix_controller_init.time_budget(budget):
+            time.sleep(0.002)
+            aviatrix_controller_init.send_aviatrix_api(api_endpoint_url=api_endpoint_url, payload={"action": "login"})
+    assert not isinstance(excinfo.value, CircuitBreakerOpenException)
+    assert not circuit_breaker.trial_in_progress
+    assert circuit_breaker.allow_request()
+
+
+# End def test_budget_cut_trial_releases_circuit_breaker()
+
+
+def test_trial_is_released_on_unexpected_error(start_controller, monkeypatch):
+    server, hostname = start_controller("ready")
+    api_endpoint_url = "https://" + hostname + "/v1/api"
+    circuit_breaker = aviatrix_controller_init.configure_circuit_breaker(
+        api_endpoint_url, CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    )
+    circuit_breaker.record_failure()
+    time.sleep(0.15)
+
+    def broken_observe(*args, **kwargs):
+        raise RuntimeError("broken metrics")
+
+    monkeypatch.setattr(aviatrix_controller_init.get_metrics(), "observe", broken_observe)
+    with pytest.raises(RuntimeError):
+        aviatrix_controller_init.send_aviatrix_api(api_endpoint_url=api_endpoint_url, payload={"action": "login"})
+    assert not circuit_breaker.trial_in_progress
+
+
+# End def test_trial_is_released_on_unexpected_error()
+
+
+def test_password_change_is_not_retried_blindly():
+    policy = RetryPolicy()
+    for action in ("edit_account_user", "change_password"):
+        decision = policy.classify("POST", {"action": action}, error=requests.exceptions.ReadTimeout())
+        assert decision == RetryPolicy.RETRYABLE_ONCE
+
+
+# End def test_password_change_is_not_retried_blindly()
+
+
+@pytest.mark.parametrize(
+    "current_version, target_version, expected",
+    [
+        ("UserConnect-6.5.1000", "6.5", True),
+        ("UserConnect-6.5.1000", "6.5.1000", True),
+        ("UserConnect-6.50.1", "6.5", False),
+        ("UserConnect-16.5.1", "6.5", False),
+        ("UserConnect-6.5", "6.5.1000", False),
+        ("", "6.5", False),
+    ],
+)
+def test_is_target_version(current_version, target_version, expected):
+    assert (
+        aviatrix_controller_init.is_target_version(current_version=current_version, target_version=target_version)
+        == expected
+    )
+
+
+# End def test_is_target_version()
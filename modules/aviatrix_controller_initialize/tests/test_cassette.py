@@ -0,0 +1,51 @@
+import json
+
+import aviatrix_controller_init
+from benchmark_init import build_event
+
+
+def test_record_and_replay(start_controller, tmp_path):
+    cassette_file = str(tmp_path / "cassette.json")
+    # the not-ready answers of the wake-up are recorded whatever the timing of the probes
+    server, hostname = start_controller("counted-wakeup")
+    event = dict(
+        build_event(hostname=hostname, private_ip=server.state.private_ip), arm_application_client_secret="s3cr3t-value"
+    )
+    aviatrix_controller_init.configure_aviatrix_session(cassette_mode="record", cassette_file=cassette_file)
+    aviatrix_controller_init.function_handler(event)
+    aviatrix_controller_init.close_aviatrix_session()
+
+    with open(cassette_file) as f:
+        text = f.read()
+    interactions = json.loads(text)["interactions"]
+    transient_interactions = [interaction for interaction in interactions if interaction["transient"]]
+    assert [interaction.get("status_code") for interaction in transient_interactions] == [503, 200, 200]
+    # no credential, session token or license key is written to the cassette
+    for secret in ["Aviatrix123#", "s3cr3t-value", server.state.private_ip, "aviatrix-1234567.89", "CID000001"]:
+        assert secret not in text
+    logins = [interaction for interaction in interactions if interaction["key"][2] == "login"]
+    assert '"CID": "************"' in logins[-1]["body"]
+
+    # the replay needs no controller and sends the placeholders back
+    aviatrix_controller_init.invalidate_response_cache()
+    aviatrix_controller_init.configure_aviatrix_session(
+        cassette_mode="replay", cassette_file=cassette_file, cassette_speed="instant"
+    )
+    assert aviatrix_controller_init.is_replaying_cassette()
+    request_count = server.state.request_count
+    aviatrix_controller_init.function_handler(dict(event, hostname="192.0.2.1"))
+    assert server.state.request_count == request_count
+
+
+# End def test_record_and_replay()
+
+
+def test_nested_fields_are_redacted():
+    fields = {"results": [{"account_name": "a", "arm_application_client_secret": "s"}], "customer_id": "c"}
+    assert aviatrix_controller_init.redact_fields(fields) == {
+        "results": [{"account_name": "a", "arm_application_client_secret": "************"}],
+        "customer_id": "************",
+    }
+
+
+# End def test_nested_fields_are_redacted()
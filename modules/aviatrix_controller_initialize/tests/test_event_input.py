@@ -0,0 +1,162 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import aviatrix_controller_init
+from aviatrix_controller_init import AviatrixException, InvalidRecord
+from benchmark_init import build_event
+
+legacy_arguments = [
+    "1.2.3.4",
+    "10.0.0.4",
+    "admin@example.com",
+    "Aviatrix123#",
+    "subscription",
+    "client-id",
+    "client-secret",
+    "tenant",
+    "account@example.com",
+    "azure-account",
+    "customer-id",
+    "6.6",
+]
+
+
+@pytest.mark.parametrize(
+    "text, hostnames",
+    [
+        ('{"hostname": "a"}\n\n# a comment\n{"hostname": "b"}\n', ["a", "b"]),
+        ('[{"hostname": "a"},\n {"hostname": "b"}]\n', ["a", "b"]),
+        ('\n{\n  "hostname": "a"\n}\n', ["a"]),
+        ("", []),
+    ],
+)
+def test_read_json_records(text, hostnames):
+    records = aviatrix_controller_init.read_json_records(io.StringIO(text))
+    assert [record["hostname"] for record in records] == hostnames
+
+
+# End def test_read_json_records()
+
+
+def test_read_json_records_with_plain_lines():
+    text = "1.2.3.4\n# a comment\n{\"hostname\": \"5.6.7.8\", \"username\": \"auditor\"}\n"
+    records = list(aviatrix_controller_init.read_json_records(io.StringIO(text), read_line=str))
+    assert records == ["1.2.3.4", {"hostname": "5.6.7.8", "username": "auditor"}]
+
+
+# End def test_read_json_records_with_plain_lines()
+
+
+def test_read_events_is_lazy():
+    # the first event is yielded before the rest of the stream is read
+    def lines():
+        yield json.dumps({"hostname": "a"}) + "\n"
+        raise AssertionError("read past the first event")
+
+    events = aviatrix_controller_init.read_events(lines())
+    event = next(events)
+    assert event["hostname"] == "a"
+    assert event["aviatrix_api_version"] == "v1"
+    assert event["aviatrix_api_route"] == "api"
+    assert event["controller_init_version"] == "latest"
+
+
+# End def test_read_events_is_lazy()
+
+
+def test_invalid_lines_are_yielded_and_skipped():
+    # one line that cannot be read does not stop the stream
+    text = '{"hostname": "a"}\n{"hostname": \n["b"]\nnot json\n{"hostname": "c"}\n'
+    records = list(aviatrix_controller_init.read_json_records(io.StringIO(text)))
+    assert records[0] == {"hostname": "a"}
+    assert isinstance(records[1], InvalidRecord) and records[1].line_number == 2
+    assert records[2] == ["b"]
+    assert isinstance(records[3], InvalidRecord) and records[3].line_number == 4
+    assert records[4] == {"hostname": "c"}
+
+    # also when the first line is the invalid one
+    records = list(aviatrix_controller_init.read_json_records(io.StringIO('{"hostname"\n{"hostname": "a"}\n')))
+    assert isinstance(records[0], InvalidRecord) and records[0].line_number == 1
+    assert records[1] == {"hostname": "a"}
+
+    # an event that is not an object
+    events = list(aviatrix_controller_init.read_events(io.StringIO(text)))
+    assert [event["hostname"] for event in events if isinstance(event, dict)] == ["a", "c"]
+    assert "must be a JSON object" in str(events[2].to_exception())
+
+
+# End def test_invalid_lines_are_yielded_and_skipped()
+
+
+def test_build_event_from_arguments():
+    event = aviatrix_controller_init.build_event_from_arguments(legacy_arguments)
+    assert event["hostname"] == "1.2.3.4"
+    assert event["access_account_name"] == "azure-account"
+    assert event["aviatrix_customer_id"] == "customer-id"
+    assert event["controller_init_version"] == "6.6"
+    assert event["aviatrix_api_route"] == "api"
+    with pytest.raises(AviatrixException):
+        aviatrix_controller_init.build_event_from_arguments(legacy_arguments[:11])
+
+
+# End def test_build_event_from_arguments()
+
+
+def test_stream_initializes_every_controller(start_controller):
+    servers = [start_controller("ready") for i in range(3)]
+    stream = io.StringIO(
+        "".join(
+            json.dumps(build_event(hostname=hostname, private_ip=server.state.private_ip)) + "\n"
+            for server, hostname in servers
+        )
+        + json.dumps({"hostname": "127.0.0.1:1", "ucc_private_ip": "10.0.0.4", "deadline": 1}) + "\n"
+        + '{"hostname": "truncated\n'
+        + '"not an event"\n'
+    )
+    results = list()
+    failures = aviatrix_controller_init.function_handler_stream(
+        events=aviatrix_controller_init.read_events(stream), max_concurrency=2, on_result=results.append
+    )
+    # every line has its result, also the ones that are not an event
+    assert failures == 3
+    assert len(results) == 6
+    assert sorted(result["hostname"] for result in results if result["success"]) == sorted(
+        hostname for server, hostname in servers
+    )
+    for server, hostname in servers:
+        assert server.state.password == "Aviatrix123#"
+
+
+# End def test_stream_initializes_every_controller()
+
+
+def run_script(arguments, event, environ=dict()):
+    # run aviatrix_controller_init.py in its own process, returns its exit code
+    return subprocess.run(
+        [sys.executable, "-W", "ignore", os.path.abspath(aviatrix_controller_init.__file__)] + arguments,
+        input=json.dumps(event),
+        env=dict(os.environ, **environ),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+        timeout=60,
+    ).returncode
+
+
+# End def run_script()
+
+
+def test_event_env_keeps_exit_code_zero(closed_port):
+    # the Terraform path: a failed initialization is logged, like with the 12 positional arguments
+    event = build_event(hostname="127.0.0.1:%d" % closed_port, private_ip="10.0.0.4")
+    event["deadline"] = 1
+    assert run_script(["--event-env", "AVIATRIX_INIT_EVENT"], dict(), {"AVIATRIX_INIT_EVENT": json.dumps(event)}) == 0
+    assert run_script(["-"], event) == 1
+
+
+# End def test_event_env_keeps_exit_code_zero()
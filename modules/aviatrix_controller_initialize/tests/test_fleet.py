@@ -0,0 +1,57 @@
+import threading
+import time
+
+import aviatrix_controller_init
+from benchmark_init import build_event
+
+
+def test_fleet_initializes_every_controller(start_controller):
+    servers = [start_controller("ready") for i in range(3)]
+    failing_server, failing_hostname = start_controller("not-found")
+    events = [
+        build_event(hostname=hostname, private_ip=server.state.private_ip)
+        for server, hostname in servers + [(failing_server, failing_hostname)]
+    ]
+    reported = list()
+    results = aviatrix_controller_init.function_handler_fleet(
+        events=events, max_concurrency=2, on_result=reported.append
+    )
+    # on_result() gets every result as it completes, in the order of the returned list
+    assert reported == results
+    assert sorted(result["hostname"] for result in results if result["success"]) == sorted(
+        hostname for server, hostname in servers
+    )
+    failed = [result for result in results if not result["success"]]
+    assert [result["hostname"] for result in failed] == [failing_hostname]
+    assert "404" in failed[0]["error"]
+    for server, hostname in servers:
+        assert server.state.password == "Aviatrix123#"
+        assert list(server.state.accounts) == ["azure-account"]
+    assert failing_server.state.admin_email is None
+
+
+# End def test_fleet_initializes_every_controller()
+
+
+def test_fleet_bounds_concurrency(monkeypatch):
+    in_flight = [0]
+    max_in_flight = [0]
+    lock = threading.Lock()
+
+    def initialize_controller(event):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        return {"hostname": event["hostname"], "success": True, "error": "", "duration": 0.05}
+
+    monkeypatch.setattr(aviatrix_controller_init, "initialize_controller", initialize_controller)
+    events = [{"hostname": "10.0.0.%d" % i} for i in range(10)]
+    results = aviatrix_controller_init.function_handler_fleet(events=events, max_concurrency=3)
+    assert sorted(result["hostname"] for result in results) == sorted(event["hostname"] for event in events)
+    assert max_in_flight[0] == 3
+
+
+# End def test_fleet_bounds_concurrency()
@@ -0,0 +1,114 @@
+import csv
+import io
+import json
+import time
+
+import aviatrix_controller_init
+import aviatrix_fleet_audit
+from benchmark_init import build_event
+
+read_only_actions = set(["login", "initial_setup", "list_version_info", "list_accounts"])
+
+
+def test_audit_fleet(start_controller, closed_port):
+    initialized_server, initialized_hostname = start_controller("ready")
+    aviatrix_controller_init.function_handler(
+        build_event(hostname=initialized_hostname, private_ip=initialized_server.state.private_ip)
+    )
+    new_server, new_hostname = start_controller("ready")
+    initialized_server.state.action_count.clear()
+
+    targets = aviatrix_fleet_audit.read_audit_targets(
+        io.StringIO(
+            "\n".join(
+                [
+                    initialized_hostname,
+                    json.dumps({"hostname": new_hostname, "password": new_server.state.private_ip}),
+                    json.dumps({"hostname": initialized_hostname, "password": "wrong-password"}),
+                    "127.0.0.1:%d" % closed_port,
+                ]
+            )
+        )
+    )
+    rows = list()
+    report = aviatrix_fleet_audit.audit_fleet(
+        targets=targets, max_concurrency=4, timeout=5, password="Aviatrix123#", on_row=rows.append
+    )
+    assert len(rows) == 4
+    initialized, new, wrong_password, unreachable = report
+
+    assert initialized["reachable"] and initialized["logged_in"] and initialized["initialized"]
+    assert initialized["version"] == initialized_server.state.current_version.replace("UserConnect-", "")
+    assert initialized["accounts"] == ["azure-account"]
+    assert initialized["account_count"] == 1
+    assert initialized["error"] == ""
+
+    assert new["logged_in"] and new["initialized"] is False
+    assert new["accounts"] == []
+
+    assert wrong_password["reachable"] and not wrong_password["logged_in"]
+    assert wrong_password["error"]
+
+    assert not unreachable["reachable"]
+    assert unreachable["error"]
+
+    # the audit does not change the controllers
+    for server in (initialized_server, new_server):
+        assert set(server.state.action_count) <= read_only_actions
+    assert initialized_server.state.password == "Aviatrix123#"
+    assert new_server.state.admin_email is None
+
+
+# End def test_audit_fleet()
+
+
+def test_invalid_targets_are_reported(start_controller):
+    server, hostname = start_controller("ready")
+    targets = aviatrix_fleet_audit.read_audit_targets(
+        io.StringIO('{"hostname": \n{"username": "admin"}\n' + hostname + "\n")
+    )
+    rows = aviatrix_fleet_audit.audit_fleet(targets=targets, timeout=5, password=server.state.private_ip)
+    assert [row["hostname"] for row in rows] == [None, None, hostname]
+    assert "Invalid record on line 1" in rows[0]["error"]
+    assert "has no hostname" in rows[1]["error"]
+    assert rows[2]["logged_in"]
+
+
+# End def test_invalid_targets_are_reported()
+
+
+def test_audit_is_bounded_by_host_timeout(start_controller):
+    # the API server answers the dummy login after 5 seconds
+    server, hostname = start_controller({"response_delays": {"login": ("fixed", 5)}})
+    start_time = time.monotonic()
+    row = aviatrix_fleet_audit.audit_controller(hostname=hostname, password=server.state.private_ip, timeout=1)
+    assert time.monotonic() - start_time < 3
+    assert not row["reachable"]
+    assert row["error"]
+    assert row["duration"] < 3
+
+
+# End def test_audit_is_bounded_by_host_timeout()
+
+
+def test_write_audit_report():
+    rows = [dict((column, None) for column in aviatrix_fleet_audit.audit_columns) for i in range(2)]
+    rows[0].update({"hostname": "a", "reachable": True, "accounts": ["x", "y"], "account_count": 2, "error": ""})
+    rows[1].update({"hostname": "b", "reachable": False, "error": "refused"})
+
+    stream = io.StringIO()
+    aviatrix_fleet_audit.write_audit_report(rows, stream, output_format="json")
+    columns = json.loads(stream.getvalue())
+    assert list(columns) == aviatrix_fleet_audit.audit_columns
+    assert columns["hostname"] == ["a", "b"]
+    assert columns["accounts"] == [["x", "y"], None]
+
+    stream = io.StringIO()
+    aviatrix_fleet_audit.write_audit_report(rows, stream, output_format="csv")
+    lines = list(csv.reader(io.StringIO(stream.getvalue())))
+    assert lines[0] == aviatrix_fleet_audit.audit_columns
+    assert lines[1][aviatrix_fleet_audit.audit_columns.index("accounts")] == "x;y"
+    assert lines[2][aviatrix_fleet_audit.audit_columns.index("error")] == "refused"
+
+
+# End def test_write_audit_report()
@@ -0,0 +1,154 @@
+import pytest
+
+import aviatrix_controller_init
+from aviatrix_controller_init import AviatrixException, InitJournal
+from benchmark_init import build_event
+
+
+def run_init(hostname, private_ip, journal_dir="", steps=None, deadline=60, **event_keys):
+    # run_init_steps() of one controller, like run_controller_initialization() does
+    event = dict(build_event(hostname=hostname, private_ip=private_ip), **event_keys)
+    context = aviatrix_controller_init.build_init_context(event)
+    journal = InitJournal(journal_dir=journal_dir, hostname=hostname, ucc_private_ip=private_ip)
+    context["journal"] = journal
+    if steps is None:
+        steps = aviatrix_controller_init.build_init_steps()
+    with aviatrix_controller_init.time_budget(deadline):
+        aviatrix_controller_init.run_init_steps(steps=steps, context=context, journal=journal)
+    return context
+
+
+# End def run_init()
+
+
+def assert_initialized(state):
+    assert state.upgrade_is_done()
+    assert state.admin_email == "admin@example.com"
+    assert state.password == "Aviatrix123#"
+    assert state.customer_id == "aviatrix-1234567.89"
+    assert list(state.accounts) == ["azure-account"]
+
+
+# End def assert_initialized()
+
+
+@pytest.mark.parametrize("scenario", ["ready", "fast-wakeup", "request-refused", "legacy-password-api"])
+def test_init_succeeds(start_controller, scenario):
+    server, hostname = start_controller(scenario)
+    run_init(hostname, server.state.private_ip)
+    assert_initialized(server.state)
+
+
+# End def test_init_succeeds()
+
+
+def test_init_fails_on_not_found(start_controller):
+    server, hostname = start_controller("not-found")
+    with pytest.raises(AviatrixException) as excinfo:
+        run_init(hostname, server.state.private_ip)
+    assert "404" in str(excinfo.value)
+    assert server.state.admin_email is None
+
+
+# End def test_init_fails_on_not_found()
+
+
+def test_initial_setup_is_checked_once(start_controller):
+    # the check of step 3 tells step 7 that the initial setup has not run yet
+    server, hostname = start_controller("ready")
+    run_init(hostname, server.state.private_ip)
+    assert_initialized(server.state)
+    # the check and the run
+    assert server.state.action_count["initial_setup"] == 2
+
+
+# End def test_initial_setup_is_checked_once()
+
+
+def test_upgrade_connection_drop_is_tracked(start_controller):
+    # the "run" request is dropped while the upgrade goes on, the upgrade is polled to its end
+    server, hostname = start_controller("upgrade-connection-drop")
+    context = run_init(hostname, server.state.private_ip)
+    assert_initialized(server.state)
+    # the dropped call did not count towards the circuit breaker of the controller
+    circuit_breaker = aviatrix_controller_init.get_circuit_breaker(context["api_endpoint_url"])
+    assert circuit_breaker.open_until is None
+
+
+# End def test_upgrade_connection_drop_is_tracked()
+
+
+def test_journal_resumes_after_failed_step(start_controller, tmp_path):
+    server, hostname = start_controller("ready")
+    private_ip = server.state.private_ip
+
+    def fail(context):
+        raise AviatrixException(message="set customer id failed")
+
+    steps = aviatrix_controller_init.build_init_steps()
+    steps[10].run = fail
+    with pytest.raises(AviatrixException):
+        run_init(hostname, private_ip, journal_dir=str(tmp_path), steps=steps)
+    assert server.state.customer_id is None
+    journal = InitJournal(journal_dir=str(tmp_path), hostname=hostname, ucc_private_ip=private_ip)
+    assert journal.completed_steps == set([1, 2, 3, 4, 5, 6, 7, 8, 9, 11])
+
+    # the resumed run only re-logs in and runs the failed step
+    action_count = dict(server.state.action_count)
+    run_init(hostname, private_ip, journal_dir=str(tmp_path))
+    assert_initialized(server.state)
+    assert server.state.action_count.get("initial_setup") == action_count.get("initial_setup")
+    assert server.state.action_count.get("setup_account_profile") == action_count.get("setup_account_profile")
+    assert server.state.action_count["setup_customer_id"] == 1
+
+
+# End def test_journal_resumes_after_failed_step()
+
+
+def test_journal_ignores_previous_controller(start_controller, tmp_path):
+    # entries of another private ip belong to a previous controller with the same public ip
+    server, hostname = start_controller("ready")
+    journal = InitJournal(journal_dir=str(tmp_path), hostname=hostname, ucc_private_ip="10.0.0.99")
+    for step in range(1, 12):
+        journal.record(step)
+    run_init(hostname, server.state.private_ip, journal_dir=str(tmp_path))
+    assert_initialized(server.state)
+
+
+# End def test_journal_ignores_previous_controller()
+
+
+def test_journal_ignores_previous_instance(tmp_path):
+    # a redeployed controller can get the same public and private ip as the previous one
+    journal = InitJournal(
+        journal_dir=str(tmp_path), hostname="10.1.1.1", ucc_private_ip="10.0.0.4", instance_id="vm-1"
+    )
+    journal.record(1)
+    journal = InitJournal(
+        journal_dir=str(tmp_path), hostname="10.1.1.1", ucc_private_ip="10.0.0.4", instance_id="vm-2"
+    )
+    assert journal.completed_steps == set()
+    journal.record(1)
+    journal.clear()
+    assert not InitJournal(
+        journal_dir=str(tmp_path), hostname="10.1.1.1", ucc_private_ip="10.0.0.4", instance_id="vm-2"
+    ).is_completed(1)
+
+
+# End def test_journal_ignores_previous_instance()
+
+
+def test_race_pins_reachable_address(start_controller):
+    # the public address refuses connections, the private one of the same port answers
+    server, hostname = start_controller("ready", private_ip="127.0.0.1")
+    port = server.server_address[1]
+    public_hostname = "127.0.0.2:%d" % port
+    context = run_init(public_hostname, "127.0.0.1", endpoint_mode="race")
+    assert context["endpoint_hostnames"] == [public_hostname, hostname]
+    assert_initialized(server.state)
+    assert aviatrix_controller_init.resolve_api_endpoint(context["api_endpoint_url"]) == (
+        "https://" + hostname + "/v1/api"
+    )
+
+
+# End def test_race_pins_reachable_address()
@@ -0,0 +1,86 @@
+import pytest
+
+import aviatrix_controller_init
+import loadtest_controller_api
+from aviatrix_controller_init import CircuitBreaker
+
+
+def send_call(hostname, password, action_key=("list_version_info", None), timeout=5):
+    api_endpoint_url = "https://" + hostname + "/v1/api"
+    aviatrix_controller_init.configure_circuit_breaker(api_endpoint_url, CircuitBreaker(failure_threshold=0))
+    return loadtest_controller_api.send_load_test_call(
+        api_endpoint_url=api_endpoint_url, password=password, CID="CID000001", action_key=action_key, timeout=timeout
+    )
+
+
+# End def send_call()
+
+
+def test_call_outcomes(start_controller, closed_port):
+    server, hostname = start_controller("ready")
+    server.started.wait()
+    assert send_call(hostname, server.state.password, ("login", None)) == "ok"
+    assert send_call(hostname, server.state.password) == "ok"
+    assert send_call(hostname, "wrong-password", ("login", None)) == "rejected"
+    assert send_call("127.0.0.1:%d" % closed_port, "password") == "connection"
+
+
+# End def test_call_outcomes()
+
+
+@pytest.mark.parametrize(
+    "scenario, outcome",
+    [
+        ({"boot_phases": [("http_503", ("fixed", 30))]}, "http_503"),
+        ({"boot_phases": [("request_refused", ("fixed", 30))]}, "refused"),
+        ({"response_delays": {"list_version_info": ("fixed", 2)}}, "timeout"),
+    ],
+)
+def test_error_kinds(start_controller, scenario, outcome):
+    server, hostname = start_controller(scenario)
+    server.started.wait()
+    assert send_call(hostname, server.state.password, timeout=0.5) == outcome
+
+
+# End def test_error_kinds()
+
+
+def test_load_test_finds_error_onset(start_controller):
+    # the stand-in refuses the calls above 8 in flight
+    server, hostname = start_controller("limited-capacity")
+    server.started.wait()
+    stages = list()
+    result = loadtest_controller_api.run_load_test(
+        api_endpoint_url="https://" + hostname + "/v1/api",
+        password=server.state.password,
+        action_mix=loadtest_controller_api.parse_action_mix(),
+        concurrency_stages=[1, 64, 128],
+        duration=0.5,
+        error_threshold=0.01,
+        on_stage=stages.append,
+    )
+    assert result["stages"] == stages
+    assert stages[0]["error_rate"] == 0
+    assert stages[0]["requests"] > 0
+    assert stages[0]["p50_ms"] <= stages[0]["p99_ms"]
+    # the ramp stops at the first stage over the threshold
+    assert result["onset"] is stages[-1]
+    assert result["onset"]["concurrency"] > 1
+    assert "refused" in result["onset"]["errors"]
+    # the circuit breaker of the controller is restored
+    assert aviatrix_controller_init.get_circuit_breaker("https://" + hostname + "/v1/api").failure_threshold > 0
+
+
+# End def test_load_test_finds_error_onset()
+
+
+def test_parse_action_mix():
+    assert loadtest_controller_api.parse_action_mix("initial_setup:check=4,login") == [
+        (("initial_setup", "check"), 4.0),
+        (("login", None), 1.0),
+    ]
+    with pytest.raises(ValueError):
+        loadtest_controller_api.parse_action_mix("setup_account_profile=1")
+
+
+# End def test_parse_action_mix()
@@ -0,0 +1,111 @@
+import pytest
+import requests
+
+import aviatrix_controller_init
+import aviatrix_file_lock
+import aviatrix_metrics
+from aviatrix_controller_init import AviatrixException, AviatrixMetrics
+from benchmark_init import build_event
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    # the metrics of one process, see get_metrics()
+    monkeypatch.setattr(aviatrix_metrics, "_metrics", None)
+
+
+# End def fresh_metrics()
+
+
+def read_samples(text):
+    # {"name{labels}": value} of the Prometheus text format
+    samples = dict()
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+# End def read_samples()
+
+
+def test_metrics_file_accumulates_runs(start_controller, monkeypatch, tmp_path):
+    metrics_file = str(tmp_path / "aviatrix_init.prom")
+    server, hostname = start_controller("request-refused")
+    event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+    event["metrics_file"] = metrics_file
+    aviatrix_controller_init.function_handler(event)
+
+    with open(metrics_file) as f:
+        samples = read_samples(f.read())
+    assert samples['aviatrix_init_duration_seconds_count{outcome="success"}'] == 1
+    assert samples['aviatrix_api_server_wait_seconds_count{outcome="ready"}'] == 2
+    assert samples['aviatrix_upgrade_duration_seconds_count{outcome="confirmed"}'] == 1
+    assert samples['aviatrix_api_backend_not_ready_total{reason="request_refused"}'] >= 1
+    assert samples['aviatrix_api_request_duration_seconds_count{action="initial_setup",status="200"}'] == 2
+
+    # the run of another process is added to the totals of the file
+    monkeypatch.setattr(aviatrix_metrics, "_metrics", None)
+    server, hostname = start_controller("not-found")
+    event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+    event["metrics_file"] = metrics_file
+    with pytest.raises(AviatrixException):
+        aviatrix_controller_init.function_handler(event)
+
+    with open(metrics_file) as f:
+        samples = read_samples(f.read())
+    assert samples['aviatrix_init_duration_seconds_count{outcome="success"}'] == 1
+    assert samples['aviatrix_init_duration_seconds_count{outcome="failure"}'] == 1
+    assert samples['aviatrix_upgrade_duration_seconds_count{outcome="confirmed"}'] == 1
+
+
+# End def test_metrics_file_accumulates_runs()
+
+
+def test_metrics_file_keeps_histograms():
+    metrics = AviatrixMetrics()
+    for value in [0.01, 0.2, 3]:
+        metrics.observe("aviatrix_api_request_duration_seconds", value, action="login", status="200")
+    metrics.inc("aviatrix_api_retries_total", action="login", reason="http_502")
+    samples = read_samples(metrics.to_text())
+    labels = 'action="login",status="200"'
+    assert samples["aviatrix_api_request_duration_seconds_bucket{" + labels + ',le="0.05"}'] == 1
+    assert samples["aviatrix_api_request_duration_seconds_bucket{" + labels + ',le="0.25"}'] == 2
+    assert samples["aviatrix_api_request_duration_seconds_bucket{" + labels + ',le="+Inf"}'] == 3
+    assert samples["aviatrix_api_request_duration_seconds_sum{" + labels + "}"] == pytest.approx(3.21)
+    assert samples['aviatrix_api_retries_total{action="login",reason="http_502"}'] == 1
+
+
+# End def test_metrics_file_keeps_histograms()
+
+
+def test_metrics_file_without_fcntl(monkeypatch, tmp_path):
+    # Windows has no fcntl, the text file is still written
+    monkeypatch.setattr(aviatrix_file_lock, "fcntl", None)
+    metrics = AviatrixMetrics()
+    metrics.inc("aviatrix_api_retries_total", action="login", reason="http_502")
+    metrics.write_text_file(str(tmp_path / "aviatrix_init.prom"))
+    with open(str(tmp_path / "aviatrix_init.prom")) as f:
+        assert read_samples(f.read())['aviatrix_api_retries_total{action="login",reason="http_502"}'] == 1
+
+
+# End def test_metrics_file_without_fcntl()
+
+
+def test_metrics_server(closed_port):
+    server = aviatrix_controller_init.start_metrics_server(port=closed_port)
+    try:
+        aviatrix_controller_init.get_metrics().inc("aviatrix_api_retries_total", action="login", reason="Timeout")
+        response = requests.get("http://127.0.0.1:%d/metrics" % closed_port, timeout=5)
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+        assert read_samples(response.text)['aviatrix_api_retries_total{action="login",reason="Timeout"}'] == 1
+        assert requests.get("http://127.0.0.1:%d/" % closed_port, timeout=5).status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert aviatrix_controller_init.start_metrics_server(port=0) is None
+
+
+# End def test_metrics_server()
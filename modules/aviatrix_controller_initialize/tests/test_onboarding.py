@@ -0,0 +1,137 @@
+import io
+import time
+
+import aviatrix_account_onboarding
+import aviatrix_controller_init
+from aviatrix_controller_init import CircuitBreaker
+
+
+def azure_account(account_name):
+    return {
+        "account_name": account_name,
+        "account_email": account_name + "@example.com",
+        "arm_subscription_id": "00000000-0000-0000-0000-000000000000",
+        "arm_application_client_id": "client-id",
+        "arm_application_client_secret": "client-secret",
+    }
+
+
+# End def azure_account()
+
+
+def test_onboard_accounts(start_controller):
+    server, hostname = start_controller({"response_delays": {"setup_account_profile": ("fixed", 0.3)}})
+    server.state.accounts["existing"] = {"cloud_type": "8"}
+    stream = io.StringIO(
+        "\n".join(
+            [
+                '{"account_name": "existing"}',
+                '"not an object"',
+                '{"account_name": "truncated',
+                '{"cloud_type": "1"}',
+            ]
+            + ['{"account_name": "azure-%d", "account_email": "a@example.com"}' % i for i in range(8)]
+        )
+    )
+    results = list()
+    start_time = time.monotonic()
+    summary = aviatrix_account_onboarding.onboard_accounts(
+        api_endpoint_url="https://" + hostname + "/v1/api",
+        password=server.state.password,
+        accounts=aviatrix_controller_init.read_json_records(stream),
+        max_workers=8,
+        on_result=results.append,
+    )
+    # the 8 new accounts are created concurrently
+    assert time.monotonic() - start_time < 8 * 0.3
+    assert summary == {"created": 8, "exists": 1, "failed": 3}
+    # every line has its result, also the ones that are not an account definition
+    assert len(results) == 12
+    failed = sorted(result["error"] for result in results if result["status"] == "failed")
+    assert "Invalid record on line 3" in failed[0]
+    assert "has no account_name" in failed[1]
+    assert "not a JSON object" in failed[2]
+    assert sorted(server.state.accounts) == sorted(["existing"] + ["azure-%d" % i for i in range(8)])
+    assert server.state.accounts["azure-0"]["cloud_type"] == "8"
+
+
+# End def test_onboard_accounts()
+
+
+def test_account_created_meanwhile_exists(start_controller):
+    server, hostname = start_controller("ready")
+    api_endpoint_url = "https://" + hostname + "/v1/api"
+    server.state.accounts["azure-1"] = {"cloud_type": "8"}
+    result = aviatrix_account_onboarding.onboard_account(
+        api_endpoint_url=api_endpoint_url, password=server.state.password, account=azure_account("azure-1")
+    )
+    assert result["status"] == "exists"
+    assert result["error"] == ""
+
+
+# End def test_account_created_meanwhile_exists()
+
+
+def test_busy_controller_is_waited_for(start_controller):
+    # the circuit breaker of the controller is open, the account is sent once it lets calls through
+    server, hostname = start_controller("ready")
+    api_endpoint_url = "https://" + hostname + "/v1/api"
+    circuit_breaker = aviatrix_controller_init.configure_circuit_breaker(
+        api_endpoint_url, CircuitBreaker(failure_threshold=1, reset_timeout=1)
+    )
+    circuit_breaker.record_failure()
+    result = aviatrix_account_onboarding.onboard_account(
+        api_endpoint_url=api_endpoint_url,
+        password=server.state.password,
+        account=azure_account("azure-1"),
+        breaker_wait_time=5,
+    )
+    assert result["status"] == "created"
+    assert "azure-1" in server.state.accounts
+
+    circuit_breaker.record_failure()
+    result = aviatrix_account_onboarding.onboard_account(
+        api_endpoint_url=api_endpoint_url,
+        password=server.state.password,
+        account=azure_account("azure-2"),
+        breaker_wait_time=0,
+    )
+    assert result["status"] == "failed"
+
+
+# End def test_busy_controller_is_waited_for()
+
+
+def test_refused_calls_are_sent_again(start_controller):
+    # the controller takes one call at a time and refuses the others with "RequestRefused"
+    server, hostname = start_controller(
+        {"max_concurrent_requests": 1, "response_delays": {"setup_account_profile": ("fixed", 0.2)}}
+    )
+    summary = aviatrix_account_onboarding.onboard_accounts(
+        api_endpoint_url="https://" + hostname + "/v1/api",
+        password=server.state.password,
+        accounts=[azure_account("azure-%d" % i) for i in range(4)],
+        max_workers=4,
+    )
+    assert summary == {"created": 4, "exists": 0, "failed": 0}
+    assert server.state.action_count["setup_account_profile"] > 4
+
+
+# End def test_refused_calls_are_sent_again()
+
+
+def test_refused_connection_is_retried_within_budget(closed_port):
+    api_endpoint_url = "https://127.0.0.1:%d/v1/api" % closed_port
+    aviatrix_controller_init.configure_circuit_breaker(api_endpoint_url, CircuitBreaker(failure_threshold=0))
+    start_time = time.monotonic()
+    result = aviatrix_account_onboarding.onboard_account(
+        api_endpoint_url=api_endpoint_url, password="password", account=azure_account("azure-1"), breaker_wait_time=1
+    )
+    assert result["status"] == "failed"
+    assert "Failed to invoke Aviatrix API" in result["error"]
+    # sent again until the budget is used up, not longer
+    assert 0.5 < time.monotonic() - start_time < 5
+
+
+# End def test_refused_connection_is_retried_within_budget()
+
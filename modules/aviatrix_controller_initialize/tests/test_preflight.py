@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+import aviatrix_controller_init
+from aviatrix_controller_init import AviatrixException
+from benchmark_init import build_event
+
+client_id = "00000000-0000-0000-0000-000000000001"
+tenant_id = "00000000-0000-0000-0000-000000000002"
+
+
+def build_arm_event(server, hostname, endpoint):
+    # build_event() with the ARM credentials check against the stand-in token endpoint
+    event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+    event["preflight_arm_check"] = True
+    event["arm_endpoint"] = endpoint
+    event["arm_login_endpoint"] = endpoint
+    return event
+
+
+# End def build_arm_event()
+
+
+def test_preflight_accepts_credentials(start_controller, start_marketplace):
+    server, hostname = start_controller("ready")
+    marketplace, endpoint = start_marketplace(client_id=client_id, client_secret="secret", tenant_id=tenant_id)
+    aviatrix_controller_init.function_handler(build_arm_event(server, hostname, endpoint))
+    assert marketplace.state.request_count == 1
+    assert list(server.state.accounts) == ["azure-account"]
+
+
+# End def test_preflight_accepts_credentials()
+
+
+def test_preflight_waits_for_replication(start_controller, start_marketplace):
+    # the new service principal is not found during the first second
+    server, hostname = start_controller("ready")
+    marketplace, endpoint = start_marketplace(client_id=client_id, client_secret="secret", replication_delay=1)
+    aviatrix_controller_init.function_handler(build_arm_event(server, hostname, endpoint))
+    assert marketplace.state.request_count == 2
+    assert list(server.state.accounts) == ["azure-account"]
+
+
+# End def test_preflight_waits_for_replication()
+
+
+def test_rejected_credentials_abort_readiness_wait(start_controller, start_marketplace):
+    # the controller does not answer yet, the unknown tenant fails the run right away
+    server, hostname = start_controller({"boot_delay": ("fixed", 60)})
+    marketplace, endpoint = start_marketplace(client_id=client_id, client_secret="secret", tenant_id="other-tenant")
+    start_time = time.monotonic()
+    with pytest.raises(AviatrixException) as excinfo:
+        aviatrix_controller_init.function_handler(build_arm_event(server, hostname, endpoint))
+    assert "AADSTS90002" in str(excinfo.value)
+    assert time.monotonic() - start_time < 10
+    assert marketplace.state.request_count == 1
+    assert server.state.request_count == 0
+
+
+# End def test_rejected_credentials_abort_readiness_wait()
+
+
+def test_invalid_secret_is_left_to_access_account(start_marketplace):
+    # a new secret may not be replicated yet: retried during the wait, then only logged
+    marketplace, endpoint = start_marketplace(client_id=client_id, client_secret="secret")
+    is_valid = aviatrix_controller_init.check_arm_credentials(
+        tenant_id=tenant_id,
+        client_id=client_id,
+        client_secret="wrong-secret",
+        arm_endpoint=endpoint,
+        arm_login_endpoint=endpoint,
+        replication_wait_time=1,
+    )
+    assert is_valid is False
+    assert marketplace.state.request_count == 1
+
+    # the retries stop when the run is aborted
+    abort_event = threading.Event()
+    threading.Timer(0.3, abort_event.set).start()
+    start_time = time.monotonic()
+    is_valid = aviatrix_controller_init.check_arm_credentials(
+        tenant_id=tenant_id,
+        client_id=client_id,
+        client_secret="wrong-secret",
+        arm_endpoint=endpoint,
+        arm_login_endpoint=endpoint,
+        replication_wait_time=60,
+        abort_event=abort_event,
+    )
+    assert is_valid is False
+    assert time.monotonic() - start_time < 2
+    assert marketplace.state.request_count == 2
+
+
+# End def test_invalid_secret_is_left_to_access_account()
+
+
+def test_unreachable_token_endpoint_is_skipped(start_controller, closed_port):
+    server, hostname = start_controller("ready")
+    aviatrix_controller_init.function_handler(
+        build_arm_event(server, hostname, "http://127.0.0.1:%d" % closed_port)
+    )
+    assert list(server.state.accounts) == ["azure-account"]
+
+
+# End def test_unreachable_token_endpoint_is_skipped()
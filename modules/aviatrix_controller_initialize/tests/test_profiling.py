@@ -0,0 +1,77 @@
+import json
+import os
+import pstats
+import tracemalloc
+
+import pytest
+
+import aviatrix_controller_init
+from aviatrix_controller_init import AviatrixException
+from benchmark_init import build_event
+
+
+def get_run_dir(profile_dir):
+    # the directory of the only run profiled in profile_dir
+    run_dirs = os.listdir(profile_dir)
+    assert len(run_dirs) == 1
+    return os.path.join(profile_dir, run_dirs[0])
+
+
+# End def get_run_dir()
+
+
+def test_profile_run(start_controller, tmp_path):
+    server, hostname = start_controller("ready")
+    event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+    event["profile_dir"] = str(tmp_path)
+    aviatrix_controller_init.function_handler(event)
+
+    run_dir = get_run_dir(str(tmp_path))
+    assert os.path.basename(run_dir).startswith(hostname.replace(":", "_") + "-")
+    with open(os.path.join(run_dir, "sections.json")) as f:
+        sections = dict((section["name"], section) for section in json.load(f))
+    assert sections["run"]["calls"] == 1
+    for number in range(0, 12):
+        assert len([name for name in sections if name.startswith("step%d " % number)]) == 1
+    # the two readiness waits, and every request but their HTTP and API probes
+    assert sections["wait_until_controller_api_server_is_ready"]["calls"] == 2
+    assert sections["send_aviatrix_api"]["calls"] == server.state.request_count - 4
+    for section in sections.values():
+        assert section["wait_s"] == pytest.approx(max(section["wall_s"] - section["cpu_s"], 0.0))
+
+    # the stats of the steps, together in run.prof
+    assert [name for name in os.listdir(run_dir) if name.startswith("step") and name.endswith(".prof")]
+    stats = pstats.Stats(os.path.join(run_dir, "run.prof"))
+    assert any(function_name == "send_aviatrix_api" for (file_name, line, function_name) in stats.stats)
+    assert os.path.getsize(os.path.join(run_dir, "run.txt")) > 0
+    with open(os.path.join(run_dir, "categories.json")) as f:
+        categories = json.load(f)
+    assert set(categories) == set(["tls", "json", "logging", "sleep_and_wait", "http", "other"])
+    assert categories["http"] > 0
+    assert not os.path.exists(os.path.join(run_dir, "memory.txt"))
+
+
+# End def test_profile_run()
+
+
+def test_profile_memory_of_failed_run(start_controller, tmp_path):
+    server, hostname = start_controller("not-found")
+    event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+    event["profile_dir"] = str(tmp_path)
+    event["profile_memory"] = "true"
+    with pytest.raises(AviatrixException):
+        aviatrix_controller_init.function_handler(event)
+
+    # the profile of a failed run is still written, and tracemalloc is stopped
+    run_dir = get_run_dir(str(tmp_path))
+    assert not tracemalloc.is_tracing()
+    assert os.path.getsize(os.path.join(run_dir, "memory.txt")) > 0
+    assert os.path.exists(os.path.join(run_dir, "run.tracemalloc"))
+    snapshots = [name for name in os.listdir(run_dir) if name.startswith("step") and name.endswith(".tracemalloc")]
+    assert snapshots
+    tracemalloc.Snapshot.load(os.path.join(run_dir, snapshots[0]))
+    with open(os.path.join(run_dir, "sections.json")) as f:
+        assert "run" in [section["name"] for section in json.load(f)]
+
+
+# End def test_profile_memory_of_failed_run()
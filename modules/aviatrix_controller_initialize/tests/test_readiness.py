@@ -0,0 +1,242 @@
+import json
+import threading
+
+import pytest
+
+import aviatrix_controller_init
+import aviatrix_file_lock
+import aviatrix_wakeup_history
+from aviatrix_controller_init import AviatrixException, WakeupHistory
+from benchmark_init import build_event
+
+
+@pytest.fixture
+def wakeup_history(monkeypatch, tmp_path):
+    wakeup_history = WakeupHistory(history_file=str(tmp_path / "wakeup_history.json"), size=10, min_samples=3)
+    monkeypatch.setattr(aviatrix_wakeup_history, "_wakeup_history", wakeup_history)
+    return wakeup_history
+
+
+# End def wakeup_history()
+
+
+def test_staged_probes_wait_for_boot(start_controller):
+    server, hostname = start_controller("fast-wakeup")
+    assert aviatrix_controller_init.wait_until_controller_api_server_is_ready(
+        hostname=hostname, total_wait_time=20, interval_wait_time=0.5
+    )
+    # the dummy login went through only once the backend was ready
+    assert "boot" in server.state.detection_lags
+    assert server.state.detection_lags["boot"] < 1
+
+
+# End def test_staged_probes_wait_for_boot()
+
+
+def test_slow_dummy_login_is_waited_for(start_controller):
+    # the answer to the dummy login is slower than the connect probes may take
+    server, hostname = start_controller({"response_delays": {"login": ("fixed", 1)}})
+    assert aviatrix_controller_init.wait_until_controller_api_server_is_ready(
+        hostname=hostname, total_wait_time=10, probe_timeout=0.5, api_probe_timeout=5
+    )
+    assert server.state.action_count["login"] == 1
+
+
+# End def test_slow_dummy_login_is_waited_for()
+
+
+def test_placeholder_page_is_not_ready(start_controller):
+    # Apache answers 200 with its placeholder page before the API is served
+    server, hostname = start_controller({"boot_phases": [("placeholder_page", ("fixed", 1))]})
+    server.started.wait()
+    api_endpoint_url = "https://" + hostname + "/v1/api"
+    is_ready, reason = aviatrix_controller_init.probe_controller_api(api_endpoint_url=api_endpoint_url)
+    assert not is_ready
+    assert aviatrix_controller_init.wait_until_controller_api_server_is_ready(
+        hostname=hostname, total_wait_time=10, interval_wait_time=0.2
+    )
+    assert server.state.detection_lags["boot"] < 1
+
+
+# End def test_placeholder_page_is_not_ready()
+
+
+def test_api_read_timeout_keeps_api_stage(start_controller):
+    server, hostname = start_controller({"response_delays": {"login": ("fixed", 1)}})
+    with pytest.raises(AviatrixException) as excinfo:
+        aviatrix_controller_init.wait_until_controller_api_server_is_ready(
+            hostname=hostname, total_wait_time=2, interval_wait_time=0.2, probe_timeout=0.5, api_probe_timeout=0.3
+        )
+    assert "The last probe was: api" in str(excinfo.value)
+
+
+# End def test_api_read_timeout_keeps_api_stage()
+
+
+def test_not_found_is_not_waited_for(start_controller):
+    server, hostname = start_controller("not-found")
+    with pytest.raises(AviatrixException) as excinfo:
+        aviatrix_controller_init.wait_until_controller_api_server_is_ready(hostname=hostname, total_wait_time=20)
+    assert "404" in str(excinfo.value)
+
+
+# End def test_not_found_is_not_waited_for()
+
+
+def test_wait_is_aborted(closed_port):
+    abort_event = threading.Event()
+    abort_event.set()
+    with pytest.raises(AviatrixException) as excinfo:
+        aviatrix_controller_init.wait_until_controller_api_server_is_ready(
+            hostname="127.0.0.1:%d" % closed_port, total_wait_time=20, abort_event=abort_event
+        )
+    assert "aborted" in str(excinfo.value)
+
+
+# End def test_wait_is_aborted()
+
+
+def test_history_falls_back_to_coarser_breakdown(wakeup_history):
+    wakeup_history.add("wakeup", "westeurope", "Standard_A4_v2", "6.5", 100)
+    wakeup_history.add("wakeup", "westeurope", "Standard_A4_v2", "6.6", 110)
+    wakeup_history.add("wakeup", "westeurope", "Standard_D4_v3", "6.6", 120)
+    wakeup_history.add("upgrade", "westeurope", "Standard_A4_v2", "6.6", 500)
+    # a single run of the version is not enough, the region has three
+    assert wakeup_history.get_durations("wakeup", "westeurope", "Standard_A4_v2", "6.6") == [100, 110, 120]
+    assert wakeup_history.get_durations("upgrade", "westeurope", "Standard_A4_v2", "6.6") == list()
+
+    # the history is shared through the file
+    with open(wakeup_history.history_file) as f:
+        assert len(json.load(f)) == 4
+    assert WakeupHistory(history_file=wakeup_history.history_file, min_samples=3).get_durations(
+        "wakeup", "eastus", None, None
+    ) == [100, 110, 120]
+
+
+# End def test_history_falls_back_to_coarser_breakdown()
+
+
+def test_history_keeps_last_durations(wakeup_history):
+    for duration in range(15):
+        wakeup_history.add("wakeup", "westeurope", None, None, duration)
+    assert wakeup_history.get_durations("wakeup", "westeurope", None, None) == list(range(5, 15))
+
+
+# End def test_history_keeps_last_durations()
+
+
+def test_history_without_fcntl(wakeup_history, monkeypatch):
+    # Windows has no fcntl, the history is still shared through the file
+    monkeypatch.setattr(aviatrix_file_lock, "fcntl", None)
+    wakeup_history.add("wakeup", "westeurope", None, None, 100)
+    assert WakeupHistory(history_file=wakeup_history.history_file).load() == {"wakeup|westeurope|*|*": [100]}
+
+
+# End def test_history_without_fcntl()
+
+
+def test_readiness_plan_is_learned(wakeup_history):
+    context = {"location": "westeurope", "vm_size": "Standard_A4_v2", "controller_init_version": "latest"}
+    plan = aviatrix_controller_init.get_readiness_plan(context, "wakeup", default_wait_time=300)
+    assert plan == {"wait_time": 300, "probe_schedule": None}
+
+    for duration in [100, 120, 140]:
+        aviatrix_controller_init.record_readiness_duration(context, "wakeup", duration)
+    plan = aviatrix_controller_init.get_readiness_plan(context, "wakeup", default_wait_time=300)
+    assert plan["wait_time"] == int(140 * aviatrix_controller_init.wakeup_wait_margin) + 1
+    # sparse probes before the earliest wake-up, dense ones until the latest, then the default
+    probe_schedule = plan["probe_schedule"]
+    assert probe_schedule(0) == aviatrix_controller_init.wakeup_sparse_probe_interval
+    assert probe_schedule(90) == 5
+    assert probe_schedule(110) == aviatrix_controller_init.wakeup_dense_probe_interval
+    assert probe_schedule(200) == 2
+
+    # a short history never plans a wait below the minimum
+    aviatrix_controller_init.record_readiness_duration(context, "restart", 1)
+    aviatrix_controller_init.record_readiness_duration(context, "restart", 2)
+    aviatrix_controller_init.record_readiness_duration(context, "restart", 3)
+    plan = aviatrix_controller_init.get_readiness_plan(context, "restart")
+    assert plan["wait_time"] == aviatrix_controller_init.wakeup_min_wait_time
+
+
+# End def test_readiness_plan_is_learned()
+
+
+def test_timed_out_wait_is_recorded(wakeup_history, closed_port):
+    event = build_event(hostname="127.0.0.1:%d" % closed_port, private_ip="10.0.0.4")
+    context = aviatrix_controller_init.build_init_context(event)
+    context["wakeup_plan"] = {"wait_time": 1, "probe_schedule": None}
+    with pytest.raises(AviatrixException):
+        aviatrix_controller_init.wait_for_controller_readiness(context, "wakeup")
+    # as a duration of at least its budget
+    entries = wakeup_history.load()
+    assert list(entries) == ["wakeup|*|*|latest"]
+    assert entries["wakeup|*|*|latest"][0] >= 1
+
+
+# End def test_timed_out_wait_is_recorded()
+
+
+def test_ready_wait_is_recorded(wakeup_history, start_controller):
+    server, hostname = start_controller("fast-wakeup")
+    context = aviatrix_controller_init.build_init_context(build_event(hostname=hostname, private_ip="10.0.0.4"))
+    aviatrix_controller_init.wait_for_controller_readiness(context, "wakeup")
+    entries = wakeup_history.load()
+    assert list(entries) == ["wakeup|*|*|latest"]
+    assert len(entries["wakeup|*|*|latest"]) == 1
+    assert entries["wakeup|*|*|latest"][0] >= 0.5
+
+    # the controller is up now, e.g. on a re-run: nothing was waited for, nothing is recorded
+    aviatrix_controller_init.wait_for_controller_readiness(context, "wakeup")
+    assert len(wakeup_history.load()["wakeup|*|*|latest"]) == 1
+
+
+# End def test_ready_wait_is_recorded()
+
+
+def test_run_sets_history_file(wakeup_history, start_controller, tmp_path):
+    # e.g. a job of the persistent worker, started with another history file
+    server, hostname = start_controller("fast-wakeup")
+    event = dict(build_event(hostname=hostname, private_ip="10.0.0.4"), wakeup_history_file=str(tmp_path / "job.json"))
+    context = aviatrix_controller_init.build_init_context(event)
+    aviatrix_controller_init.wait_for_controller_readiness(context, "wakeup")
+    assert list(WakeupHistory(history_file=str(tmp_path / "job.json")).load()) == ["wakeup|*|*|latest"]
+    assert wakeup_history.load() == dict()
+
+
+# End def test_run_sets_history_file()
+
+
+def test_init_context_plans_from_stored_percentiles(wakeup_history):
+    # durations stored by earlier runs of the same region and VM size, e.g. by other processes
+    durations = [float(duration) for duration in range(100, 200, 10)]
+    with open(wakeup_history.history_file, "w") as f:
+        json.dump({"wakeup|westeurope|Standard_A4_v2|latest": durations, "upgrade|*|*|*": [400, 420, 440]}, f)
+    wakeup_history.entries = wakeup_history.load()
+
+    event = dict(
+        build_event(hostname="127.0.0.1:1", private_ip="10.0.0.4"), location="westeurope", vm_size="Standard_A4_v2"
+    )
+    context = aviatrix_controller_init.build_init_context(event)
+    wakeup_plan = context["wakeup_plan"]
+    assert wakeup_plan["wait_time"] == int(
+        aviatrix_controller_init.get_percentile(durations, 99) * aviatrix_controller_init.wakeup_wait_margin
+    ) + 1
+    early_time = aviatrix_controller_init.get_percentile(durations, 5)
+    late_time = aviatrix_controller_init.get_percentile(durations, 95)
+    assert wakeup_plan["probe_schedule"](early_time - 1) == 2
+    assert wakeup_plan["probe_schedule"](early_time) == aviatrix_controller_init.wakeup_dense_probe_interval
+    assert wakeup_plan["probe_schedule"](late_time + 1) == 2
+    assert context["upgrade_plan"]["wait_time"] == int(440 * aviatrix_controller_init.wakeup_wait_margin) + 1
+    # no restart durations: the fixed budget and the default backoff
+    assert context["restart_plan"] == {
+        "wait_time": aviatrix_controller_init.default_wait_time_for_apache_wakeup,
+        "probe_schedule": None,
+    }
+
+    # another VM size has too few durations of its own and falls back to the region
+    context = aviatrix_controller_init.build_init_context(dict(event, vm_size="Standard_D4_v3"))
+    assert context["wakeup_plan"]["wait_time"] == wakeup_plan["wait_time"]
+
+
+# End def test_init_context_plans_from_stored_percentiles()
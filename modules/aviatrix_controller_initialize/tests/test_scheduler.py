@@ -0,0 +1,139 @@
+import threading
+import time
+
+import pytest
+
+import aviatrix_controller_init
+from aviatrix_controller_init import AviatrixException, InitStep
+from benchmark_init import build_event
+
+
+def record_intervals(steps, intervals):
+    # wrap the run of every step to record its (start, end) in intervals[step number]
+    def wrap(step):
+        run = step.run
+
+        def timed_run(context):
+            start_time = time.monotonic()
+            try:
+                run(context)
+            finally:
+                intervals[step.number] = (start_time, time.monotonic())
+
+        step.run = timed_run
+
+    for step in steps:
+        wrap(step)
+    return steps
+
+
+# End def record_intervals()
+
+
+def overlap(first, second):
+    return first[0] < second[1] and second[0] < first[1]
+
+
+# End def overlap()
+
+
+def test_independent_steps_run_concurrently(start_controller, monkeypatch):
+    # the customer id and the access account take 0.5 second each, both run after the re-login
+    server, hostname = start_controller(
+        {"response_delays": {"setup_customer_id": ("fixed", 0.5), "setup_account_profile": ("fixed", 0.5)}}
+    )
+    intervals = dict()
+    steps = record_intervals(aviatrix_controller_init.build_init_steps(), intervals)
+    monkeypatch.setattr(aviatrix_controller_init, "build_init_steps", lambda: steps)
+    aviatrix_controller_init.function_handler(build_event(hostname=hostname, private_ip=server.state.private_ip))
+
+    assert sorted(intervals) == list(range(0, 12))
+    assert overlap(intervals[10], intervals[11])
+    # no step starts before its dependencies end
+    for step in steps:
+        for number in step.depends_on:
+            assert intervals[number][1] <= intervals[step.number][0]
+    assert server.state.customer_id == "aviatrix-1234567.89"
+    assert list(server.state.accounts) == ["azure-account"]
+
+
+# End def test_independent_steps_run_concurrently()
+
+
+def test_failed_preflight_aborts_readiness_wait(start_controller):
+    # the controller does not answer yet, the invalid input stops the wait right away
+    server, hostname = start_controller({"boot_delay": ("fixed", 60)})
+    event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+    event["admin_email"] = "not an email"
+    start_time = time.monotonic()
+    with pytest.raises(AviatrixException) as excinfo:
+        aviatrix_controller_init.function_handler(event)
+    assert "admin_email is not an email address" in str(excinfo.value)
+    assert time.monotonic() - start_time < 10
+    assert server.state.request_count == 0
+
+
+# End def test_failed_preflight_aborts_readiness_wait()
+
+
+def test_steps_are_limited_to_max_workers():
+    in_flight = [0]
+    max_in_flight = [0]
+    lock = threading.Lock()
+
+    def run(context):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+
+    intervals = dict()
+    steps = [InitStep(0, "first", run)] + [InitStep(number, "next", run, depends_on=[0]) for number in range(1, 6)]
+    steps = record_intervals(steps, intervals)
+    aviatrix_controller_init.run_init_steps(steps=steps, context=dict(), max_workers=2)
+    assert sorted(intervals) == list(range(0, 6))
+    assert max_in_flight[0] == 2
+
+
+# End def test_steps_are_limited_to_max_workers()
+
+
+def test_failed_step_stops_the_flow():
+    started = list()
+    abort = threading.Event()
+
+    def run(context):
+        started.append("run")
+
+    def fail(context):
+        raise AviatrixException(message="step failed")
+
+    def wait_for_abort(context):
+        # a running step is asked to stop
+        assert context["abort"].wait(timeout=5)
+
+    steps = [
+        InitStep(0, "fail", fail),
+        InitStep(1, "running", wait_for_abort),
+        InitStep(2, "dependent", run, depends_on=[0]),
+    ]
+    with pytest.raises(AviatrixException) as excinfo:
+        aviatrix_controller_init.run_init_steps(steps=steps, context={"abort": abort})
+    assert str(excinfo.value) == "step failed"
+    assert abort.is_set()
+    assert started == []
+
+
+# End def test_failed_step_stops_the_flow()
+
+
+def test_unresolvable_dependencies_are_refused():
+    steps = [InitStep(0, "first", lambda context: None), InitStep(1, "next", lambda context: None, depends_on=[7])]
+    with pytest.raises(AviatrixException) as excinfo:
+        aviatrix_controller_init.run_init_steps(steps=steps, context=dict())
+    assert "[1]" in str(excinfo.value)
+
+
+# End def test_unresolvable_dependencies_are_refused()
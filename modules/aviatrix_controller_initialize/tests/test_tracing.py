@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+import aviatrix_controller_init
+from aviatrix_controller_init import AviatrixException
+from benchmark_init import build_event
+
+
+def read_spans(path):
+    with open(path) as f:
+        timeline = json.load(f)
+    return timeline["spans"]
+
+
+# End def read_spans()
+
+
+def test_trace_timeline(start_controller, tmp_path):
+    server, hostname = start_controller("ready")
+    event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+    event["trace_file"] = str(tmp_path / "trace-{hostname}.json")
+    aviatrix_controller_init.function_handler(event)
+
+    spans = read_spans(str(tmp_path / ("trace-%s.json" % hostname.replace(":", "_"))))
+    spans_by_id = dict((span["span_id"], span) for span in spans)
+    roots = [span for span in spans if not span["parent_span_id"]]
+    assert [span["name"] for span in roots] == ["function_handler"]
+    # a probe may fail before the stand-in listens, and is retried
+    assert [span["name"] for span in spans if span["status"] != "ok" and span["attributes"].get("kind") != "probe"] == []
+
+    # the steps are children of the run, the API calls and probes are children of a step
+    steps = [span for span in spans if span["parent_span_id"] == roots[0]["span_id"]]
+    assert sorted(span["attributes"]["step"] for span in steps) == list(range(0, 12))
+    calls = [span for span in spans if span["attributes"].get("kind") == "http"]
+    probes = [span for span in spans if span["attributes"].get("kind") == "probe"]
+    for span in calls + probes:
+        assert spans_by_id[span["parent_span_id"]] in steps
+    # every request the controller got is an API call or an HTTP or API readiness probe
+    assert len(calls) + len([span for span in probes if span["attributes"]["stage"] in ("http", "api")]) == (
+        server.state.request_count
+    )
+    assert set(["login", "initial_setup", "setup_account_profile"]) <= set(
+        span["attributes"]["action"] for span in calls
+    )
+    assert all(span["attributes"]["status_code"] == 200 for span in calls)
+
+
+# End def test_trace_timeline()
+
+
+def test_trace_otlp_records_failure(start_controller, tmp_path):
+    server, hostname = start_controller("not-found")
+    event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+    event["trace_file"] = str(tmp_path / "trace.json")
+    event["trace_format"] = "otlp"
+    with pytest.raises(AviatrixException):
+        aviatrix_controller_init.function_handler(event)
+
+    # the timeline of a failed run is still written
+    with open(str(tmp_path / "trace.json")) as f:
+        otlp = json.load(f)
+    resource_spans = otlp["resourceSpans"][0]
+    assert resource_spans["resource"]["attributes"][0]["key"] == "service.name"
+    spans = resource_spans["scopeSpans"][0]["spans"]
+    root = [span for span in spans if span["name"] == "function_handler"][0]
+    assert root["status"]["code"] == 2
+    assert "404" in root["status"]["message"]
+    # the failure is recorded on the API probe of the readiness wait and on its step
+    failed = [span["name"] for span in spans if span["status"]["code"] == 2]
+    assert failed == ["function_handler", "Step1. wait until API server is ready", "readiness probe api"]
+
+
+# End def test_trace_otlp_records_failure()
+
+
+def test_fleet_writes_one_timeline_per_controller(start_controller, tmp_path):
+    servers = [start_controller("ready") for i in range(2)]
+    events = list()
+    for server, hostname in servers:
+        event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+        event["trace_file"] = str(tmp_path / "trace.json")
+        events.append(event)
+    results = aviatrix_controller_init.function_handler_fleet(events=events, max_concurrency=2)
+    assert all(result["success"] for result in results)
+
+    paths = sorted(tmp_path.glob("trace-*.json"))
+    assert len(paths) == 2
+    for (server, hostname), path in zip(sorted(servers, key=lambda item: item[1]), paths):
+        assert path.name.startswith("trace-%s-" % hostname.replace(":", "_"))
+        spans = read_spans(str(path))
+        assert [span["attributes"]["hostname"] for span in spans if span["name"] == "function_handler"] == [hostname]
+
+
+# End def test_fleet_writes_one_timeline_per_controller()
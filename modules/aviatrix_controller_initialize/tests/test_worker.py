@@ -0,0 +1,185 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import aviatrix_controller_worker
+from benchmark_init import build_event
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / "worker" / "aviatrix_controller_init.sock")
+
+
+# End def socket_path()
+
+
+def start_serve(socket_path, idle_timeout=0):
+    thread = threading.Thread(
+        target=aviatrix_controller_worker.serve,
+        kwargs={"socket_path": socket_path, "idle_timeout": idle_timeout},
+        daemon=True,
+    )
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not aviatrix_controller_worker.is_worker_running(socket_path):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    return thread
+
+
+# End def start_serve()
+
+
+def test_run_job_round_trip(start_controller, socket_path, capsys, caplog):
+    caplog.set_level(logging.INFO)
+    server, hostname = start_controller("ready")
+    thread = start_serve(socket_path)
+    assert oct(os.stat(os.path.dirname(socket_path)).st_mode & 0o777) == "0o700"
+
+    result = aviatrix_controller_worker.run_job(
+        {"event": build_event(hostname=hostname, private_ip=server.state.private_ip)}, socket_path=socket_path
+    )
+    assert result["success"], result["error"]
+    assert result["hostname"] == hostname
+    assert "Aviatrix Controller has been initialized successfully" in capsys.readouterr().out
+    assert server.state.password == "Aviatrix123#"
+
+    status = aviatrix_controller_worker.send_worker_request({"command": "status"}, socket_path=socket_path)
+    assert status["jobs_served"] == 1
+    assert status["jobs_failed"] == 0
+    aviatrix_controller_worker.send_worker_request({"command": "stop"}, socket_path=socket_path)
+    thread.join(10)
+    assert not thread.is_alive()
+    assert not os.path.exists(socket_path)
+
+
+# End def test_run_job_round_trip()
+
+
+def test_failed_job_is_reported(start_controller, socket_path):
+    server, hostname = start_controller("not-found")
+    thread = start_serve(socket_path)
+    event = dict(build_event(hostname=hostname, private_ip=server.state.private_ip), deadline=30)
+    result = aviatrix_controller_worker.run_job({"event": event}, socket_path=socket_path)
+    assert not result["success"]
+    assert result["error"]
+    # the arguments of the legacy invocation are turned into the event by the daemon
+    result = aviatrix_controller_worker.run_job({"arguments": ["1.2.3.4"]}, socket_path=socket_path)
+    assert not result["success"]
+    assert "12 arguments" in result["error"]
+    aviatrix_controller_worker.send_worker_request({"command": "stop"}, socket_path=socket_path)
+    thread.join(10)
+
+
+# End def test_failed_job_is_reported()
+
+
+def test_job_with_other_settings_is_refused(start_controller, socket_path, monkeypatch):
+    # the daemon reads the retry settings only when it starts
+    server, hostname = start_controller("ready")
+    monkeypatch.delenv("AVIATRIX_RETRY_MAX_ATTEMPTS", raising=False)
+    thread = start_serve(socket_path)
+    monkeypatch.setenv("AVIATRIX_RETRY_MAX_ATTEMPTS", "9")
+    event = build_event(hostname=hostname, private_ip=server.state.private_ip)
+    result = aviatrix_controller_worker.run_job({"event": event}, socket_path=socket_path)
+    assert not result["success"]
+    assert "AVIATRIX_RETRY_MAX_ATTEMPTS" in result["error"]
+    assert server.state.request_count == 0
+
+    monkeypatch.delenv("AVIATRIX_RETRY_MAX_ATTEMPTS")
+    result = aviatrix_controller_worker.run_job({"event": event}, socket_path=socket_path)
+    assert result["success"], result["error"]
+    aviatrix_controller_worker.send_worker_request({"command": "stop"}, socket_path=socket_path)
+    thread.join(10)
+
+
+# End def test_job_with_other_settings_is_refused()
+
+
+def test_idle_worker_exits(socket_path):
+    thread = start_serve(socket_path, idle_timeout=1)
+    thread.join(10)
+    assert not thread.is_alive()
+    assert not aviatrix_controller_worker.is_worker_running(socket_path)
+    assert not os.path.exists(socket_path)
+
+
+# End def test_idle_worker_exits()
+
+
+def test_stale_socket_is_replaced(socket_path):
+    # the socket file of a killed daemon: it exists, but nothing listens on it
+    aviatrix_controller_worker.check_socket_directory(socket_path, create=True)
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    assert os.path.exists(socket_path)
+    assert not aviatrix_controller_worker.is_worker_running(socket_path)
+
+    thread = start_serve(socket_path)
+    status = aviatrix_controller_worker.send_worker_request({"command": "status"}, socket_path=socket_path)
+    assert status["socket"] == socket_path
+    aviatrix_controller_worker.send_worker_request({"command": "stop"}, socket_path=socket_path)
+    thread.join(10)
+
+
+# End def test_stale_socket_is_replaced()
+
+
+def test_socket_directory_open_to_others_is_refused(tmp_path):
+    socket_dir = tmp_path / "shared"
+    socket_dir.mkdir()
+    os.chmod(str(socket_dir), 0o777)
+    with pytest.raises(RuntimeError):
+        aviatrix_controller_worker.check_socket_directory(str(socket_dir / "aviatrix_controller_init.sock"))
+
+
+# End def test_socket_directory_open_to_others_is_refused()
+
+
+def test_peer_of_another_user_is_refused(socket_path, monkeypatch):
+    thread = start_serve(socket_path)
+    monkeypatch.setattr(aviatrix_controller_worker, "get_peer_uid", lambda connection, path: os.getuid() + 1)
+    with pytest.raises(RuntimeError):
+        aviatrix_controller_worker.send_worker_request({"command": "status"}, socket_path=socket_path)
+    monkeypatch.undo()
+    aviatrix_controller_worker.send_worker_request({"command": "stop"}, socket_path=socket_path)
+    thread.join(10)
+
+
+# End def test_peer_of_another_user_is_refused()
+
+
+def test_job_settings_and_scrubbed_environment():
+    environ = {
+        "AVIATRIX_INIT_DEADLINE": "900",
+        "AVIATRIX_PREFLIGHT_ARM_CHECK": "false",
+        "AVIATRIX_INIT_EVENT": "{}",
+        "AVIATRIX_WAKEUP_HISTORY_FILE": "history.json",
+        "AVIATRIX_CID_CACHE_FILE": "cid.json",
+        "AVIATRIX_WORKER_IDLE_TIMEOUT": "60",
+        "ARM_CLIENT_SECRET": "secret",
+        "PATH": "/usr/bin",
+    }
+    assert aviatrix_controller_worker.get_job_settings(environ) == {
+        "deadline": "900",
+        "preflight_arm_check": False,
+        "wakeup_history_file": "history.json",
+    }
+    assert aviatrix_controller_worker.get_process_settings(environ) == {"AVIATRIX_CID_CACHE_FILE": "cid.json"}
+    assert aviatrix_controller_worker.get_worker_environment(environ) == {
+        "AVIATRIX_INIT_DEADLINE": "900",
+        "AVIATRIX_PREFLIGHT_ARM_CHECK": "false",
+        "AVIATRIX_WAKEUP_HISTORY_FILE": "history.json",
+        "AVIATRIX_CID_CACHE_FILE": "cid.json",
+        "AVIATRIX_WORKER_IDLE_TIMEOUT": "60",
+        "PATH": "/usr/bin",
+    }
+
+
+# End def test_job_settings_and_scrubbed_environment()
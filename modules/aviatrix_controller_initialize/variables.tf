@@ -8,6 +8,12 @@ variable "avx_controller_private_ip" {
   description = "aviatrix controller private ip address(required)"
 }
 
+variable "avx_controller_instance_id" {
+  type        = string
+  description = "Virtual machine id of the aviatrix controller, a rebuilt controller does not resume the initialization journal of the previous one"
+  default     = ""
+}
+
 variable "avx_controller_admin_email" {
   type        = string
   description = "aviatrix controller admin email address"
@@ -65,3 +71,33 @@ variable "controller_version" {
   description = "Aviatrix Controller version"
   default     = "latest"
 }
+
+variable "use_init_worker" {
+  type        = bool
+  description = "Run the initialization in a persistent local worker process shared by all controllers"
+  default     = false
+}
+
+variable "init_journal_dir" {
+  type        = string
+  description = "Directory of the journals of the initialization, a re-applied failed initialization resumes at the first incomplete step. Defaults to .terraform/aviatrix_init_journal in the root module"
+  default     = ""
+}
+
+variable "wakeup_history_file" {
+  type        = string
+  description = "History of the wake-up, upgrade and restart durations of the controllers, sets the wait budgets and the probe schedule of the next initializations. Defaults to .terraform/aviatrix_wakeup_history.json in the root module"
+  default     = ""
+}
+
+variable "location" {
+  type        = string
+  description = "Azure region of the controller, breaks down the wake-up history of the initialization"
+  default     = ""
+}
+
+variable "controller_virtual_machine_size" {
+  type        = string
+  description = "Virtual machine size of the controller, breaks down the wake-up history of the initialization"
+  default     = ""
+}